@@ -1,13 +1,27 @@
 # /microservices/api-gateway/api-gateway.py
 
-import pika
+import os
+import sys
 import json
+import math
+import asyncio
+import contextlib
 import threading
 import requests
-import queue
 import time
+import uuid
 from flask import Flask, request, jsonify, Response
 from flask_cors import CORS
+from collections import OrderedDict, defaultdict, deque
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from comum.http_cliente import ClienteHTTP
+from comum.publicador import PublicadorEventos
+from comum.assinatura import CABECALHO_ASSINATURA, assinar, assinar_pedido, verificar_pedido
+from comum.consumidor import ConsumidorEventos
+from comum.idempotencia import CacheIdempotencia
+from comum.limitador import BaldesTokens, LimiteConcorrencia
+from comum.particionamento import AnelConsistente, ler_replicas, particao_do_leilao, rota_particionada, rota_base
 
 # --- Configurações ---
 RABBITMQ_HOST = '127.0.0.1'
@@ -17,16 +31,415 @@ EXCHANGE_NAME = 'leilao_topic_exchange'
 
 MS_LEILAO_URL = "http://127.0.0.1:5001"
 MS_LANCE_URL = "http://127.0.0.1:5002"
+# Réplicas do MS Lance ({id: url}); cada lance vai para a dona da partição do leilão
+MS_LANCE_REPLICAS = ler_replicas(os.environ.get('MS_LANCE_REPLICAS', f"ms-lance-0={MS_LANCE_URL}"))
+# Todas as réplicas que podem entrar num rebalanceamento (id=url); o PUT não aceita outras
+MS_LANCE_PERMITIDAS = ler_replicas(os.environ.get('MS_LANCE_PERMITIDAS', '')) or dict(MS_LANCE_REPLICAS)
+# Assina o PUT /particoes/ms-lance (operador) e as chamadas às réplicas; mesmo valor no MS Lance
+PARTICOES_SEGREDO = os.environ.get('PARTICOES_SEGREDO', 'segredo-dev-particoes').encode()
+# Conexões keep-alive por upstream (uma por thread do Flask em uso simultâneo)
+HTTP_POOL = int(os.environ.get('HTTP_POOL', 50))
+IDEMPOTENCIA_CAPACIDADE = int(os.environ.get('IDEMPOTENCIA_CAPACIDADE', 100000)) # Respostas de /lance lembradas (LRU)
+# Admissão de lances: token bucket por usuário e por leilão (lances/s e rajada) e um teto de
+# chamadas simultâneas ao MS Lance. Acima disso o lance é recusado na hora (429/503 + Retry-After)
+LANCES_POR_USUARIO = float(os.environ.get('LANCES_POR_USUARIO', 5))
+RAJADA_POR_USUARIO = float(os.environ.get('RAJADA_POR_USUARIO', 10))
+LANCES_POR_LEILAO = float(os.environ.get('LANCES_POR_LEILAO', 200))
+RAJADA_POR_LEILAO = float(os.environ.get('RAJADA_POR_LEILAO', 400))
+MS_LANCE_EM_VOO = int(os.environ.get('MS_LANCE_EM_VOO', 64))
+
+# 'sincrono' = POST /lance repassado ao MS Lance; 'fila' = comando assinado em fila durável, resposta 202
+LANCE_MODO = os.environ.get('LANCE_MODO', 'sincrono')
+LANCE_SEGREDO = os.environ.get('LANCE_SEGREDO', 'segredo-dev-leilao').encode() # Mesmo valor do MS Lance
+ROUTING_KEY_COMANDO_LANCE = 'lance.comando' # Publicado com a partição: lance.comando.p<k>
+CONFIRMAR_PUBLICACAO = os.environ.get('CONFIRMAR_PUBLICACAO') == '1' # Confirmação do broker por lote
+# 'evento' = MS Lance publica um lance.invalidado por rejeição; 'agregado' = a rejeição chega só ao
+# próprio usuário (resposta HTTP + SSE dele) e o MS Lance publica contagens periódicas (lance.rejeicoes)
+REJEICOES_MODO = os.environ.get('REJEICOES_MODO', 'evento') # Mesmo valor do MS Lance
+REJEICOES_LIMITE_MAXIMO = 1000 # Leilões listados por GET /metricas/rejeicoes
+
+# Cache da listagem de leilões: respostas do MS Leilão valem por este tempo
+CACHE_LEILOES_TTL = 1.0
+CACHE_LEILOES_MAX = 1024 # Consultas distintas guardadas (LRU); a query string vem do cliente
+CACHE_LEILOES_RETENCAO = 30.0 # Vencidas ficam este tempo só para revalidar com ETag
+TIMEOUT_SINGLE_FLIGHT = 10
+
+# 'thread' = servidor Flask (uma thread por conexão SSE); 'async' = ASGI/uvicorn + aio-pika
+GATEWAY_MODO = os.environ.get('GATEWAY_MODO', 'thread')
+SSE_KEEPALIVE = 15 # Segundos sem eventos até mandar um comentário de keep-alive
 
-BINDING_KEYS = ['lance.validado', 'lance.invalidado', 'leilao.vencedor', 'link_pagamento', 'status_pagamento']
+# Filas SSE por cliente: acima do limite suave, eventos descartáveis são
+# jogados fora; acima do limite duro o cliente é desconectado
+SSE_LIMITE_FILA = int(os.environ.get('SSE_LIMITE_FILA', 100))
+SSE_LIMITE_DURO = int(os.environ.get('SSE_LIMITE_DURO', 1000))
+EVENTOS_COALESCIVEIS = {'novo_lance'} # Só o preço mais recente de cada leilão importa
+# Replay na reconexão (Last-Event-ID): últimos eventos guardados por leilão e por usuário
+SSE_REPLAY_POR_LEILAO = 64
+SSE_REPLAY_POR_USUARIO = 32
+SSE_MAX_SESSOES_SALVAS = 10000 # Inscrições lembradas de usuários desconectados
+SSE_MAX_HISTORICOS = 10000 # Leilões/usuários com histórico guardado (os mais antigos saem)
+EVENTOS_ESSENCIAIS = {'vencedor_leilao', 'link_pagamento', 'status_pagamento',
+                      'leilao_iniciado', 'leilao_finalizado'} # Nunca descartados
+EVENTOS_BROADCAST = {'leilao_iniciado', 'leilao_finalizado'} # Vão para todos os conectados
+SSE_REPLAY_GLOBAL = 256 # Eventos de broadcast guardados para replay
+
+GATEWAY_ID = os.environ.get('GATEWAY_ID', '1') # Identifica a fila durável desta instância
+# Rejeições de lances que ESTE Gateway enfileirou (REJEICOES_MODO=agregado): só esta instância recebe
+ROTA_REJEICOES_LOCAIS = f'lance.invalidado.{GATEWAY_ID}'
+BINDING_KEYS = ['leilao.iniciado.#', 'leilao.finalizado.#', 'lance.validado', 'lance.invalidado',
+                ROTA_REJEICOES_LOCAIS, 'lance.rejeicoes', 'leilao.vencedor', 'link_pagamento', 'status_pagamento']
+FILA_EVENTOS = f'gateway.{GATEWAY_ID}.eventos'
+ARGUMENTOS_FILA = {'x-expires': 3600 * 1000} # Fila de instância abandonada some após 1h sem consumidor
+CONSUMO_PREFETCH = int(os.environ.get('CONSUMO_PREFETCH', 500))
+LOTE_ACK = 200 # Mensagens confirmadas por basic_ack(multiple=True)
+INTERVALO_ACK = 0.05 # Modo async: segundos até confirmar um lote parcial
 
 app = Flask(__name__)
-CORS(app)
+CORS(app, expose_headers=['X-Proximo-Cursor', 'ETag', 'Idempotent-Replayed', 'Retry-After'])
+
+# Clientes HTTP dos upstreams: pool keep-alive, timeouts e disjuntor
+# (com o MS fora do ar, as chamadas falham na hora com 503 em vez de segurar threads)
+ms_leilao = ClienteHTTP('MS Leilão', MS_LEILAO_URL, pool=HTTP_POOL)
+
+def montar_roteamento_lance(replicas):
+    """Anel de hash consistente + um cliente HTTP por réplica do MS Lance."""
+    clientes = {id_replica: ClienteHTTP(f'MS Lance {id_replica}', url, pool=HTTP_POOL)
+                for id_replica, url in replicas.items()}
+    return AnelConsistente(replicas), clientes
+
+# Trocado inteiro em um rebalanceamento; quem roteia lê a tupla uma vez
+roteamento_lance = montar_roteamento_lance(MS_LANCE_REPLICAS)
+rebalanceamento_lock = threading.Lock()
+
+def cliente_do_leilao(id_leilao):
+    anel, clientes = roteamento_lance
+    return clientes[anel.dono_da_particao(particao_do_leilao(id_leilao))]
+
+def comando_sem_destino(routing_key, corpo):
+    """Comando que nenhuma réplica recebeu (partição sem fila ligada): avisa o usuário pelo SSE."""
+    lance = json.loads(corpo).get('lance', {})
+    despachar_evento_sse('lance_invalido', dict(lance, erro="MS Lance indisponível para este leilão, tente novamente"))
+
+# Publicador dos comandos de lance (só no modo fila). As filas de comandos são
+# declaradas pelas réplicas do MS Lance, cada uma ligada às suas partições, e
+# mudam de dono no rebalanceamento; por isso o Gateway não as declara. Os
+# comandos vão com mandatory: um comando publicado antes de alguma réplica
+# ligar a partição volta do broker e é republicado em vez de se perder.
+publicador_comandos = PublicadorEventos(
+    RABBITMQ_HOST, RABBITMQ_USER, RABBITMQ_PASS, EXCHANGE_NAME, nome='gateway-lances',
+    confirmar=CONFIRMAR_PUBLICACAO, obrigatorio=True, ao_descartar=comando_sem_destino,
+) if LANCE_MODO == 'fila' else None
+
+# Resposta já dada a cada Idempotency-Key de POST /lance: retries não chegam ao MS Lance
+idempotencia = CacheIdempotencia(IDEMPOTENCIA_CAPACIDADE)
+
+baldes_usuario = BaldesTokens(LANCES_POR_USUARIO, RAJADA_POR_USUARIO)
+baldes_leilao = BaldesTokens(LANCES_POR_LEILAO, RAJADA_POR_LEILAO)
+em_voo_ms_lance = LimiteConcorrencia(MS_LANCE_EM_VOO) # Todas as réplicas somadas
+
+def recusar(mensagem, status, espera):
+    resposta = jsonify({"erro": mensagem})
+    resposta.headers['Retry-After'] = str(espera)
+    return resposta, status
 
 # --- Gerenciamento SSE ---
-clientes_sse = {}
+clientes_sse = {} # id_usuario -> ClienteSSE
+inscritos_por_leilao = defaultdict(set) # id_leilao -> {ClienteSSE}; índice invertido de cliente.interesses
 clientes_lock = threading.Lock()
 
+# Replay (todos sob clientes_lock)
+# Ids começam no relógio (µs): continuam crescentes depois de um reinício do Gateway
+ultimo_id_evento = time.time_ns() // 1000
+PRIMEIRO_ID_EVENTO = ultimo_id_evento + 1
+historico_por_leilao = OrderedDict()  # id_leilao -> deque[(id_evento, msg, tipo, id_leilao)]
+historico_por_usuario = OrderedDict() # id_usuario -> deque[(id_evento, msg, tipo, id_leilao)]
+historico_global = deque(maxlen=SSE_REPLAY_GLOBAL) # eventos de broadcast
+sessoes_salvas = OrderedDict() # id_usuario -> interesses no momento da desconexão
+
+# Preço corrente dos leilões ativos, mantido pelos próprios eventos (para o snapshot ao seguir)
+estado_leiloes = {} # id_leilao -> {"id_leilao", "valor"}
+
+# Contagens de lance.rejeicoes (REJEICOES_MODO=agregado): id_leilao -> [rejeições, último erro]
+rejeicoes_por_leilao = {}
+rejeicoes_lock = threading.Lock()
+
+MSG_CONEXAO = f"event: ping\ndata: {json.dumps({'msg': 'conexao_iniciada'})}\n\n"
+MSG_KEEPALIVE = ": keepalive\n\n"
+
+class ClienteSSE:
+    """
+    Conexão SSE de um usuário (modo thread: o gerador da resposta bloqueia em proxima()).
+    A fila é limitada: um novo_lance ainda não enviado é substituído pelo mais
+    recente do mesmo leilão (coalescência), eventos não essenciais são
+    descartados acima de SSE_LIMITE_FILA e acima de SSE_LIMITE_DURO o cliente
+    é desconectado. As mensagens são as mesmas strings para todos os
+    destinatários; nada é serializado por cliente.
+    """
+
+    def __init__(self, id_usuario):
+        self.id_usuario = id_usuario
+        self.interesses = set()
+        self.desconectado = False
+        self.entregues = 0
+        self.coalescidas = 0
+        self.descartadas = 0
+        self._itens = deque()       # slots [msg, tipo, id_leilao]
+        self._lances_pendentes = {} # id_leilao -> slot de novo_lance ainda na fila
+        self._seqs = {} # id_leilao -> maior seq_leilao já enfileirado para este cliente
+        self._cond = threading.Condition()
+
+    def entregar(self, msg, tipo=None, id_leilao=None, seq=None, snapshot=False):
+        """
+        `seq` é o seq_leilao do preço na mensagem. Um snapshot (estado_leilao)
+        mais antigo que o último preço entregue a este cliente é descartado:
+        o preço exibido nunca volta. A checagem e o enfileiramento são atômicos.
+        """
+        with self._cond:
+            if self.desconectado: return
+            if seq is not None:
+                ultimo = self._seqs.get(id_leilao, -1)
+                if snapshot and seq < ultimo:
+                    self.descartadas += 1
+                    return
+                self._seqs[id_leilao] = max(seq, ultimo)
+            if tipo in EVENTOS_COALESCIVEIS:
+                slot = self._lances_pendentes.get(id_leilao)
+                if slot is not None:
+                    slot[0] = msg # Mantém a posição, troca pelo preço mais recente
+                    self.coalescidas += 1
+                    return
+            if len(self._itens) >= SSE_LIMITE_DURO:
+                print(f"[SSE] Cliente {self.id_usuario} lento demais ({len(self._itens)} mensagens). Desconectando.")
+                self.desconectado = True
+                self._itens.clear()
+                self._lances_pendentes.clear()
+                self._sinalizar()
+                return
+            if len(self._itens) >= SSE_LIMITE_FILA and tipo not in EVENTOS_ESSENCIAIS and tipo not in EVENTOS_COALESCIVEIS:
+                self.descartadas += 1
+                return
+            slot = [msg, tipo, id_leilao]
+            self._itens.append(slot)
+            if tipo in EVENTOS_COALESCIVEIS:
+                self._lances_pendentes[id_leilao] = slot
+            self._sinalizar()
+
+    def estatisticas(self):
+        with self._cond:
+            return {"pendentes": len(self._itens), "entregues": self.entregues,
+                    "coalescidas": self.coalescidas, "descartadas": self.descartadas}
+
+    def _retirar(self):
+        # Chamado com self._cond preso e a fila não vazia
+        msg, tipo, id_leilao = self._itens.popleft()
+        if tipo in EVENTOS_COALESCIVEIS:
+            self._lances_pendentes.pop(id_leilao, None)
+        self.entregues += 1
+        return msg
+
+    def _sinalizar(self):
+        self._cond.notify()
+
+    def proxima(self, timeout=None):
+        """Próxima mensagem; MSG_KEEPALIVE no timeout; None se o cliente foi desconectado."""
+        with self._cond:
+            if not self._itens and not self.desconectado:
+                self._cond.wait(timeout)
+            if self._itens:
+                return self._retirar()
+            return None if self.desconectado else MSG_KEEPALIVE
+
+class ClienteSSEAsync(ClienteSSE):
+    """Conexão SSE no modo async: lida por uma corrotina, sem thread dedicada."""
+
+    def __init__(self, id_usuario, loop):
+        super().__init__(id_usuario)
+        self._loop = loop
+        self._thread_loop = threading.get_ident()
+        self._evento = asyncio.Event()
+
+    def _sinalizar(self):
+        # Rotas REST rodam em threads do WSGI; só o event loop pode mexer no asyncio.Event
+        if threading.get_ident() == self._thread_loop:
+            self._evento.set()
+        else:
+            self._loop.call_soon_threadsafe(self._evento.set)
+
+    async def proxima(self, timeout=None):
+        """Próxima mensagem; MSG_KEEPALIVE no timeout; None se o cliente foi desconectado."""
+        with self._cond:
+            if self._itens:
+                return self._retirar()
+            if self.desconectado:
+                return None
+            self._evento.clear()
+        try:
+            await asyncio.wait_for(self._evento.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        with self._cond:
+            if self._itens:
+                return self._retirar()
+            return None if self.desconectado else MSG_KEEPALIVE
+
+def conectar_cliente(cliente, ultimo_id=None):
+    """
+    Registra a conexão. Se o navegador informou o último evento recebido
+    (Last-Event-ID), restaura as inscrições da sessão anterior e reenvia o
+    que foi despachado depois dele. A conexão anterior pode ainda não ter
+    caído (o navegador reconecta antes do servidor notar); nesse caso as
+    inscrições vêm dela, já que o desconectar_cliente dela não salva nada.
+    """
+    with clientes_lock:
+        interesses = sessoes_salvas.pop(cliente.id_usuario, set())
+        anterior = clientes_sse.get(cliente.id_usuario)
+        if anterior is not None:
+            interesses |= anterior.interesses
+        clientes_sse[cliente.id_usuario] = cliente
+        if ultimo_id is None:
+            interesses = set()
+        for id_leilao in interesses:
+            seguir_leilao(cliente, id_leilao)
+        if ultimo_id is not None:
+            # Entrega ainda sob o lock para o replay não chegar depois de um evento novo
+            reenviar_historico(cliente, ultimo_id)
+    print(f"[SSE] Cliente {cliente.id_usuario} conectado" + (f" (retomando após evento {ultimo_id})." if ultimo_id is not None else "."))
+
+def desconectar_cliente(cliente):
+    with clientes_lock:
+        # Só remove se ainda for esta conexão (o usuário pode ter reconectado)
+        if clientes_sse.get(cliente.id_usuario) is cliente:
+            del clientes_sse[cliente.id_usuario]
+            sessoes_salvas[cliente.id_usuario] = set(cliente.interesses)
+            if len(sessoes_salvas) > SSE_MAX_SESSOES_SALVAS:
+                sessoes_salvas.popitem(last=False)
+        for id_leilao in cliente.interesses:
+            _remover_inscrito(id_leilao, cliente)
+        cliente.interesses.clear()
+    print(f"[SSE] Cliente {cliente.id_usuario} desconectou.")
+
+def registrar_historico(chave, historicos, limite, item):
+    historico = historicos.get(chave)
+    if historico is None:
+        historico = historicos[chave] = deque(maxlen=limite)
+        if len(historicos) > SSE_MAX_HISTORICOS:
+            historicos.popitem(last=False)
+    else:
+        historicos.move_to_end(chave)
+    historico.append(item)
+
+def reenviar_historico(cliente, ultimo_id):
+    """Chamado sob clientes_lock. Pede resync se o buffer já perdeu eventos posteriores a ultimo_id."""
+    buffers = [historico_global, historico_por_usuario.get(cliente.id_usuario)]
+    buffers += [historico_por_leilao.get(id_leilao) for id_leilao in cliente.interesses]
+    pendentes = []
+    lacuna = ultimo_id < PRIMEIRO_ID_EVENTO - 1 # O Gateway reiniciou desde então
+    for buffer in buffers:
+        if not buffer: continue
+        if len(buffer) == buffer.maxlen and buffer[0][0] > ultimo_id + 1:
+            lacuna = True
+        pendentes.extend(item for item in buffer if item[0] > ultimo_id)
+    pendentes.sort(key=lambda item: item[0])
+    if lacuna:
+        cliente.entregar(f"event: resync\ndata: {json.dumps({'ultimo_id': ultimo_id})}\n\n", 'resync')
+    for _, msg, tipo, id_leilao in pendentes:
+        cliente.entregar(msg, tipo, id_leilao)
+
+def ler_ultimo_id(valor):
+    try:
+        return int(valor) if valor not in (None, '') else None
+    except ValueError:
+        return None
+
+# Inscrições: sempre sob clientes_lock, mantendo cliente.interesses e o índice juntos
+def seguir_leilao(cliente, id_leilao):
+    cliente.interesses.add(id_leilao)
+    inscritos_por_leilao[id_leilao].add(cliente)
+
+def deixar_de_seguir_leilao(cliente, id_leilao):
+    cliente.interesses.discard(id_leilao)
+    _remover_inscrito(id_leilao, cliente)
+
+def _remover_inscrito(id_leilao, cliente):
+    inscritos = inscritos_por_leilao.get(id_leilao)
+    if inscritos is not None:
+        inscritos.discard(cliente)
+        if not inscritos:
+            del inscritos_por_leilao[id_leilao]
+
+# --- Cache de GET /leiloes (TTL + single-flight) ---
+cache_leiloes = OrderedDict()  # query string -> {"expira": ts, "status": int, "corpo": bytes, "headers": dict}
+voos_leiloes = {}   # query string -> busca em andamento no MS Leilão
+cache_leiloes_lock = threading.Lock()
+
+def buscar_leiloes_cacheado(params):
+    """
+    Retorna a listagem do MS Leilão, reaproveitando a resposta por CACHE_LEILOES_TTL.
+    Se várias requisições chegam com o cache vencido, só a primeira vai ao
+    MS Leilão; as demais esperam e recebem o mesmo resultado.
+    """
+    chave = '&'.join(f"{k}={v}" for k, v in sorted(params.items()))
+    with cache_leiloes_lock:
+        item = cache_leiloes.get(chave)
+        if item and item['expira'] > time.monotonic():
+            return item
+        voo = voos_leiloes.get(chave)
+        lider = voo is None
+        if lider:
+            voo = voos_leiloes[chave] = {"evento": threading.Event(), "item": None, "erro": None}
+
+    if not lider:
+        if not voo['evento'].wait(TIMEOUT_SINGLE_FLIGHT):
+            raise requests.exceptions.Timeout("Aguardando listagem em andamento")
+        if voo['erro']:
+            raise voo['erro']
+        return voo['item']
+
+    try:
+        print(f"[Gateway] Encaminhando GET /leiloes para {MS_LEILAO_URL}")
+        # Revalida com o ETag da resposta vencida: se nada mudou o MS Leilão responde 304 sem corpo
+        headers = {'If-None-Match': item['headers']['ETag']} if item and 'ETag' in item['headers'] else {}
+        response = ms_leilao.get("/leiloes/ativos", params=params, headers=headers)
+        if response.status_code == 304:
+            novo = dict(item, expira=time.monotonic() + CACHE_LEILOES_TTL)
+        else:
+            novo = {
+                "expira": time.monotonic() + CACHE_LEILOES_TTL,
+                "status": response.status_code,
+                "corpo": response.content,
+                "headers": {k: response.headers[k] for k in ('ETag', 'X-Proximo-Cursor') if k in response.headers},
+            }
+        with cache_leiloes_lock:
+            if novo['status'] == 200:
+                cache_leiloes[chave] = novo
+                cache_leiloes.move_to_end(chave)
+                podar_cache_leiloes()
+            else:
+                cache_leiloes.pop(chave, None)
+        voo['item'] = novo
+        return novo
+    except requests.exceptions.RequestException as e:
+        voo['erro'] = e
+        raise
+    finally:
+        if voo['item'] is None and voo['erro'] is None:
+            # Falha inesperada do líder: quem espera recebe um erro tratável (503), não None
+            voo['erro'] = requests.exceptions.RequestException("Falha ao buscar a listagem de leilões")
+        with cache_leiloes_lock:
+            voos_leiloes.pop(chave, None)
+        voo['evento'].set()
+
+def podar_cache_leiloes():
+    """
+    Sob cache_leiloes_lock. A ordem do OrderedDict é a de gravação, então os
+    vencidos há mais de CACHE_LEILOES_RETENCAO ficam no começo; acima de
+    CACHE_LEILOES_MAX sai também o menos recente.
+    """
+    limite = time.monotonic() - CACHE_LEILOES_RETENCAO
+    while cache_leiloes and (len(cache_leiloes) > CACHE_LEILOES_MAX
+                             or next(iter(cache_leiloes.values()))['expira'] < limite):
+        cache_leiloes.popitem(last=False)
+
 # --- Endpoints REST ---
 
 @app.route('/leiloes', methods=['GET', 'POST'])
@@ -34,40 +447,132 @@ def gerenciar_leiloes():
     if request.method == 'POST':
         try:
             print(f"[Gateway] Encaminhando POST /leiloes para {MS_LEILAO_URL}")
-            response = requests.post(f"{MS_LEILAO_URL}/leiloes", json=request.json)
+            response = ms_leilao.post("/leiloes", json=request.json)
             return jsonify(response.json()), response.status_code
         except requests.exceptions.RequestException as e:
             return jsonify({"erro": f"Erro MS Leilão: {e}"}), 503
             
     elif request.method == 'GET':
         try:
-            print(f"[Gateway] Encaminhando GET /leiloes para {MS_LEILAO_URL}")
-            response = requests.get(f"{MS_LEILAO_URL}/leiloes/ativos")
-            return jsonify(response.json()), response.status_code
+            # Repassa a paginação (limit, cursor, ordem); o corpo já vem serializado do MS Leilão
+            item = buscar_leiloes_cacheado(request.args.to_dict())
+            etag = item['headers'].get('ETag')
+            if etag and request.if_none_match.contains(etag.strip('"')):
+                return Response(status=304, headers={'ETag': etag})
+            return Response(item['corpo'], status=item['status'], mimetype='application/json', headers=item['headers'])
         except requests.exceptions.RequestException as e:
             return jsonify({"erro": f"Erro MS Leilão: {e}"}), 503
 
+@app.route('/leiloes/lote', methods=['POST'])
+def criar_leiloes_lote():
+    try:
+        print(f"[Gateway] Encaminhando POST /leiloes/lote para {MS_LEILAO_URL}")
+        response = ms_leilao.post("/leiloes/lote", json=request.json)
+        return Response(response.content, status=response.status_code, mimetype='application/json')
+    except requests.exceptions.RequestException as e:
+        return jsonify({"erro": f"Erro MS Leilão: {e}"}), 503
+
+@app.route('/leiloes/<int:id_leilao>/lances', methods=['GET'], defaults={'consulta': None})
+@app.route('/leiloes/<int:id_leilao>/lances/<any(top, serie):consulta>', methods=['GET'])
+def historico_lances_proxy(id_leilao, consulta):
+    """Histórico de lances (últimos, top N, série de preços): proxy para a réplica dona do leilão."""
+    caminho = f"/leiloes/{id_leilao}/lances" + (f"/{consulta}" if consulta else "")
+    try:
+        response = cliente_do_leilao(id_leilao).get(caminho, params=request.args.to_dict())
+        return Response(response.content, status=response.status_code, mimetype='application/json')
+    except requests.exceptions.RequestException as e:
+        return jsonify({"erro": f"Erro MS Lance: {e}"}), 503
+
 @app.route('/lance', methods=['POST'])
 def efetuar_lance_proxy():
-    dados = request.json
-    
+    return atender_lance(request.json, enfileirar_lance if publicador_comandos else repassar_lance)
+
+@app.route('/lance/maximo', methods=['POST'])
+def efetuar_lance_maximo_proxy():
+    """Lance automático (até valor_maximo): sempre síncrono, na réplica dona do leilão."""
+    return atender_lance(request.json, lambda dados, chave: repassar_lance(dados, chave, '/lance/maximo'))
+
+def atender_lance(dados, executar):
+    """Admissão, auto-follow e idempotência comuns aos lances; `executar(dados, chave)` decide."""
     id_usuario = dados.get('id_usuario')
     id_leilao = dados.get('id_leilao')
+
+    # Idempotency-Key (ou id_lance do cliente): um retry recebe a mesma resposta.
+    # Vem antes dos baldes: o retry de um lance já decidido não gasta ficha nem leva 429
+    chave = request.headers.get('Idempotency-Key') or dados.get('id_lance')
+    chave = str(chave) if chave else None
+    chave_cache = f"{id_usuario}:{chave}" if chave else None
+    if chave_cache:
+        veredito = idempotencia.obter(chave_cache)
+        if veredito is not CacheIdempotencia.AUSENTE:
+            corpo, status = veredito
+            return Response(corpo, status=status, mimetype='application/json', headers={'Idempotent-Replayed': 'true'})
+
+    # Antes de qualquer trabalho: um cliente inundando /lance gasta só o próprio balde
+    espera = baldes_usuario.consumir(id_usuario or request.remote_addr)
+    if espera:
+        return recusar("Muitos lances deste usuário, aguarde", 429, espera)
+    espera = baldes_leilao.consumir(id_leilao)
+    if espera:
+        return recusar("Muitos lances neste leilão, tente novamente", 429, espera)
     
     if id_usuario and id_leilao:
         with clientes_lock:
             # Se o usuário está conectado ao SSE, adicionamos o interesse
             if id_usuario in clientes_sse:
-                clientes_sse[id_usuario]['interesses'].add(id_leilao)
+                seguir_leilao(clientes_sse[id_usuario], id_leilao)
                 print(f"[Auto-Follow] Usuário {id_usuario} inscrito automaticamente no leilão {id_leilao}")
 
+    resposta, status = executar(dados, chave)
+    if chave_cache and status < 500: # 5xx: nada foi decidido, o retry deve tentar de novo
+        idempotencia.guardar(chave_cache, (resposta.get_data(), status))
+    return resposta, status
+
+def repassar_lance(dados, chave, caminho='/lance'):
+    """Modo síncrono: repassa à réplica do MS Lance dona do leilão, com a mesma chave."""
+    if not em_voo_ms_lance.entrar():
+        # MS Lance saturado: recusar já é melhor que esperar na fila atrás dos outros
+        return recusar("MS Lance sobrecarregado, tente novamente", 503, 1)
     try:
-        response = requests.post(f"{MS_LANCE_URL}/lance", json=dados)
+        headers = {'Idempotency-Key': chave} if chave else None
+        response = cliente_do_leilao(dados.get('id_leilao')).post(caminho, json=dados, headers=headers)
+        if response.status_code == 409:
+            # A réplica não é mais dona do leilão: o anel mudou e este Gateway ainda não sabe
+            return jsonify({"erro": "Rebalanceamento do MS Lance em andamento, tente novamente"}), 503
+        if response.status_code == 400 and REJEICOES_MODO == 'agregado':
+            # Sem lance.invalidado no broker: o SSE do próprio usuário é avisado daqui
+            # Só os campos que o MS Lance põe no lance.invalidado (nunca o valor_maximo)
+            evento = {campo: dados[campo] for campo in ('id_leilao', 'id_usuario', 'id_lance') if campo in dados}
+            despachar_evento_sse('lance_invalido', dict(evento, erro=response.json().get('erro')))
         return jsonify(response.json()), response.status_code
     except requests.exceptions.RequestException as e:
         if e.response is not None:
             return jsonify(e.response.json()), e.response.status_code
         return jsonify({"erro": f"Erro MS Lance: {e}"}), 503
+    finally:
+        em_voo_ms_lance.sair()
+
+def enfileirar_lance(dados, chave):
+    """
+    Modo fila: assina o lance e o publica como comando para o MS Lance, sem esperar a decisão.
+    O veredito chega ao usuário pelo SSE (novo_lance / lance_invalido) com o mesmo id_lance.
+    """
+    if not dados.get('id_usuario') or dados.get('id_leilao') is None or not isinstance(dados.get('valor'), (int, float)):
+        return jsonify({"erro": "Campos obrigatórios: id_leilao, id_usuario, valor"}), 400
+    # bool é int e NaN/inf passam no isinstance: recusados aqui, como o MS Lance faria
+    if isinstance(dados['valor'], bool) or not math.isfinite(dados['valor']) or dados['valor'] <= 0:
+        return jsonify({"erro": "Valor do lance deve ser um número positivo"}), 400
+    lance = {
+        "id_lance": chave or uuid.uuid4().hex, # O MS Lance deduplica reentregas por id_lance
+        "id_leilao": dados['id_leilao'],
+        "id_usuario": dados['id_usuario'],
+        "valor": dados['valor'],
+        "gateway": GATEWAY_ID, # Com REJEICOES_MODO=agregado, a rejeição volta só para esta instância
+    }
+    comando = {"lance": lance, "assinatura": assinar(lance, LANCE_SEGREDO)}
+    if not publicador_comandos.publicar(rota_particionada(ROUTING_KEY_COMANDO_LANCE, lance['id_leilao']), comando):
+        return jsonify({"erro": "Fila de lances cheia, tente novamente"}), 503
+    return jsonify({"status": "Lance recebido", "id_lance": lance['id_lance']}), 202
 
 @app.route('/notificacoes/registrar', methods=['POST'])
 def registrar_interesse():
@@ -77,18 +582,38 @@ def registrar_interesse():
     if not id_usuario or id_leilao is None:
         return jsonify({"erro": "Dados incompletos"}), 400
     with clientes_lock:
-        if id_usuario not in clientes_sse:
+        cliente = clientes_sse.get(id_usuario)
+        if cliente is None:
             return jsonify({"erro": "Usuário não conectado ao SSE"}), 400
-        clientes_sse[id_usuario]['interesses'].add(id_leilao)
+        seguir_leilao(cliente, id_leilao)
+        # Snapshot imediato do preço: o cliente não precisa recarregar a listagem.
+        # Entregue sob o lock para não passar na frente de um novo_lance mais recente.
+        estado = estado_leiloes.get(id_leilao)
+        if estado is not None:
+            enviar_estado_leilao(cliente, estado)
+
+    if estado is None:
+        # Fora do lock (chamada HTTP). O valor_atual do MS Leilão pode estar até
+        # INTERVALO_PRECOS atrasado; entregar() descarta o snapshot se o cliente
+        # já recebeu um preço com seq_leilao maior
+        estado = buscar_estado_leilao(id_leilao)
+        if estado is not None:
+            enviar_estado_leilao(cliente, estado)
     return jsonify({"status": "ok"}), 200
 
+def enviar_estado_leilao(cliente, estado):
+    # Coalesce como novo_lance: substitui um lance pendente do mesmo leilão só
+    # se não for mais antigo que ele (seq_leilao)
+    cliente.entregar(f"event: estado_leilao\ndata: {json.dumps(estado)}\n\n", 'novo_lance', estado['id_leilao'],
+                     estado.get('seq_leilao', 0), snapshot=True)
+
 @app.route('/notificacoes/cancelar', methods=['POST'])
 def cancelar_interesse():
     dados = request.json
     with clientes_lock:
         uid = dados.get('id_usuario')
         if uid in clientes_sse:
-            clientes_sse[uid]['interesses'].discard(dados.get('id_leilao'))
+            deixar_de_seguir_leilao(clientes_sse[uid], dados.get('id_leilao'))
     return jsonify({"status": "ok"}), 200
 
 @app.route('/eventos')
@@ -96,29 +621,124 @@ def sse_stream():
     id_usuario = request.args.get('id_usuario')
     if not id_usuario: return jsonify({"erro": "Faltou id_usuario"}), 400
 
-    def event_generator(user_id):
-        q = queue.Queue()
-        with clientes_lock:
-            clientes_sse[user_id] = {'queue': q, 'interesses': set()}
-            print(f"[SSE] Cliente {user_id} conectado.")
-        
-        yield f"event: ping\ndata: {json.dumps({'msg': 'conexao_iniciada'})}\n\n"
+    # Last-Event-ID é enviado pelo EventSource ao reconectar; last_event_id cobre reconexões manuais
+    ultimo_id = ler_ultimo_id(request.headers.get('Last-Event-ID') or request.args.get('last_event_id'))
 
+    def event_generator(cliente):
+        conectar_cliente(cliente, ultimo_id)
         try:
+            yield MSG_CONEXAO
             while True:
-                msg = q.get()
+                msg = cliente.proxima(timeout=SSE_KEEPALIVE)
+                if msg is None: break # Desconectado por lentidão
                 yield msg
-        except GeneratorExit:
-            with clientes_lock:
-                if user_id in clientes_sse: del clientes_sse[user_id]
-            print(f"[SSE] Cliente {user_id} desconectou.")
+        finally:
+            desconectar_cliente(cliente)
+
+    return Response(event_generator(ClienteSSE(id_usuario)), mimetype='text/event-stream')
+
+@app.route('/metricas/sse', methods=['GET'])
+def metricas_sse():
+    with clientes_lock:
+        clientes = list(clientes_sse.values())
+    por_cliente = {c.id_usuario: c.estatisticas() for c in clientes}
+    totais = {k: sum(e[k] for e in por_cliente.values()) for k in ('pendentes', 'entregues', 'coalescidas', 'descartadas')}
+    return jsonify({"conectados": len(clientes), "totais": totais, "clientes": por_cliente}), 200
 
-    return Response(event_generator(id_usuario), mimetype='text/event-stream')
+@app.route('/metricas/http', methods=['GET'])
+def metricas_http():
+    clientes = [ms_leilao, *roteamento_lance[1].values()]
+    return jsonify({c.nome: c.estatisticas() for c in clientes}), 200
+
+@app.route('/particoes/ms-lance', methods=['GET', 'PUT'])
+def particoes_ms_lance():
+    """
+    GET: dono de cada partição. PUT {"replicas": {id: url}}: rebalanceia. Cada
+    réplica do novo conjunto busca o estado das partições que ganhou com o dono
+    anterior; só então o Gateway passa a rotear pelo novo anel.
+    O PUT precisa vir assinado com PARTICOES_SEGREDO (X-Assinatura, ver
+    comum/assinatura.py) e só aceita réplicas de MS_LANCE_PERMITIDAS: mudar o
+    anel decide para onde vão os lances e o estado dos leilões.
+    """
+    global roteamento_lance
+    if request.method == 'GET':
+        anel, clientes = roteamento_lance
+        return jsonify({
+            "replicas": {id_replica: c.base_url for id_replica, c in clientes.items()},
+            "particoes": {id_replica: sorted(anel.particoes_de(id_replica)) for id_replica in clientes},
+        }), 200
+
+    dados = request.get_json(silent=True)
+    if not verificar_pedido(dados, request.headers.get(CABECALHO_ASSINATURA), PARTICOES_SEGREDO):
+        return jsonify({"erro": "Assinatura inválida ou expirada"}), 401
+    novas = dados.get('replicas')
+    if not novas or not isinstance(novas, dict):
+        return jsonify({"erro": "Informe replicas: {id: url}"}), 400
+    desconhecidas = sorted(id_replica for id_replica, url in novas.items() if MS_LANCE_PERMITIDAS.get(id_replica) != url)
+    if desconhecidas:
+        return jsonify({"erro": f"Réplicas fora de MS_LANCE_PERMITIDAS: {desconhecidas}"}), 403
+    with rebalanceamento_lock:
+        novo_roteamento = montar_roteamento_lance(novas)
+        resultados, falhas = {}, 0
+        for id_replica, cliente in novo_roteamento[1].items():
+            try:
+                corpo, headers = assinar_pedido({"replicas": novas}, PARTICOES_SEGREDO)
+                resposta = cliente.post('/particoes/rebalancear', json=corpo, headers=headers, timeout=(1, 60))
+                resultados[id_replica] = resposta.json()
+                falhas += resposta.status_code != 200
+            except requests.exceptions.RequestException as e:
+                resultados[id_replica] = {"erro": str(e)}
+                falhas += 1
+        roteamento_lance = novo_roteamento
+    print(f"[Gateway] MS Lance rebalanceado entre {list(novas)} ({falhas} falha(s)).")
+    return jsonify(resultados), 502 if falhas else 200
+
+@app.route('/metricas/rejeicoes', methods=['GET'])
+def metricas_rejeicoes():
+    """Leilões com mais lances rejeitados (somatório dos lance.rejeicoes recebidos). Query: limit."""
+    try:
+        limite = min(max(int(request.args.get('limit', 20)), 1), REJEICOES_LIMITE_MAXIMO)
+    except ValueError:
+        return jsonify({"erro": "limit inválido"}), 400
+    with rejeicoes_lock:
+        leiloes = sorted(rejeicoes_por_leilao.items(), key=lambda item: item[1][0], reverse=True)
+    return jsonify({
+        "modo": REJEICOES_MODO,
+        "total": sum(quantidade for _, (quantidade, _) in leiloes),
+        "leiloes": [{"id_leilao": id_leilao, "rejeicoes": quantidade, "ultimo_erro": erro}
+                    for id_leilao, (quantidade, erro) in leiloes[:limite]],
+    }), 200
+
+@app.route('/metricas/admissao', methods=['GET'])
+def metricas_admissao():
+    """Lances admitidos e recusados (carga descartada) por limite."""
+    return jsonify({
+        "por_usuario": baldes_usuario.estatisticas(),
+        "por_leilao": baldes_leilao.estatisticas(),
+        "ms_lance_em_voo": em_voo_ms_lance.estatisticas(),
+    }), 200
+
+@app.route('/metricas/idempotencia', methods=['GET'])
+def metricas_idempotencia():
+    return jsonify(idempotencia.estatisticas()), 200
+
+@app.route('/metricas/consumo', methods=['GET'])
+def metricas_consumo():
+    if GATEWAY_MODO == 'async':
+        return jsonify({"fila": FILA_EVENTOS, "modo": "async"}), 200
+    return jsonify(consumidor.estatisticas()), 200
+
+@app.route('/metricas/publicador', methods=['GET'])
+def metricas_publicador():
+    if not publicador_comandos:
+        return jsonify({"erro": "LANCE_MODO=sincrono: o Gateway não publica comandos"}), 404
+    return jsonify(publicador_comandos.estatisticas()), 200
 
 # --- Consumidor RabbitMQ ---
 
 def despachar_evento_sse(evento_tipo, dados):
-    msg = f"event: {evento_tipo}\ndata: {json.dumps(dados)}\n\n"
+    global ultimo_id_evento
+    corpo = json.dumps(dados)
     id_leilao = dados.get('id_leilao')
     destinatario = None
     
@@ -126,59 +746,189 @@ def despachar_evento_sse(evento_tipo, dados):
     elif evento_tipo in ['link_pagamento', 'status_pagamento']: 
         destinatario = dados.get('id_vencedor') or dados.get('id_comprador')
 
+    # Sob o lock: numera o evento, guarda no histórico e copia os destinatários.
+    # A entrega acontece fora dele.
     with clientes_lock:
-        if destinatario and destinatario in clientes_sse:
-            clientes_sse[destinatario]['queue'].put_nowait(msg)
+        ultimo_id_evento += 1
+        msg = f"id: {ultimo_id_evento}\nevent: {evento_tipo}\ndata: {corpo}\n\n"
+        item = (ultimo_id_evento, msg, evento_tipo, id_leilao)
+        atualizar_estado_leilao(evento_tipo, dados)
+        if evento_tipo in EVENTOS_BROADCAST:
+            historico_global.append(item)
+            destinatarios = list(clientes_sse.values())
+        elif destinatario:
+            registrar_historico(destinatario, historico_por_usuario, SSE_REPLAY_POR_USUARIO, item)
+            cliente = clientes_sse.get(destinatario)
+            destinatarios = [cliente] if cliente else []
         elif evento_tipo in ['novo_lance', 'vencedor_leilao'] and id_leilao is not None:
-            for uid, info in clientes_sse.items():
-                if id_leilao in info['interesses']:
-                    info['queue'].put_nowait(msg)
+            registrar_historico(id_leilao, historico_por_leilao, SSE_REPLAY_POR_LEILAO, item)
+            destinatarios = list(inscritos_por_leilao.get(id_leilao, ()))
+        else:
+            destinatarios = []
+
+    seq = dados.get('seq_leilao') if evento_tipo == 'novo_lance' else None
+    for cliente in destinatarios:
+        cliente.entregar(msg, evento_tipo, id_leilao, seq)
 
-def callback_rabbitmq(ch, method, properties, body):
-    routing_key = method.routing_key
-    dados = json.loads(body.decode())
+def atualizar_estado_leilao(evento_tipo, dados):
+    # Chamado sob clientes_lock
+    id_leilao = dados.get('id_leilao')
+    if evento_tipo == 'leilao_iniciado':
+        estado_leiloes[id_leilao] = {"id_leilao": id_leilao, "valor": dados.get('valor_atual', dados.get('valor_inicial')),
+                                     "seq_leilao": 0}
+    elif evento_tipo == 'novo_lance' and id_leilao in estado_leiloes:
+        estado = estado_leiloes[id_leilao]
+        seq = dados.get('seq_leilao', 0)
+        if seq >= estado['seq_leilao']:
+            estado['valor'], estado['seq_leilao'] = dados.get('valor'), seq
+    elif evento_tipo == 'leilao_finalizado':
+        estado_leiloes.pop(id_leilao, None)
+
+def buscar_estado_leilao(id_leilao):
+    """Fallback para leilões que começaram antes de o Gateway subir."""
+    try:
+        response = ms_leilao.get(f"/leiloes/{id_leilao}")
+        if response.status_code != 200: return None
+        leilao = response.json()
+        if leilao.get('status') != 'ativo': return None
+        return {"id_leilao": id_leilao, "valor": leilao.get('valor_atual'), "seq_leilao": leilao.get('seq_leilao', 0)}
+    except requests.exceptions.RequestException:
+        return None
+
+MAPA_EVENTOS_SSE = {
+    'leilao.iniciado': 'leilao_iniciado',
+    'leilao.finalizado': 'leilao_finalizado',
+    'lance.validado': 'novo_lance',
+    'lance.invalidado': 'lance_invalido',
+    'leilao.vencedor': 'vencedor_leilao',
+    'link_pagamento': 'link_pagamento',
+    'status_pagamento': 'status_pagamento'
+}
+
+def acumular_rejeicoes(dados):
+    with rejeicoes_lock:
+        for id_leilao, quantidade, erro in dados.get('leiloes', []):
+            contagem = rejeicoes_por_leilao.setdefault(id_leilao, [0, None])
+            contagem[0] += quantidade
+            contagem[1] = erro
+
+def processar_evento(routing_key, dados):
+    """Comum aos dois modos: traduz o evento do RabbitMQ e despacha via SSE."""
     print(f"[Gateway SUB] Evento recebido: {routing_key}")
-    
-    mapa = {
-        'lance.validado': 'novo_lance',
-        'lance.invalidado': 'lance_invalido',
-        'leilao.vencedor': 'vencedor_leilao',
-        'link_pagamento': 'link_pagamento',
-        'status_pagamento': 'status_pagamento'
-    }
-    
-    if routing_key == 'lance.validado':
-        try:
-            id_leilao = dados.get('id_leilao')
-            novo_valor = dados.get('valor')
-            requests.patch(f"{MS_LEILAO_URL}/leiloes/{id_leilao}", json={"valor": novo_valor})
-            print(f"[Gateway] Atualizou MS Leilão {id_leilao} com valor {novo_valor}")
-        except Exception as e:
-            print(f"[Gateway] Falha ao atualizar MS Leilão: {e}")
-
-    if routing_key in mapa:
-        despachar_evento_sse(mapa[routing_key], dados)
-        
-    ch.basic_ack(delivery_tag=method.delivery_tag)
-
-def iniciar_consumidor():
-    while True:
-        try:
-            creds = pika.PlainCredentials(RABBITMQ_USER, RABBITMQ_PASS)
-            conn = pika.BlockingConnection(pika.ConnectionParameters(host=RABBITMQ_HOST, credentials=creds))
-            ch = conn.channel()
-            ch.exchange_declare(exchange=EXCHANGE_NAME, exchange_type='topic')
-            q = ch.queue_declare(queue='', exclusive=True).method.queue
-            for k in BINDING_KEYS: ch.queue_bind(exchange=EXCHANGE_NAME, queue=q, routing_key=k)
-            
-            print("[Gateway] Conectado ao RabbitMQ.")
-            ch.basic_consume(queue=q, on_message_callback=callback_rabbitmq)
-            ch.start_consuming()
-        except Exception as e:
-            print(f"[Gateway] Erro RabbitMQ: {e}. Reconectando em 5s...")
-            time.sleep(5)
+    if routing_key == ROTA_REJEICOES_LOCAIS:
+        routing_key = 'lance.invalidado' # Endereçado a esta instância; entregue só ao usuário
+    elif routing_key == 'lance.rejeicoes':
+        return acumular_rejeicoes(dados) # Agregado: não vai para o SSE
+    routing_key = rota_base(routing_key) # leilao.iniciado.p<k> -> leilao.iniciado
+    if routing_key == 'leilao.finalizado':
+        with rejeicoes_lock:
+            rejeicoes_por_leilao.pop(dados.get('id_leilao'), None)
+    if routing_key in MAPA_EVENTOS_SSE:
+        despachar_evento_sse(MAPA_EVENTOS_SSE[routing_key], dados)
+
+# Cada Gateway precisa de TODOS os eventos (os seus clientes SSE podem seguir qualquer leilão):
+# fila durável própria por instância, não compartilhada
+consumidor = ConsumidorEventos(RABBITMQ_HOST, RABBITMQ_USER, RABBITMQ_PASS, EXCHANGE_NAME,
+                               FILA_EVENTOS, BINDING_KEYS, processar_evento, nome='gateway',
+                               prefetch=CONSUMO_PREFETCH, tamanho_lote=LOTE_ACK, argumentos_fila=ARGUMENTOS_FILA)
+
+# --- Modo Assíncrono (GATEWAY_MODO=async) ---
+
+def iniciar_modo_async():
+    """
+    Sobe o Gateway em ASGI (uvicorn). Cada cliente SSE vira uma corrotina com
+    sua asyncio.Queue e o consumidor RabbitMQ roda com aio-pika no mesmo
+    event loop, então milhares de conexões ociosas não custam uma thread cada.
+    As rotas REST continuam sendo as do Flask, montadas via WSGI.
+    Requer: uvicorn, starlette, a2wsgi, aio-pika.
+    """
+    import uvicorn
+    import aio_pika
+    from a2wsgi import WSGIMiddleware
+    from starlette.applications import Starlette
+    from starlette.responses import JSONResponse, StreamingResponse
+    from starlette.routing import Mount, Route
+
+    cabecalhos_cors = {'Access-Control-Allow-Origin': '*'}
+
+    async def sse_stream_async(request):
+        id_usuario = request.query_params.get('id_usuario')
+        if not id_usuario:
+            return JSONResponse({"erro": "Faltou id_usuario"}, status_code=400, headers=cabecalhos_cors)
+        cliente = ClienteSSEAsync(id_usuario, asyncio.get_running_loop())
+        ultimo_id = ler_ultimo_id(request.headers.get('last-event-id') or request.query_params.get('last_event_id'))
+
+        async def event_generator():
+            conectar_cliente(cliente, ultimo_id)
+            try:
+                yield MSG_CONEXAO
+                while True:
+                    msg = await cliente.proxima(timeout=SSE_KEEPALIVE)
+                    if msg is None: break # Desconectado por lentidão
+                    yield msg
+            finally:
+                desconectar_cliente(cliente)
+
+        return StreamingResponse(event_generator(), media_type='text/event-stream',
+                                 headers={**cabecalhos_cors, 'Cache-Control': 'no-cache'})
+
+    async def consumir_rabbitmq():
+        while True:
+            try:
+                conn = await aio_pika.connect(host=RABBITMQ_HOST, login=RABBITMQ_USER, password=RABBITMQ_PASS)
+                async with conn:
+                    ch = await conn.channel()
+                    await ch.set_qos(prefetch_count=CONSUMO_PREFETCH)
+                    exchange = await ch.declare_exchange(EXCHANGE_NAME, aio_pika.ExchangeType.TOPIC)
+                    fila = await ch.declare_queue(FILA_EVENTOS, durable=True, arguments=ARGUMENTOS_FILA)
+                    for k in BINDING_KEYS: await fila.bind(exchange, routing_key=k)
+
+                    # Ack em lote: a última mensagem processada confirma todas as anteriores (multiple=True)
+                    pendente = {"ultima": None, "n": 0}
+
+                    async def confirmar():
+                        ultima, pendente['ultima'], pendente['n'] = pendente['ultima'], None, 0
+                        if ultima is not None:
+                            await ultima.ack(multiple=True)
+
+                    async def ao_receber(mensagem):
+                        try:
+                            processar_evento(mensagem.routing_key, json.loads(mensagem.body.decode()))
+                        except Exception as e:
+                            print(f"[Gateway] Erro ao processar '{mensagem.routing_key}': {e}")
+                        pendente['ultima'] = mensagem
+                        pendente['n'] += 1
+                        if pendente['n'] >= LOTE_ACK:
+                            await confirmar()
+
+                    print("[Gateway] Conectado ao RabbitMQ (aio-pika).")
+                    await fila.consume(ao_receber)
+                    while not ch.is_closed:
+                        await asyncio.sleep(INTERVALO_ACK)
+                        await confirmar()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"[Gateway] Erro RabbitMQ: {e}. Reconectando em 5s...")
+                await asyncio.sleep(5)
+
+    @contextlib.asynccontextmanager
+    async def ciclo_de_vida(_app):
+        tarefa = asyncio.create_task(consumir_rabbitmq())
+        yield
+        tarefa.cancel()
+
+    app_async = Starlette(
+        routes=[Route('/eventos', sse_stream_async), Mount('/', app=WSGIMiddleware(app))],
+        lifespan=ciclo_de_vida,
+    )
+    print("[*] API Gateway (modo async) rodando na porta 5000 (com CORS)...")
+    uvicorn.run(app_async, host='127.0.0.1', port=5000, log_level='warning', backlog=4096)
 
 if __name__ == '__main__':
-    threading.Thread(target=iniciar_consumidor, daemon=True).start()
-    print("[*] API Gateway rodando na porta 5000 (com CORS)...")
-    app.run(port=5000, debug=True, use_reloader=False)
\ No newline at end of file
+    if GATEWAY_MODO == 'async':
+        iniciar_modo_async()
+    else:
+        consumidor.iniciar()
+        print("[*] API Gateway rodando na porta 5000 (com CORS)...")
+        app.run(port=5000, debug=True, use_reloader=False)
\ No newline at end of file
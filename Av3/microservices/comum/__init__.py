@@ -0,0 +1,2 @@
+# /microservices/comum/__init__.py
+# Código compartilhado pelos microsserviços (importado via sys.path a partir de cada serviço)
@@ -0,0 +1,38 @@
+# /microservices/comum/assinatura.py
+
+import hmac
+import json
+import time
+import hashlib
+
+CABECALHO_ASSINATURA = 'X-Assinatura'
+VALIDADE_PEDIDO = 60 # Segundos em que um pedido assinado é aceito
+
+def _canonico(dados: dict) -> bytes:
+    return json.dumps(dados, sort_keys=True, separators=(',', ':')).encode()
+
+def assinar(dados: dict, segredo: bytes) -> str:
+    """HMAC-SHA256 (hex) do JSON canônico de `dados`."""
+    return hmac.new(segredo, _canonico(dados), hashlib.sha256).hexdigest()
+
+def verificar(dados: dict, assinatura: str, segredo: bytes) -> bool:
+    """Confere a assinatura em tempo constante."""
+    return isinstance(assinatura, str) and hmac.compare_digest(assinar(dados, segredo), assinatura)
+
+def assinar_pedido(dados: dict, segredo: bytes):
+    """
+    Corpo e cabeçalhos de uma chamada de controle entre serviços (rebalanceamento,
+    exportação de partições). O instante de emissão entra na assinatura e limita
+    a reutilização de um pedido capturado a VALIDADE_PEDIDO segundos.
+    """
+    corpo = dict(dados, emitido_em=time.time())
+    return corpo, {CABECALHO_ASSINATURA: assinar(corpo, segredo)}
+
+def verificar_pedido(corpo, assinatura: str, segredo: bytes) -> bool:
+    """Assinatura válida e emitida há no máximo VALIDADE_PEDIDO segundos."""
+    if not isinstance(corpo, dict):
+        return False
+    emitido_em = corpo.get('emitido_em')
+    if not isinstance(emitido_em, (int, float)) or abs(time.time() - emitido_em) > VALIDADE_PEDIDO:
+        return False
+    return verificar(corpo, assinatura, segredo)
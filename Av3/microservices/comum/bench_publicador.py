@@ -0,0 +1,94 @@
+# /microservices/comum/bench_publicador.py
+#
+# Benchmark de vazão de publicação no RabbitMQ (eventos/s), para comparar:
+#   conexao     - uma conexão por evento (como os serviços publicavam antes)
+#   transacao   - canal fixo, lote dentro de uma transação AMQP (tx_commit por lote)
+#   sem_confirm - PublicadorEventos sem confirmação do broker
+#   confirmado  - PublicadorEventos com publisher confirms em lote
+# Publica numa exchange própria, sem filas ligadas: mede só o caminho do publisher.
+#
+#   python comum/bench_publicador.py --eventos 20000
+
+import os
+import sys
+import json
+import time
+import argparse
+
+import pika
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from comum.publicador import PublicadorEventos
+
+EXCHANGE = 'bench_publicador_exchange'
+ROUTING_KEY = 'bench.evento'
+
+def corpo(i):
+    return json.dumps({"id_leilao": i % 64, "id_usuario": f"bench_{i}", "valor": float(i)}).encode()
+
+def credenciais(args):
+    return pika.ConnectionParameters(host=args.host, credentials=pika.PlainCredentials(args.usuario, args.senha))
+
+def bench_conexao(args):
+    for i in range(args.eventos):
+        connection = pika.BlockingConnection(credenciais(args))
+        channel = connection.channel()
+        channel.exchange_declare(exchange=EXCHANGE, exchange_type='topic')
+        channel.basic_publish(exchange=EXCHANGE, routing_key=ROUTING_KEY, body=corpo(i),
+                              properties=pika.BasicProperties(delivery_mode=2))
+        connection.close()
+
+def bench_transacao(args):
+    connection = pika.BlockingConnection(credenciais(args))
+    channel = connection.channel()
+    channel.exchange_declare(exchange=EXCHANGE, exchange_type='topic')
+    channel.tx_select()
+    propriedades = pika.BasicProperties(delivery_mode=2)
+    for i in range(args.eventos):
+        channel.basic_publish(exchange=EXCHANGE, routing_key=ROUTING_KEY, body=corpo(i), properties=propriedades)
+        if (i + 1) % args.lote == 0:
+            channel.tx_commit()
+    channel.tx_commit()
+    connection.close()
+
+def bench_publicador(args, confirmar):
+    publicador = PublicadorEventos(args.host, args.usuario, args.senha, EXCHANGE, nome='bench',
+                                   confirmar=confirmar, tamanho_lote=args.lote, capacidade=args.eventos)
+    while not publicador.estatisticas()["conectado"]:
+        time.sleep(0.05)
+    inicio = time.perf_counter()
+    for i in range(args.eventos):
+        publicador.publicar(ROUTING_KEY, None, corpo=corpo(i))
+    while publicador.estatisticas()["publicados"] < args.eventos:
+        time.sleep(0.005)
+    return time.perf_counter() - inicio, publicador.estatisticas()
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de eventos/s do publisher AMQP")
+    parser.add_argument('--host', default=os.getenv('RABBITMQ_HOST', 'localhost'))
+    parser.add_argument('--usuario', default=os.getenv('RABBITMQ_USER', 'guest'))
+    parser.add_argument('--senha', default=os.getenv('RABBITMQ_PASS', 'guest'))
+    parser.add_argument('--eventos', type=int, default=20000)
+    parser.add_argument('--lote', type=int, default=200)
+    parser.add_argument('--modos', default='conexao,transacao,sem_confirm,confirmado')
+    args = parser.parse_args()
+
+    for modo in args.modos.split(','):
+        stats = None
+        if modo in ('sem_confirm', 'confirmado'):
+            decorrido, stats = bench_publicador(args, confirmar=(modo == 'confirmado'))
+        else:
+            eventos = args.eventos
+            if modo == 'conexao':
+                # Uma conexão por evento é ordens de grandeza mais lenta; limita a amostra
+                args.eventos = min(eventos, 1000)
+            inicio = time.perf_counter()
+            {'conexao': bench_conexao, 'transacao': bench_transacao}[modo](args)
+            decorrido = time.perf_counter() - inicio
+            eventos, args.eventos = args.eventos, eventos
+        print(f"[bench] {modo:<12} {eventos} eventos em {decorrido:.2f}s -> {eventos / decorrido:.0f} eventos/s")
+        if stats and "latencia_ms" in stats:
+            print(f"[bench] {'':<12} latência enfileirar->publicado {stats['latencia_ms']}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+# /microservices/comum/consumidor.py
+
+import json
+import time
+import threading
+
+import pika
+
+class ReprocessarDepois(Exception):
+    """Falha passageira em `processar` (dependência fora do ar): a mensagem volta para a fila."""
+
+class ConsumidorEventos:
+    """
+    Consumidor AMQP compartilhado pelos microsserviços.
+    Consome uma fila NOMEADA e durável (sobrevive a reinícios do serviço: o
+    que chegar enquanto ele estiver fora fica guardado no broker), com
+    basic_qos(prefetch) e ack em lote: as mensagens são processadas em ordem
+    e confirmadas com um único basic_ack(multiple=True) quando o lote enche
+    ou a fila fica ociosa.
+
+    Instâncias que usam o mesmo nome de fila competem pelas mensagens (cada
+    uma recebe uma parte); instâncias que precisam de TODOS os eventos devem
+    usar nomes de fila diferentes.
+
+    As bindings podem mudar com o serviço rodando (atualizar_bindings); a
+    mudança é aplicada pela própria thread de consumo, dona do canal. Como a
+    fila durável guarda bindings de execuções anteriores, a cada conexão as
+    chaves de `universo_bindings` que não estão em uso são desligadas.
+
+    `processar(routing_key, dados)` é chamado na thread do consumidor. Se
+    lançar exceção, o erro é registrado e a mensagem é confirmada mesmo
+    assim, para não ser reentregue para sempre. A exceção é
+    ReprocessarDepois: a mensagem e as seguintes do lote voltam para a fila
+    (basic_nack com requeue) e o consumidor espera antes de continuar,
+    de `espera_reprocessar` segundos dobrando até `espera_maxima_reprocessar`
+    enquanto a falha se repetir.
+    """
+
+    def __init__(self, host, usuario, senha, exchange, fila, binding_keys, processar, nome='consumidor',
+                 prefetch=100, tamanho_lote=50, intervalo_lote=0.05, argumentos_fila=None,
+                 universo_bindings=(), espera_reprocessar=1.0, espera_maxima_reprocessar=30.0):
+        self._parametros = pika.ConnectionParameters(
+            host=host, credentials=pika.PlainCredentials(usuario, senha), heartbeat=30)
+        self._exchange = exchange
+        self.fila = fila
+        self._binding_keys = list(binding_keys)
+        self._processar = processar
+        self._nome = nome
+        self._prefetch = prefetch
+        self._tamanho_lote = min(tamanho_lote, prefetch) # Mais que o prefetch nunca chega sem ack
+        self._intervalo_lote = intervalo_lote
+        self._argumentos_fila = argumentos_fila
+        self._universo_bindings = list(universo_bindings)
+        self._espera_reprocessar = espera_reprocessar
+        self._espera_maxima_reprocessar = espera_maxima_reprocessar
+        self._espera_atual = espera_reprocessar
+
+        self._stats_lock = threading.Lock()
+        self._recebidas = 0
+        self._erros = 0
+        self._reprocessadas = 0
+        self._lotes = 0
+        self._reconexoes = 0
+        self._bindings_lock = threading.Lock()
+        self._mudancas = [] # (adicionar, remover, threading.Event) ainda não aplicadas no canal
+        self._thread = threading.Thread(target=self._executar, daemon=True, name=f"{nome}-consumo")
+
+    # --- API pública ---
+    def iniciar(self):
+        self._thread.start()
+        return self
+
+    def atualizar_bindings(self, adicionar=(), remover=()):
+        """
+        Liga/desliga routing keys da fila. Retorna um threading.Event que é
+        marcado quando o broker confirmou a mudança.
+        """
+        aplicado = threading.Event()
+        with self._bindings_lock:
+            self._binding_keys = [k for k in self._binding_keys if k not in set(remover)]
+            self._binding_keys += [k for k in adicionar if k not in self._binding_keys]
+            self._mudancas.append((list(adicionar), list(remover), aplicado))
+        return aplicado
+
+    def estatisticas(self):
+        with self._stats_lock:
+            return {
+                "fila": self.fila,
+                "recebidas": self._recebidas,
+                "erros": self._erros,
+                "reprocessadas": self._reprocessadas,
+                "lotes_confirmados": self._lotes,
+                "reconexoes": self._reconexoes,
+                "prefetch": self._prefetch,
+            }
+
+    # --- Thread de consumo ---
+    def _processar_lote(self, channel, lote):
+        erros = 0
+        feitas = len(lote)
+        for i, (method, body) in enumerate(lote):
+            try:
+                self._processar(method.routing_key, json.loads(body.decode()))
+            except ReprocessarDepois as e:
+                print(f"  [!] [{self._nome}] '{method.routing_key}' volta para a fila: {e}. "
+                      f"Nova tentativa em {self._espera_atual}s...")
+                feitas = i
+                break
+            except Exception as e:
+                erros += 1
+                print(f"  [!] [{self._nome}] Erro ao processar '{method.routing_key}': {e}")
+        # Confirma só o que foi processado; o resto do lote volta para a fila na ordem
+        if feitas:
+            channel.basic_ack(delivery_tag=lote[feitas - 1][0].delivery_tag, multiple=True)
+        if feitas < len(lote):
+            channel.basic_nack(delivery_tag=lote[-1][0].delivery_tag, multiple=True, requeue=True)
+        with self._stats_lock:
+            self._recebidas += feitas
+            self._erros += erros
+            self._reprocessadas += len(lote) - feitas
+            self._lotes += 1
+        if feitas < len(lote):
+            # Espera processando eventos da conexão (heartbeats em dia), sem martelar a dependência
+            channel.connection.sleep(self._espera_atual)
+            self._espera_atual = min(self._espera_atual * 2, self._espera_maxima_reprocessar)
+        else:
+            self._espera_atual = self._espera_reprocessar
+
+    def _aplicar_mudancas(self, channel):
+        with self._bindings_lock:
+            mudancas, self._mudancas = self._mudancas, []
+        for adicionar, remover, aplicado in mudancas:
+            for key in adicionar:
+                channel.queue_bind(exchange=self._exchange, queue=self.fila, routing_key=key)
+            for key in remover:
+                channel.queue_unbind(exchange=self._exchange, queue=self.fila, routing_key=key)
+            aplicado.set()
+
+    def _executar(self):
+        while True:
+            try:
+                connection = pika.BlockingConnection(self._parametros)
+                channel = connection.channel()
+                channel.exchange_declare(exchange=self._exchange, exchange_type='topic')
+                channel.queue_declare(queue=self.fila, durable=True, arguments=self._argumentos_fila)
+                with self._bindings_lock:
+                    binding_keys = list(self._binding_keys)
+                    pendentes, self._mudancas = self._mudancas, [] # Já refletidas em _binding_keys
+                for key in binding_keys:
+                    channel.queue_bind(exchange=self._exchange, queue=self.fila, routing_key=key)
+                for key in set(self._universo_bindings) - set(binding_keys):
+                    channel.queue_unbind(exchange=self._exchange, queue=self.fila, routing_key=key)
+                for _, _, aplicado in pendentes:
+                    aplicado.set()
+                channel.basic_qos(prefetch_count=self._prefetch)
+
+                print(f"[*] [{self._nome}] Consumindo '{self.fila}' ({len(binding_keys)} bindings, prefetch {self._prefetch}).")
+                lote = []
+                for method, _, body in channel.consume(self.fila, inactivity_timeout=self._intervalo_lote):
+                    if method is not None:
+                        lote.append((method, body))
+                    # Fecha o lote quando enche ou quando a fila fica ociosa
+                    if lote and (method is None or len(lote) >= self._tamanho_lote):
+                        self._processar_lote(channel, lote)
+                        lote = []
+                    if self._mudancas:
+                        self._aplicar_mudancas(channel)
+            except Exception as e:
+                print(f"[!] [{self._nome}] Erro no consumidor: {e}. Reconectando em 5s...")
+                with self._stats_lock:
+                    self._reconexoes += 1
+                time.sleep(5)
@@ -0,0 +1,123 @@
+# /microservices/comum/http_cliente.py
+
+import time
+import threading
+from collections import deque
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from comum.metricas import resumo_latencias
+
+class CircuitoAberto(requests.exceptions.ConnectionError):
+    """
+    O upstream falhou demais e o disjuntor está aberto: a chamada nem é feita.
+    Herda de RequestException, então os tratamentos existentes (503) continuam valendo.
+    """
+
+class ClienteHTTP:
+    """
+    Cliente HTTP de um upstream (ex.: MS Lance).
+    Usa uma requests.Session com pool de conexões keep-alive do tamanho pedido,
+    timeouts de conexão/leitura e um disjuntor (circuit breaker): depois de
+    `limite_falhas` falhas seguidas o upstream fica "aberto" por `tempo_aberto`
+    segundos e as chamadas falham na hora; passado esse tempo, uma chamada de
+    teste decide se o circuito fecha de novo.
+    """
+
+    FECHADO, ABERTO, MEIO_ABERTO = 'fechado', 'aberto', 'meio_aberto'
+
+    def __init__(self, nome, base_url, pool=20, timeout_conexao=1.0, timeout_leitura=5.0,
+                 limite_falhas=5, tempo_aberto=10.0, amostras_latencia=2048):
+        self.nome = nome
+        self.base_url = base_url.rstrip('/')
+        self._timeout = (timeout_conexao, timeout_leitura)
+        self._limite_falhas = limite_falhas
+        self._tempo_aberto = tempo_aberto
+
+        self._sessao = requests.Session()
+        adaptador = HTTPAdapter(pool_connections=1, pool_maxsize=pool, max_retries=0, pool_block=False)
+        self._sessao.mount('http://', adaptador)
+        self._sessao.mount('https://', adaptador)
+
+        self._lock = threading.Lock()
+        self._estado = self.FECHADO
+        self._falhas_seguidas = 0
+        self._aberto_ate = 0.0
+        self._teste_em_andamento = False
+        self._chamadas = 0
+        self._erros = 0
+        self._rejeitadas = 0 # Falharam rápido com o circuito aberto
+        self._latencias = deque(maxlen=amostras_latencia)
+
+    # --- API pública ---
+    def get(self, caminho, **kwargs):
+        return self.request('GET', caminho, **kwargs)
+
+    def post(self, caminho, **kwargs):
+        return self.request('POST', caminho, **kwargs)
+
+    def patch(self, caminho, **kwargs):
+        return self.request('PATCH', caminho, **kwargs)
+
+    def request(self, metodo, caminho, **kwargs):
+        """Faz a chamada ou lança CircuitoAberto. Respostas 5xx contam como falha do upstream."""
+        self._autorizar()
+        kwargs.setdefault('timeout', self._timeout)
+        t0 = time.perf_counter()
+        try:
+            resposta = self._sessao.request(metodo, f"{self.base_url}{caminho}", **kwargs)
+        except requests.exceptions.RequestException:
+            self._registrar(time.perf_counter() - t0, sucesso=False)
+            raise
+        self._registrar(time.perf_counter() - t0, sucesso=resposta.status_code < 500)
+        return resposta
+
+    def estatisticas(self):
+        with self._lock:
+            stats = {
+                "url": self.base_url,
+                "estado": self._estado,
+                "chamadas": self._chamadas,
+                "erros": self._erros,
+                "rejeitadas_circuito_aberto": self._rejeitadas,
+                "falhas_seguidas": self._falhas_seguidas,
+            }
+            latencias = list(self._latencias)
+        resumo = resumo_latencias(latencias)
+        if resumo:
+            stats["latencia_ms"] = resumo
+        return stats
+
+    # --- Disjuntor ---
+    def _autorizar(self):
+        with self._lock:
+            if self._estado == self.ABERTO and time.monotonic() >= self._aberto_ate:
+                self._estado = self.MEIO_ABERTO
+            if self._estado == self.MEIO_ABERTO:
+                if not self._teste_em_andamento:
+                    self._teste_em_andamento = True # Só esta chamada testa o upstream
+                    return
+            elif self._estado == self.FECHADO:
+                return
+            self._rejeitadas += 1
+        raise CircuitoAberto(f"{self.nome} indisponível (circuito aberto)")
+
+    def _registrar(self, duracao, sucesso):
+        with self._lock:
+            self._chamadas += 1
+            self._latencias.append(duracao)
+            self._teste_em_andamento = False
+            if sucesso:
+                self._falhas_seguidas = 0
+                if self._estado != self.FECHADO:
+                    print(f"[HTTP] Circuito de {self.nome} FECHADO (upstream respondeu).")
+                self._estado = self.FECHADO
+                return
+            self._erros += 1
+            self._falhas_seguidas += 1
+            if self._estado == self.MEIO_ABERTO or self._falhas_seguidas >= self._limite_falhas:
+                if self._estado != self.ABERTO:
+                    print(f"[HTTP] Circuito de {self.nome} ABERTO por {self._tempo_aberto}s após {self._falhas_seguidas} falhas.")
+                self._estado = self.ABERTO
+                self._aberto_ate = time.monotonic() + self._tempo_aberto
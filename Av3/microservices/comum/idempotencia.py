@@ -0,0 +1,50 @@
+# /microservices/comum/idempotencia.py
+
+import threading
+from collections import OrderedDict
+
+class CacheIdempotencia:
+    """
+    Veredito já dado para cada chave de idempotência (LRU com capacidade fixa:
+    a memória não cresce com o tráfego). Repetições da mesma chave recebem o
+    veredito guardado em vez de serem processadas de novo.
+    """
+
+    AUSENTE = object()
+
+    def __init__(self, capacidade=100000):
+        self._capacidade = capacidade
+        self._itens = OrderedDict()
+        self._lock = threading.Lock()
+        self._acertos = 0
+        self._falhas = 0
+        self._despejos = 0
+
+    def obter(self, chave):
+        """Veredito guardado ou CacheIdempotencia.AUSENTE."""
+        with self._lock:
+            valor = self._itens.get(chave, self.AUSENTE)
+            if valor is self.AUSENTE:
+                self._falhas += 1
+            else:
+                self._acertos += 1
+                self._itens.move_to_end(chave)
+            return valor
+
+    def guardar(self, chave, valor):
+        with self._lock:
+            self._itens[chave] = valor
+            self._itens.move_to_end(chave)
+            if len(self._itens) > self._capacidade:
+                self._itens.popitem(last=False)
+                self._despejos += 1
+
+    def estatisticas(self):
+        with self._lock:
+            return {
+                "acertos": self._acertos,
+                "falhas": self._falhas,
+                "despejos": self._despejos,
+                "tamanho": len(self._itens),
+                "capacidade": self._capacidade,
+            }
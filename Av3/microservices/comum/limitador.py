@@ -0,0 +1,84 @@
+# /microservices/comum/limitador.py
+
+import math
+import time
+import threading
+from collections import OrderedDict
+
+class BaldesTokens:
+    """
+    Token bucket por chave (usuário, leilão...): cada chave ganha `taxa` fichas
+    por segundo, acumulando até `rajada`, e cada requisição gasta uma. Sem
+    ficha, a requisição é recusada na hora com o tempo até a próxima.
+    Guarda no máximo `max_chaves` baldes (LRU); uma chave esquecida volta
+    com o balde cheio, o que só a favorece.
+    """
+
+    def __init__(self, taxa, rajada, max_chaves=100000):
+        self.taxa = taxa
+        self.rajada = rajada
+        self._max_chaves = max_chaves
+        self._baldes = OrderedDict() # chave -> (fichas, instante da última atualização)
+        self._lock = threading.Lock()
+        self._admitidos = 0
+        self._recusados = 0
+
+    def consumir(self, chave):
+        """0 se admitido; senão, segundos inteiros até haver ficha (para o Retry-After)."""
+        agora = time.monotonic()
+        with self._lock:
+            fichas, ultimo = self._baldes.get(chave, (self.rajada, agora))
+            fichas = min(self.rajada, fichas + (agora - ultimo) * self.taxa)
+            if fichas >= 1:
+                fichas -= 1
+                espera = 0
+                self._admitidos += 1
+            else:
+                espera = max(1, math.ceil((1 - fichas) / self.taxa))
+                self._recusados += 1
+            self._baldes[chave] = (fichas, agora)
+            self._baldes.move_to_end(chave)
+            if len(self._baldes) > self._max_chaves:
+                self._baldes.popitem(last=False)
+            return espera
+
+    def estatisticas(self):
+        with self._lock:
+            return {
+                "taxa": self.taxa,
+                "rajada": self.rajada,
+                "admitidos": self._admitidos,
+                "recusados": self._recusados,
+                "chaves": len(self._baldes),
+            }
+
+class LimiteConcorrencia:
+    """
+    Máximo de chamadas simultâneas a um upstream. entrar() nunca espera:
+    acima do limite retorna False e a chamada deve ser recusada na hora,
+    em vez de enfileirar e aumentar a latência de todo mundo.
+    """
+
+    def __init__(self, limite):
+        self.limite = limite
+        self._em_voo = 0
+        self._pico = 0
+        self._recusados = 0
+        self._lock = threading.Lock()
+
+    def entrar(self):
+        with self._lock:
+            if self._em_voo >= self.limite:
+                self._recusados += 1
+                return False
+            self._em_voo += 1
+            self._pico = max(self._pico, self._em_voo)
+            return True
+
+    def sair(self):
+        with self._lock:
+            self._em_voo -= 1
+
+    def estatisticas(self):
+        with self._lock:
+            return {"limite": self.limite, "em_voo": self._em_voo, "pico": self._pico, "recusados": self._recusados}
@@ -0,0 +1,17 @@
+# /microservices/comum/metricas.py
+
+def resumo_latencias(amostras):
+    """Resumo (em ms) de uma coleção de latências em segundos: média, p50, p99 e máximo."""
+    latencias = sorted(amostras)
+    if not latencias:
+        return None
+
+    def percentil(p):
+        return round(latencias[min(int(len(latencias) * p), len(latencias) - 1)] * 1000, 3)
+
+    return {
+        "media": round(sum(latencias) / len(latencias) * 1000, 3),
+        "p50": percentil(0.50),
+        "p99": percentil(0.99),
+        "max": round(latencias[-1] * 1000, 3),
+    }
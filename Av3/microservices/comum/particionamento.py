@@ -0,0 +1,58 @@
+# /microservices/comum/particionamento.py
+#
+# Particionamento dos leilões entre réplicas do MS Lance.
+# Cada leilão cai em uma de NUM_PARTICOES partições fixas (crc32 do id); as
+# partições são distribuídas entre as réplicas por hash consistente. Quando
+# uma réplica entra ou sai, só mudam de dono as partições que o anel move.
+
+import os
+import bisect
+import hashlib
+import zlib
+
+NUM_PARTICOES = int(os.environ.get('NUM_PARTICOES', 64)) # Igual em todos os serviços
+
+def particao_do_leilao(id_leilao) -> int:
+    """Partição fixa do leilão (estável entre processos, ao contrário de hash())."""
+    return zlib.crc32(str(id_leilao).encode()) % NUM_PARTICOES
+
+def rota_particionada(routing_key: str, id_leilao) -> str:
+    """'leilao.iniciado' -> 'leilao.iniciado.p12'. Quem quer tudo escuta 'leilao.iniciado.#'."""
+    return f"{routing_key}.p{particao_do_leilao(id_leilao)}"
+
+def rota_base(routing_key: str) -> str:
+    """Remove o sufixo de partição: 'leilao.iniciado.p12' -> 'leilao.iniciado'."""
+    base, _, sufixo = routing_key.rpartition('.')
+    return base if base and sufixo[:1] == 'p' and sufixo[1:].isdigit() else routing_key
+
+def ler_replicas(texto: str) -> dict:
+    """'ms-lance-0=http://h:5002,ms-lance-1=http://h:5012' -> {id: url}, na ordem dada."""
+    replicas = {}
+    for item in filter(None, (parte.strip() for parte in texto.split(','))):
+        id_replica, _, url = item.partition('=')
+        replicas[id_replica.strip()] = url.strip()
+    return replicas
+
+def _hash(chave: str) -> int:
+    return int.from_bytes(hashlib.md5(chave.encode()).digest()[:8], 'big')
+
+class AnelConsistente:
+    """Anel de hash consistente com nós virtuais; imutável (um rebalanceamento cria outro)."""
+
+    def __init__(self, nos, vnodes=100):
+        self.nos = list(nos)
+        pontos = sorted((_hash(f"{no}#{i}"), no) for no in self.nos for i in range(vnodes))
+        self._chaves = [h for h, _ in pontos]
+        self._donos = [no for _, no in pontos]
+
+    def dono(self, chave) -> str:
+        if not self._chaves:
+            raise LookupError("anel sem réplicas")
+        i = bisect.bisect(self._chaves, _hash(str(chave))) % len(self._chaves)
+        return self._donos[i]
+
+    def dono_da_particao(self, particao: int) -> str:
+        return self.dono(f"p{particao}")
+
+    def particoes_de(self, no) -> set:
+        return {p for p in range(NUM_PARTICOES) if self.dono_da_particao(p) == no}
@@ -0,0 +1,239 @@
+# /microservices/comum/publicador.py
+
+import json
+import time
+import queue
+import threading
+from collections import deque
+
+import pika
+
+from comum.metricas import resumo_latencias
+
+class PublicadorEventos:
+    """
+    Publisher AMQP compartilhado pelos microsserviços.
+    Mantém UMA conexão/canal de longa duração, dona de uma thread própria
+    (o BlockingConnection do pika não é thread-safe). Quem publica só
+    enfileira a mensagem; a thread publica em lotes, na ordem de chegada,
+    e reconecta sozinha se o broker cair.
+
+    Com confirmar=True o canal entra em modo publisher confirms e cada lote
+    só sai da fila depois que o broker confirmou todas as suas mensagens.
+    As publicações do lote vão sem esperar e os Basic.Ack (em geral com
+    multiple=True) são colhidos depois, num único round trip por lote.
+    O confirm_delivery do BlockingChannel espera o ack de cada mensagem,
+    por isso o lote usa o canal assíncrono por baixo dele (channel._impl),
+    sempre a partir desta mesma thread. Um nack ou um ack que não chega em
+    `timeout_confirmacao` segundos derruba a conexão e o lote é republicado.
+
+    Com obrigatorio=True as mensagens vão com mandatory: a que não tem fila
+    ligada à sua routing key volta do broker (Basic.Return) em vez de sumir.
+    Ela é republicada a cada `espera_devolucao` segundos, até
+    `max_devolucoes` vezes; depois é descartada e entregue a `ao_descartar`.
+    """
+
+    def __init__(self, host, usuario, senha, exchange, nome='publicador',
+                 confirmar=False, tamanho_lote=200, capacidade=100000, amostras_latencia=2048,
+                 timeout_confirmacao=30.0, obrigatorio=False, espera_devolucao=1.0,
+                 max_devolucoes=30, ao_descartar=None):
+        self._parametros = pika.ConnectionParameters(
+            host=host, credentials=pika.PlainCredentials(usuario, senha), heartbeat=30)
+        self._exchange = exchange
+        self._nome = nome
+        self._confirmar = confirmar
+        self._tamanho_lote = tamanho_lote
+        self._timeout_confirmacao = timeout_confirmacao
+        self._obrigatorio = obrigatorio
+        self._espera_devolucao = espera_devolucao
+        self._max_devolucoes = max_devolucoes
+        self._ao_descartar = ao_descartar
+        self._devolvidas = deque() # (instante para republicar, item); só a thread de publicação mexe
+        self._fila = queue.Queue(maxsize=capacidade)
+
+        self._stats_lock = threading.Lock()
+        self._publicados = 0
+        self._descartados = 0
+        self._reconexoes = 0
+        self._lotes = 0
+        self._devolvidos = 0
+        self._latencias = deque(maxlen=amostras_latencia) # segundos, enfileirar -> publicado
+
+        self._propriedades_padrao = pika.BasicProperties(delivery_mode=2)
+        self._connection = None
+        self._channel = None
+        self._ultima_tag = 0        # delivery tag da última publicação no canal atual
+        self._nao_confirmadas = set()
+        self._recusadas = 0         # nacks recebidos no canal atual
+        self._thread = threading.Thread(target=self._executar, daemon=True, name=f"{nome}-amqp")
+        self._thread.start()
+
+    # --- API pública ---
+    def publicar(self, routing_key: str, evento: dict, corpo: bytes = None):
+        """Enfileira um evento para publicação. Não bloqueia. Retorna False se a fila estiver cheia."""
+        if corpo is None:
+            corpo = json.dumps(evento).encode()
+        try:
+            self._fila.put_nowait((routing_key, corpo, time.perf_counter(), 0))
+            return True
+        except queue.Full:
+            with self._stats_lock:
+                self._descartados += 1
+            print(f"  [!] [{self._nome}] Fila de publicação cheia; evento '{routing_key}' descartado.")
+            return False
+
+    def estatisticas(self):
+        with self._stats_lock:
+            stats = {
+                "publicados": self._publicados,
+                "descartados": self._descartados,
+                "reconexoes": self._reconexoes,
+                "lotes": self._lotes,
+                "devolvidos": self._devolvidos,
+                "pendentes": self._fila.qsize() + len(self._devolvidas),
+                "conectado": self._channel is not None and self._channel.is_open,
+            }
+            latencias = list(self._latencias)
+        resumo = resumo_latencias(latencias)
+        if resumo:
+            stats["latencia_ms"] = resumo
+        return stats
+
+    # --- Thread de publicação ---
+    def _conectar(self):
+        self._connection = pika.BlockingConnection(self._parametros)
+        self._channel = self._connection.channel()
+        self._channel.exchange_declare(exchange=self._exchange, exchange_type='topic')
+        if self._confirmar:
+            self._ativar_confirmacoes()
+        if self._obrigatorio:
+            self._channel._impl.add_on_return_callback(self._ao_devolver)
+        print(f"[*] [{self._nome}] Publicador conectado ao RabbitMQ.")
+
+    def _ativar_confirmacoes(self):
+        # As delivery tags recomeçam em 1 a cada canal novo
+        self._ultima_tag = 0
+        self._nao_confirmadas = set()
+        self._recusadas = 0
+        ativado = []
+        self._channel._impl.confirm_delivery(ack_nack_callback=self._ao_confirmar,
+                                             callback=lambda _frame: ativado.append(True))
+        self._aguardar(lambda: ativado, "ativar publisher confirms")
+
+    def _ao_confirmar(self, frame):
+        metodo = frame.method
+        if metodo.multiple:
+            tags = {tag for tag in self._nao_confirmadas if tag <= metodo.delivery_tag}
+        else:
+            tags = {metodo.delivery_tag} & self._nao_confirmadas
+        self._nao_confirmadas -= tags
+        if isinstance(metodo, pika.spec.Basic.Nack):
+            self._recusadas += len(tags)
+
+    def _ao_devolver(self, _canal, metodo, propriedades, corpo):
+        # Chega antes do ack da mensagem: o lote só é confirmado com ela já guardada aqui
+        devolucoes = (propriedades.headers or {}).get('devolucoes', 0) + 1
+        with self._stats_lock:
+            self._devolvidos += 1
+        if devolucoes > self._max_devolucoes:
+            with self._stats_lock:
+                self._descartados += 1
+            print(f"  [!] [{self._nome}] Evento '{metodo.routing_key}' sem fila de destino após "
+                  f"{self._max_devolucoes} tentativas; descartado.")
+            if self._ao_descartar:
+                try:
+                    self._ao_descartar(metodo.routing_key, corpo)
+                except Exception as e:
+                    print(f"  [!] [{self._nome}] Erro em ao_descartar: {e}")
+            return
+        self._devolvidas.append((time.monotonic() + self._espera_devolucao,
+                                 (metodo.routing_key, corpo, time.perf_counter(), devolucoes)))
+
+    def _aguardar(self, pronto, o_que):
+        prazo = time.monotonic() + self._timeout_confirmacao
+        while not pronto():
+            restante = prazo - time.monotonic()
+            if restante <= 0:
+                raise TimeoutError(f"broker não respondeu a tempo ({o_que})")
+            self._connection.process_data_events(time_limit=min(restante, 1))
+
+    def _desconectar(self):
+        try:
+            if self._connection and self._connection.is_open:
+                self._connection.close()
+        except Exception:
+            pass
+        self._connection = None
+        self._channel = None
+
+    def _proximo_lote(self):
+        lote = []
+        agora = time.monotonic()
+        while self._devolvidas and self._devolvidas[0][0] <= agora and len(lote) < self._tamanho_lote:
+            lote.append(self._devolvidas.popleft()[1])
+        if not lote:
+            espera = min(1, self._devolvidas[0][0] - agora) if self._devolvidas else 1
+            try:
+                lote = [self._fila.get(timeout=espera)]
+            except queue.Empty:
+                return []
+        try:
+            while len(lote) < self._tamanho_lote:
+                lote.append(self._fila.get_nowait())
+        except queue.Empty:
+            pass
+        return lote
+
+    def _propriedades(self, devolucoes):
+        if not devolucoes:
+            return self._propriedades_padrao
+        return pika.BasicProperties(delivery_mode=2, headers={'devolucoes': devolucoes})
+
+    def _publicar_lote(self, lote):
+        if not self._confirmar:
+            for routing_key, corpo, _, devolucoes in lote:
+                self._channel.basic_publish(exchange=self._exchange, routing_key=routing_key, body=corpo,
+                                            properties=self._propriedades(devolucoes), mandatory=self._obrigatorio)
+            return
+
+        canal = self._channel._impl
+        for routing_key, corpo, _, devolucoes in lote:
+            canal.basic_publish(self._exchange, routing_key, corpo, self._propriedades(devolucoes),
+                                mandatory=self._obrigatorio)
+            self._ultima_tag += 1
+            self._nao_confirmadas.add(self._ultima_tag)
+        self._aguardar(lambda: not self._nao_confirmadas, f"confirmar lote de {len(lote)}")
+        if self._recusadas:
+            raise RuntimeError(f"broker recusou (nack) {self._recusadas} mensagem(ns) do lote")
+
+    def _executar(self):
+        pendente = []  # lote que falhou e será republicado após reconectar
+        espera = 1
+        while True:
+            try:
+                if self._channel is None or not self._channel.is_open:
+                    self._conectar()
+                    espera = 1
+
+                lote = pendente or self._proximo_lote()
+                if not lote:
+                    # Ocioso: mantém os heartbeats da conexão em dia
+                    self._connection.process_data_events(time_limit=0)
+                    continue
+
+                pendente = lote
+                self._publicar_lote(lote)
+                pendente = []
+
+                agora = time.perf_counter()
+                with self._stats_lock:
+                    self._publicados += len(lote)
+                    self._lotes += 1
+                    self._latencias.extend(agora - enfileirado for _, _, enfileirado, _ in lote)
+            except Exception as e:
+                print(f"  [!] [{self._nome}] Erro no publicador: {e}. Reconectando em {espera}s...")
+                self._desconectar()
+                with self._stats_lock:
+                    self._reconexoes += 1
+                time.sleep(espera)
+                espera = min(espera * 2, 30)
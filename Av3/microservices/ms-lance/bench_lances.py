@@ -0,0 +1,94 @@
+# /microservices/ms-lance/bench_lances.py
+#
+# Benchmark de vazão do POST /lance do MS Lance.
+# Com o sistema rodando (orchestrator.py), cria um leilão que começa em
+# seguida, espera o MS Lance recebê-lo e dispara lances crescentes a partir
+# de várias threads. Rode uma vez em cada versão para comparar lances/s.
+# Apontando --lance-url para o Gateway (porta 5000) com LANCE_MODO=fila,
+# as respostas 202 contam como aceitas (o veredito segue pelo SSE).
+#
+#   python bench_lances.py --threads 32 --duracao 10
+
+import time
+import argparse
+import itertools
+import threading
+import requests
+from datetime import datetime, timezone, timedelta
+
+def criar_leilao(leilao_url, duracao):
+    agora = datetime.now(timezone.utc)
+    resposta = requests.post(f"{leilao_url}/leiloes", json={
+        "nome_produto": "Benchmark",
+        "descricao": "Leilão criado pelo bench_lances.py",
+        "valor_inicial": 1.0,
+        "inicio": (agora + timedelta(seconds=1)).isoformat(),
+        "fim": (agora + timedelta(seconds=duracao + 30)).isoformat(),
+    })
+    resposta.raise_for_status()
+    return resposta.json()['id']
+
+def disparar(lance_url, id_leilao, valores, fim, resultados, indice):
+    sessao = requests.Session()
+    aceitos = rejeitados = falhas = 0
+    latencias = []
+    while time.perf_counter() < fim:
+        t0 = time.perf_counter()
+        try:
+            resposta = sessao.post(f"{lance_url}/lance", json={
+                "id_leilao": id_leilao,
+                "id_usuario": f"bench_{indice}",
+                "valor": float(next(valores)),
+            })
+            if resposta.status_code in (200, 202):
+                aceitos += 1
+            else:
+                rejeitados += 1
+        except requests.exceptions.RequestException:
+            falhas += 1
+        latencias.append(time.perf_counter() - t0)
+    resultados[indice] = (aceitos, rejeitados, falhas, latencias)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de lances/s do MS Lance")
+    parser.add_argument('--lance-url', default="http://127.0.0.1:5002")
+    parser.add_argument('--leilao-url', default="http://127.0.0.1:5001")
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--duracao', type=float, default=10.0, help="segundos de carga")
+    args = parser.parse_args()
+
+    id_leilao = criar_leilao(args.leilao_url, args.duracao)
+    print(f"[bench] Leilão {id_leilao} criado; aguardando início...")
+    time.sleep(3)
+
+    valores = itertools.count(2) # Lances sempre crescentes (a maioria é aceita)
+    resultados = [None] * args.threads
+    fim = time.perf_counter() + args.duracao
+    threads = [threading.Thread(target=disparar, args=(args.lance_url, id_leilao, valores, fim, resultados, i))
+               for i in range(args.threads)]
+    inicio = time.perf_counter()
+    for t in threads: t.start()
+    for t in threads: t.join()
+    decorrido = time.perf_counter() - inicio
+
+    aceitos = sum(r[0] for r in resultados)
+    rejeitados = sum(r[1] for r in resultados)
+    falhas = sum(r[2] for r in resultados)
+    latencias = sorted(l for r in resultados for l in r[3])
+    total = aceitos + rejeitados
+    print(f"[bench] {total} lances em {decorrido:.1f}s -> {total / decorrido:.0f} lances/s "
+          f"({aceitos} aceitos, {rejeitados} rejeitados, {falhas} falhas de conexão)")
+    if latencias:
+        p50 = latencias[len(latencias) // 2] * 1000
+        p99 = latencias[min(int(len(latencias) * 0.99), len(latencias) - 1)] * 1000
+        print(f"[bench] latência p50={p50:.1f} ms  p99={p99:.1f} ms")
+    try:
+        # Direto no MS Lance: quanto tempo cada lance segurou o lock do leilão
+        resposta = requests.get(f"{args.lance_url}/metricas/lock", timeout=5)
+        if resposta.status_code == 200:
+            print(f"[bench] lock do leilão (ms): {resposta.json()['lock_ms']}")
+    except requests.exceptions.RequestException:
+        pass
+
+if __name__ == '__main__':
+    main()
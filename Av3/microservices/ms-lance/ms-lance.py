@@ -1,48 +1,740 @@
 # /microservices/ms-lance/ms-lance.py
 
-import pika
+import os
+import sys
+import glob
+import math
+import heapq
+import bisect
 import json
+import time
 import threading
+from array import array
+from collections import deque, defaultdict
+from contextlib import contextmanager
+from datetime import datetime
 from flask import Flask, request, jsonify
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from comum.publicador import PublicadorEventos
+from comum.assinatura import CABECALHO_ASSINATURA, verificar, assinar_pedido, verificar_pedido
+from comum.consumidor import ConsumidorEventos
+from comum.http_cliente import ClienteHTTP
+from comum.idempotencia import CacheIdempotencia
+from comum.metricas import resumo_latencias
+from comum.particionamento import (NUM_PARTICOES, AnelConsistente, ler_replicas,
+                                   particao_do_leilao, rota_base)
+
 # --- Configurações ---
 RABBITMQ_HOST = '127.0.0.1'
 RABBITMQ_USER = 'user'
 RABBITMQ_PASS = 'password'
 EXCHANGE_NAME = 'leilao_topic_exchange'
-# BINDING_KEYS agora escuta apenas o ciclo de vida do leilão
+NUM_LISTRAS_LOCK = int(os.environ.get('NUM_LISTRAS_LOCK', 64)) # Locks independentes para os leilões
+CONFIRMAR_PUBLICACAO = os.environ.get('CONFIRMAR_PUBLICACAO') == '1' # Confirmação do broker por lote
+# Réplicas: cada uma é dona das partições que o anel de hash consistente lhe atribui
+MS_LANCE_ID = os.environ.get('MS_LANCE_ID', 'ms-lance-0')
+MS_LANCE_PORTA = int(os.environ.get('MS_LANCE_PORTA', 5002))
+MS_LANCE_REPLICAS = ler_replicas(os.environ.get('MS_LANCE_REPLICAS', f"{MS_LANCE_ID}=http://127.0.0.1:{MS_LANCE_PORTA}"))
+# BINDING_KEYS agora escuta apenas o ciclo de vida do leilão (com sufixo de partição: leilao.iniciado.p<k>)
 BINDING_KEYS = ['leilao.iniciado', 'leilao.finalizado'] 
+# Fila durável dos eventos de ciclo de vida; uma por réplica
+FILA_EVENTOS = os.environ.get('MS_LANCE_FILA', f'ms_lance.{MS_LANCE_ID}.eventos')
+CONSUMO_PREFETCH = int(os.environ.get('CONSUMO_PREFETCH', 100))
+
+# Comandos de lance assíncronos (Gateway com LANCE_MODO=fila): fila durável por réplica
+FILA_COMANDOS_LANCE = f'lance_comandos.{MS_LANCE_ID}'
+ROUTING_KEY_COMANDO_LANCE = 'lance.comando'
+LANCE_SEGREDO = os.environ.get('LANCE_SEGREDO', 'segredo-dev-leilao').encode() # Mesmo valor do Gateway
+# Assina rebalanceamento e exportação de partições (Gateway <-> réplicas); mesmo valor em todos
+PARTICOES_SEGREDO = os.environ.get('PARTICOES_SEGREDO', 'segredo-dev-particoes').encode()
+LANCE_PREFETCH = int(os.environ.get('LANCE_PREFETCH', 500)) # Comandos entregues sem ack
+LANCE_LOTE = 200 # Comandos decididos por ack (multiple=True)
+INTERVALO_LOTE = 0.01 # Segundos sem mensagens novas para fechar um lote parcial
+
+# Recuperação: snapshot do estado + diário (append-only) das mudanças desde o snapshot
+DIRETORIO_DADOS = os.environ.get('MS_LANCE_DADOS', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dados', MS_LANCE_ID))
+SNAPSHOT_INTERVALO = 30 # Segundos entre snapshots (se houve mudança)
+SNAPSHOT_REGISTROS = 50000 # ...ou antes, quando o diário passar deste tamanho
+DIARIO_FSYNC = os.environ.get('MS_LANCE_FSYNC') == '1' # fsync por lote (sobrevive à queda da máquina)
+IDEMPOTENCIA_CAPACIDADE = int(os.environ.get('IDEMPOTENCIA_CAPACIDADE', 100000)) # Vereditos lembrados (LRU)
+INCREMENTO_LANCE = float(os.environ.get('INCREMENTO_LANCE', 1.0)) # Quanto um lance automático cobre o concorrente
+# Rejeições: 'evento' publica um lance.invalidado por lance rejeitado; 'agregado' responde só
+# ao próprio usuário e publica contagens por leilão a cada REJEICOES_INTERVALO (mesmo valor no Gateway)
+REJEICOES_MODO = os.environ.get('REJEICOES_MODO', 'evento')
+HISTORICO_MAX_LANCES = int(os.environ.get('HISTORICO_MAX_LANCES', 10000)) # Lances guardados por leilão (os mais antigos saem)
+REJEICOES_INTERVALO = float(os.environ.get('REJEICOES_INTERVALO', 5))
+CAMPOS_REJEICAO = ('id_leilao', 'id_usuario', 'id_lance') # Únicos campos do pedido copiados no lance.invalidado
 
 # --- Configuração do Flask ---
 app = Flask(__name__)
 
 # --- Estado Interno e Threading ---
 leiloes_ativos = {}
-leiloes_lock = threading.Lock() # Lock para proteger o dicionário
+lances_maximos = {} # id_leilao -> LancesMaximos (lances automáticos registrados)
+historicos = {} # id_leilao -> HistoricoLances (lances aceitos, só em memória)
+# Lock striping: cada leilão é protegido pela listra id_leilao % N, então
+# lances em leilões diferentes não disputam o mesmo lock
+locks_leiloes = [threading.Lock() for _ in range(NUM_LISTRAS_LOCK)]
+# Rejeições desde a última agregação, uma tabela por listra (protegida pelo lock da listra):
+# contar não cria disputa nova. id_leilao -> [quantidade, último erro]
+rejeicoes_por_listra = [{} for _ in range(NUM_LISTRAS_LOCK)]
+
+def lock_do_leilao(leilao_id):
+    return locks_leiloes[hash(leilao_id) % NUM_LISTRAS_LOCK]
+
+# Quanto tempo cada decisão de lance segura o lock do leilão (amostras recentes, segundos)
+tempos_lock = deque(maxlen=4096)
+
+@contextmanager
+def lock_medido(leilao_id):
+    with lock_do_leilao(leilao_id):
+        inicio = time.perf_counter()
+        try:
+            yield
+        finally:
+            tempos_lock.append(time.perf_counter() - inicio)
+
+# Partições desta réplica. Os conjuntos são trocados inteiros (nunca alterados no lugar),
+# então quem só consulta não precisa de lock. particoes_lock serializa as trocas e o
+# adiamento de eventos das partições que ainda estão chegando de outra réplica.
+anel = AnelConsistente(MS_LANCE_REPLICAS)
+particoes_proprias = frozenset(anel.particoes_de(MS_LANCE_ID))
+particoes_recebendo = frozenset()
+eventos_adiados = [] # (funcao, routing_key, mensagem) recebidos durante a transferência
+particoes_lock = threading.Lock()
+rebalanceamento_lock = threading.Lock()
+ERRO_PARTICAO = "Leilão pertence a outra réplica do MS Lance"
+
+def ler_valor(valor):
+    """Valor monetário do pedido como float positivo e finito, ou None se inválido."""
+    if isinstance(valor, bool):
+        return None
+    try:
+        valor = float(valor)
+    except (TypeError, ValueError):
+        return None
+    return valor if math.isfinite(valor) and valor > 0 else None
+
+# Veredito por chave de idempotência: lances repetidos (retry do cliente/Gateway ou
+# reentrega da fila) recebem a mesma resposta sem republicar nada
+idempotencia = CacheIdempotencia(IDEMPOTENCIA_CAPACIDADE)
+
+def chave_idempotencia(dados, chave=None):
+    """Idempotency-Key (ou id_lance do cliente), com escopo por usuário."""
+    chave = chave or dados.get('id_lance')
+    return f"{dados.get('id_usuario')}:{chave}" if chave else None
+
+def chaves_eventos(particoes):
+    return [f"{key}.p{p}" for p in sorted(particoes) for key in BINDING_KEYS]
+
+def chaves_comandos(particoes):
+    return [f"{ROUTING_KEY_COMANDO_LANCE}.p{p}" for p in sorted(particoes)]
 
 # --- Funções de Lógica de Negócio ---
 
+publicador = PublicadorEventos(RABBITMQ_HOST, RABBITMQ_USER, RABBITMQ_PASS, EXCHANGE_NAME,
+                               nome='ms-lance', confirmar=CONFIRMAR_PUBLICACAO)
+
 def publicar_evento(routing_key: str, evento: dict):
     """
     Publica um evento na exchange principal (Thread-safe).
-    Cria uma nova conexão para cada publicação.
+    Apenas enfileira no publicador compartilhado, que mantém a conexão aberta.
     """
-    try:
-        credentials = pika.PlainCredentials(RABBITMQ_USER, RABBITMQ_PASS)
-        connection = pika.BlockingConnection(pika.ConnectionParameters(host=RABBITMQ_HOST, credentials=credentials))
-        channel = connection.channel()
-        channel.exchange_declare(exchange=EXCHANGE_NAME, exchange_type='topic')
-        
-        channel.basic_publish(
-            exchange=EXCHANGE_NAME,
-            routing_key=routing_key,
-            body=json.dumps(evento),
-            properties=pika.BasicProperties(delivery_mode=2)
-        )
-        print(f"  --> [PUB] Evento '{routing_key}' publicado.")
-        connection.close()
-    except Exception as e:
-        print(f"  [!] Erro ao publicar evento '{routing_key}': {e}")
+    publicador.publicar(routing_key, evento)
+    print(f"  --> [PUB] Evento '{routing_key}' enfileirado.")
+
+class Outbox:
+    """
+    Outbox em memória dos eventos decididos sob o lock do leilão.
+    registrar() só numera e anexa o evento (O(1)); uma thread dedicada drena
+    a fila na ordem dos números de sequência e entrega ao publicador, fora
+    de qualquer lock de negócio.
+    """
+
+    def __init__(self, entregar):
+        self._entregar = entregar
+        self._itens = deque()
+        # Começa no relógio em microssegundos: seq continua crescente após reinícios
+        self._seq = time.time_ns() // 1000
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._drenar, daemon=True)
+        self._thread.start()
+
+    def registrar(self, routing_key, evento):
+        """Anexa o evento com o próximo número de sequência e o retorna."""
+        with self._cond:
+            self._seq += 1
+            self._itens.append((routing_key, dict(evento, seq=self._seq)))
+            self._cond.notify()
+            return self._seq
+
+    def estatisticas(self):
+        with self._cond:
+            return {"ultimo_seq": self._seq, "pendentes": len(self._itens)}
+
+    def _drenar(self):
+        while True:
+            with self._cond:
+                while not self._itens:
+                    self._cond.wait()
+                lote = list(self._itens)
+                self._itens.clear()
+            for routing_key, evento in lote:
+                try:
+                    self._entregar(routing_key, evento)
+                except Exception as e:
+                    print(f"  [!] Erro ao entregar evento '{routing_key}' (seq {evento['seq']}): {e}")
+
+outbox = Outbox(publicar_evento)
+
+class DiarioLances:
+    """
+    Persistência do estado de leiloes_ativos: snapshot compacto + diário.
+    registrar() só anexa o registro a uma fila (chamado sob o lock do leilão,
+    então a ordem por leilão é preservada); uma thread grava em lote no
+    segmento corrente do diário. A cada SNAPSHOT_INTERVALO/SNAPSHOT_REGISTROS
+    a thread abre um segmento novo, grava o snapshot e apaga os antigos.
+
+    Registros (listas JSON, uma por linha), todos com valores absolutos, então
+    reaplicar um registro já refletido no snapshot não muda o resultado:
+      ["i", id, valor_inicial, fim]      leilão iniciado (fim em epoch, ou null)
+      ["l", id, valor, id_usuario, seq]  lance aceito (seq: seq_leilao depois dele)
+      ["f", id]                          leilão finalizado
+      ["m", id, maior, vencedor, status, fim, seq] estado importado de outra réplica
+      ["x", id]                          leilão exportado para outra réplica
+      ["p", id, id_usuario, maximo]      lance máximo (automático) registrado
+    """
+
+    def __init__(self, diretorio, estado, maximos):
+        self._diretorio = diretorio
+        self._estado = estado # dict id -> info (leiloes_ativos)
+        self._maximos = maximos # dict id -> LancesMaximos (lances_maximos)
+        self._itens = deque()
+        self._cond = threading.Condition()
+        self._segmento = 0
+        self._arquivo = None
+        self._registros_desde_snapshot = 0
+        self._ultimo_snapshot = time.monotonic()
+        self.recuperacao = {}
+        self._thread = threading.Thread(target=self._executar, daemon=True, name='diario-lances')
+
+    # --- API pública ---
+    def registrar(self, *registro):
+        with self._cond:
+            self._itens.append(registro)
+            self._cond.notify()
+
+    def recuperar(self):
+        """Carrega o snapshot e reaplica só os segmentos do diário posteriores a ele."""
+        t0 = time.perf_counter()
+        os.makedirs(self._diretorio, exist_ok=True)
+        caminho_snapshot = os.path.join(self._diretorio, 'snapshot.json')
+        primeiro_segmento, leiloes_snapshot = 0, 0
+        if os.path.exists(caminho_snapshot):
+            with open(caminho_snapshot) as f:
+                snapshot = json.load(f)
+            primeiro_segmento = snapshot['segmento']
+            for leilao_id, maior, vencedor, status, *extra in snapshot['leiloes']:
+                self._estado[leilao_id] = {"maior_lance": maior, "vencedor": vencedor, "status": status,
+                                           "fim": extra[0] if extra else None,
+                                           "seq_leilao": extra[1] if len(extra) > 1 else 0}
+            for leilao_id, usuario, maximo in snapshot.get('maximos', []):
+                self._maximos.setdefault(leilao_id, LancesMaximos()).registrar(usuario, maximo)
+            leiloes_snapshot = len(snapshot['leiloes'])
+
+        reaplicados = 0
+        segmentos = self._segmentos()
+        for numero, caminho in segmentos:
+            if numero < primeiro_segmento: continue
+            with open(caminho) as f:
+                for linha in f:
+                    try:
+                        self._aplicar(json.loads(linha))
+                    except ValueError:
+                        break # Última linha cortada por uma queda no meio da escrita
+                    reaplicados += 1
+
+        # Sempre começa um segmento novo, depois de todos os do disco e do snapshot:
+        # um segmento com número menor que o do snapshot seria ignorado na próxima recuperação
+        self._segmento = max([primeiro_segmento] + [numero for numero, _ in segmentos]) + 1
+        self._registros_desde_snapshot = reaplicados
+        self.recuperacao = {
+            "leiloes_snapshot": leiloes_snapshot,
+            "registros_reaplicados": reaplicados,
+            "leiloes": len(self._estado),
+            "duracao_ms": round((time.perf_counter() - t0) * 1000, 1),
+        }
+        print(f"[DIÁRIO] Recuperado: {self.recuperacao}")
+        return self.recuperacao
+
+    def iniciar(self):
+        self._abrir_segmento()
+        self._thread.start()
+
+    # --- Internos ---
+    def _segmentos(self):
+        caminhos = glob.glob(os.path.join(self._diretorio, 'diario.*.log'))
+        return sorted((int(c.rsplit('.', 2)[1]), c) for c in caminhos)
+
+    def _aplicar(self, registro):
+        tipo, leilao_id = registro[0], registro[1]
+        if tipo == 'i':
+            self._estado[leilao_id] = {"maior_lance": registro[2], "vencedor": None, "status": "ativo",
+                                       "fim": registro[3] if len(registro) > 3 else None, "seq_leilao": 0}
+            self._maximos.pop(leilao_id, None)
+        elif tipo == 'l':
+            info = self._estado.setdefault(leilao_id, {"maior_lance": 0, "vencedor": None, "status": "ativo", "fim": None})
+            info['maior_lance'], info['vencedor'] = registro[2], registro[3]
+            if len(registro) > 4:
+                info['seq_leilao'] = registro[4]
+        elif tipo == 'f':
+            if leilao_id in self._estado:
+                self._estado[leilao_id]['status'] = 'encerrado'
+            self._maximos.pop(leilao_id, None)
+        elif tipo == 'm':
+            self._estado[leilao_id] = {"maior_lance": registro[2], "vencedor": registro[3], "status": registro[4],
+                                       "fim": registro[5] if len(registro) > 5 else None,
+                                       "seq_leilao": registro[6] if len(registro) > 6 else 0}
+            self._maximos.pop(leilao_id, None) # Os máximos importados vêm em registros 'p' seguintes
+        elif tipo == 'x':
+            self._estado.pop(leilao_id, None)
+            self._maximos.pop(leilao_id, None)
+        elif tipo == 'p':
+            self._maximos.setdefault(leilao_id, LancesMaximos()).registrar(registro[2], registro[3])
+
+    def _abrir_segmento(self):
+        if self._arquivo:
+            self._arquivo.close()
+        caminho = os.path.join(self._diretorio, f'diario.{self._segmento}.log')
+        self._arquivo = open(caminho, 'a', encoding='utf-8')
+
+    def _gravar_snapshot(self):
+        """
+        Roda na thread do diário. Tudo o que foi gravado nos segmentos anteriores
+        já está aplicado no estado; mudanças concorrentes à cópia também estão no
+        segmento novo e são reaplicadas na recuperação.
+        """
+        self._segmento += 1
+        self._abrir_segmento()
+        leiloes = [[leilao_id, info['maior_lance'], info['vencedor'], info['status'], info.get('fim'),
+                    info.get('seq_leilao', 0)]
+                   for leilao_id, info in list(self._estado.items()) if info['status'] == 'ativo']
+        maximos = [[leilao_id, usuario, maximo]
+                   for leilao_id, lances in list(self._maximos.items()) for usuario, maximo in lances.em_ordem()]
+        caminho = os.path.join(self._diretorio, 'snapshot.json')
+        with open(caminho + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump({"segmento": self._segmento, "leiloes": leiloes, "maximos": maximos}, f, separators=(',', ':'))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(caminho + '.tmp', caminho) # Troca atômica: nunca há snapshot pela metade
+        for numero, antigo in self._segmentos():
+            if numero < self._segmento:
+                os.remove(antigo)
+        self._registros_desde_snapshot = 0
+        self._ultimo_snapshot = time.monotonic()
+        print(f"[DIÁRIO] Snapshot com {len(leiloes)} leilão(ões) ativo(s).")
+
+    def _executar(self):
+        while True:
+            with self._cond:
+                if not self._itens:
+                    self._cond.wait(1)
+                lote = list(self._itens)
+                self._itens.clear()
+            try:
+                if lote:
+                    self._arquivo.write(''.join(json.dumps(r, separators=(',', ':')) + '\n' for r in lote))
+                    self._arquivo.flush()
+                    if DIARIO_FSYNC:
+                        os.fsync(self._arquivo.fileno())
+                    self._registros_desde_snapshot += len(lote)
+                if self._registros_desde_snapshot >= SNAPSHOT_REGISTROS or (
+                        self._registros_desde_snapshot and time.monotonic() - self._ultimo_snapshot >= SNAPSHOT_INTERVALO):
+                    self._gravar_snapshot()
+            except Exception as e:
+                print(f"  [!] Erro no diário de lances: {e}")
+
+class LancesMaximos:
+    """
+    Lances máximos (automáticos) de um leilão: cada usuário informa até quanto
+    aceita pagar e o MS Lance cobre os concorrentes por ele, só o necessário.
+    Heap por valor máximo (empate: quem registrou primeiro) com remoção
+    preguiçosa: a entrada antiga de quem aumentou o máximo fica no heap e é
+    descartada quando chega ao topo. Usado sempre sob o lock do leilão.
+    """
+
+    def __init__(self):
+        self._heap = []     # (-maximo, ordem, id_usuario)
+        self._maximos = {}  # id_usuario -> (maximo, ordem) em vigor
+        self._ordem = 0
+
+    def __len__(self):
+        return len(self._maximos)
+
+    def maximo_de(self, usuario):
+        return self._maximos.get(usuario, (None,))[0]
+
+    def registrar(self, usuario, maximo):
+        self._ordem += 1
+        self._maximos[usuario] = (maximo, self._ordem)
+        heapq.heappush(self._heap, (-maximo, self._ordem, usuario))
+        if len(self._heap) > 2 * len(self._maximos) + 16:
+            # Muitas entradas velhas (máximos aumentados): reconstrói só com as em vigor
+            self._heap = [(-m, o, u) for u, (m, o) in self._maximos.items()]
+            heapq.heapify(self._heap)
+
+    def em_ordem(self):
+        """[[id_usuario, maximo], ...] na ordem de registro (reaplicar preserva os empates)."""
+        return [[u, m] for u, (m, _) in sorted(self._maximos.items(), key=lambda item: item[1][1])]
+
+    def _topo(self):
+        while self._heap:
+            negativo, ordem, usuario = self._heap[0]
+            if self._maximos.get(usuario) == (-negativo, ordem):
+                return -negativo, usuario
+            heapq.heappop(self._heap) # Entrada substituída por um máximo maior
+        return None
+
+    def _dois_maiores(self):
+        primeiro = self._topo()
+        if primeiro is None:
+            return None, None
+        entrada = heapq.heappop(self._heap)
+        segundo = self._topo()
+        heapq.heappush(self._heap, entrada)
+        return primeiro, segundo
+
+    def resolver(self, preco, lider):
+        """
+        Disputa entre os lances automáticos a partir do estado (preco, lider).
+        O maior máximo fica na frente pagando INCREMENTO_LANCE acima do segundo
+        (ou do preço atual), limitado ao próprio máximo. Retorna (preco, lider).
+        """
+        while True:
+            primeiro, segundo = self._dois_maiores()
+            if primeiro is None:
+                return preco, lider
+            maximo, usuario = primeiro
+            if usuario == lider or maximo > preco:
+                break
+            self._maximos.pop(usuario) # Esgotado: não cobre mais o preço atual
+        concorrente = segundo[0] if segundo else preco
+        if usuario == lider:
+            # Já na frente: só sobe se outro automático passou do preço
+            if concorrente > preco:
+                preco = min(maximo, concorrente + INCREMENTO_LANCE)
+            return preco, lider
+        return min(maximo, max(preco, concorrente) + INCREMENTO_LANCE), usuario
+
+class HistoricoLances:
+    """
+    Lances aceitos de um leilão em arrays paralelos: valor e instante em
+    array('d') e o usuário como índice (array('I')) em uma tabela do próprio
+    leilão, ~20 bytes por lance em vez das centenas de um dict por lance.
+    Ao passar de HISTORICO_MAX_LANCES, o quarto mais antigo sai de uma vez.
+    Todo lance aceito é maior que o anterior: valores e instantes são
+    crescentes (busca binária) e o maior lance de cada usuário é o último dele.
+    Usado sob o lock do leilão.
+    """
+
+    def __init__(self):
+        self.valores = array('d')
+        self.instantes = array('d')
+        self.usuarios = array('I')
+        self._nomes = []     # índice -> id_usuario
+        self._indices = {}   # id_usuario -> índice
+        self._maiores = array('d')   # por índice de usuário
+        self._contagens = array('I') # lances aceitos por índice de usuário (inclusive os já descartados)
+
+    def __len__(self):
+        return len(self.valores)
+
+    def adicionar(self, valor, usuario, instante):
+        indice = self._indices.get(usuario)
+        if indice is None:
+            indice = self._indices[usuario] = len(self._nomes)
+            self._nomes.append(usuario)
+            self._maiores.append(0)
+            self._contagens.append(0)
+        if len(self.valores) >= HISTORICO_MAX_LANCES:
+            descarte = max(1, HISTORICO_MAX_LANCES // 4)
+            del self.valores[:descarte], self.instantes[:descarte], self.usuarios[:descarte]
+        self.valores.append(valor)
+        self.instantes.append(instante)
+        self.usuarios.append(indice)
+        self._maiores[indice] = valor
+        self._contagens[indice] += 1
+
+    def ultimos(self, n):
+        """Os n lances mais recentes, do mais novo para o mais antigo."""
+        inicio = max(0, len(self.valores) - n)
+        return [{"id_usuario": self._nomes[self.usuarios[i]], "valor": self.valores[i], "instante": self.instantes[i]}
+                for i in range(len(self.valores) - 1, inicio - 1, -1)]
+
+    def maiores(self, n):
+        """Os n usuários com o maior lance."""
+        indices = heapq.nlargest(n, range(len(self._nomes)), key=self._maiores.__getitem__)
+        return [{"id_usuario": self._nomes[i], "maior_lance": self._maiores[i], "lances": self._contagens[i]}
+                for i in indices]
+
+    def serie(self, desde, ate, pontos):
+        """
+        Preço ao longo de [desde, ate] em até `pontos` intervalos iguais: o
+        último valor de cada intervalo e quantos lances caíram nele. Cada
+        intervalo é uma busca binária, O(pontos * log n), sem percorrer os lances.
+        """
+        largura = (ate - desde) / pontos if ate > desde else 0
+        anterior = bisect.bisect_left(self.instantes, desde)
+        serie = []
+        for k in range(1, pontos + 1):
+            fim = ate if k == pontos or not largura else desde + k * largura
+            atual = bisect.bisect_right(self.instantes, fim)
+            if atual > anterior:
+                serie.append({"instante": fim, "valor": self.valores[atual - 1], "lances": atual - anterior})
+            anterior = atual
+            if not largura: break
+        return serie
+
+    def tamanho_bytes(self):
+        """(bytes dos arrays por lance, bytes da tabela de usuários) - medidos, com a sobra de alocação."""
+        por_lance = sum(sys.getsizeof(a) for a in (self.valores, self.instantes, self.usuarios))
+        tabela = (sys.getsizeof(self._nomes) + sys.getsizeof(self._indices) + sys.getsizeof(self._maiores)
+                  + sys.getsizeof(self._contagens) + sum(sys.getsizeof(u) for u in self._nomes))
+        return por_lance, tabela
+
+class PrazosLeiloes:
+    """
+    Índice dos prazos (fim) dos leilões desta réplica: min-heap (fim, id_leilao)
+    e uma única thread que dorme até o próximo prazo e encerra o leilão pelo
+    relógio local, sem esperar o leilao.finalizado atravessar o broker.
+    Entradas de leilões já encerrados (ou que saíram da réplica) viram no-op
+    quando chegam ao topo.
+    """
+
+    def __init__(self, ao_vencer):
+        self._ao_vencer = ao_vencer # callback(id_leilao) -> True se encerrou
+        self._heap = []
+        self._cond = threading.Condition()
+        self._atrasos = deque(maxlen=1000) # segundos entre o fim e o encerramento
+        self._encerrados = 0
+        self._thread = threading.Thread(target=self._executar, daemon=True, name='prazos-leiloes')
+
+    def iniciar(self):
+        self._thread.start()
+
+    def agendar(self, leilao_id, fim):
+        if fim is None: return
+        with self._cond:
+            heapq.heappush(self._heap, (fim, leilao_id))
+            if self._heap[0][1] == leilao_id:
+                self._cond.notify() # Prazo mais cedo que o que a thread espera
+
+    def agendar_lote(self, itens):
+        """[(id_leilao, fim), ...] de uma vez (recuperação): heapify O(n)."""
+        with self._cond:
+            self._heap.extend((fim, leilao_id) for leilao_id, fim in itens if fim is not None)
+            heapq.heapify(self._heap)
+            self._cond.notify()
+
+    def estatisticas(self):
+        with self._cond:
+            return {"pendentes": len(self._heap), "encerrados_pelo_prazo": self._encerrados,
+                    "atraso": resumo_latencias(self._atrasos)}
+
+    def _executar(self):
+        while True:
+            with self._cond:
+                while not self._heap or self._heap[0][0] > time.time():
+                    self._cond.wait(self._heap[0][0] - time.time() if self._heap else None)
+                fim, leilao_id = heapq.heappop(self._heap)
+            try:
+                if self._ao_vencer(leilao_id):
+                    with self._cond:
+                        self._encerrados += 1
+                        self._atrasos.append(time.time() - fim)
+            except Exception as e:
+                print(f"  [!] Erro ao encerrar o leilão {leilao_id} pelo prazo: {e}")
+
+def prazo_esgotado(leilao_info):
+    """Relógio local contra o fim vindo no leilao.iniciado: não depende do broker."""
+    fim = leilao_info.get('fim')
+    return fim is not None and time.time() >= fim
+
+def aceitar_lance(leilao_id, valor, usuario):
+    """
+    Sob o lock do leilão: novo maior lance no estado, no diário e no histórico.
+    seq_leilao conta os lances aceitos do leilão e vai no lance.validado; ao
+    contrário do seq do outbox (um relógio por processo), acompanha o leilão
+    no diário e na transferência de partição, então continua crescendo quando
+    outra réplica assume o leilão.
+    """
+    leilao_info = leiloes_ativos[leilao_id]
+    leilao_info['maior_lance'], leilao_info['vencedor'] = valor, usuario
+    leilao_info['seq_leilao'] = leilao_info.get('seq_leilao', 0) + 1
+    diario.registrar('l', leilao_id, valor, usuario, leilao_info['seq_leilao'])
+    historico = historicos.get(leilao_id)
+    if historico is None:
+        historico = historicos[leilao_id] = HistoricoLances()
+    historico.adicionar(valor, usuario, time.time())
+
+diario = DiarioLances(DIRETORIO_DADOS, leiloes_ativos, lances_maximos)
+
+def rejeitar(dados, erro, via_fila=False):
+    """
+    Chamado sob o lock do leilão. No modo 'agregado' a rejeição só é contada:
+    quem veio por REST já recebe o erro na resposta, e quem veio pela fila
+    recebe um lance.invalidado endereçado só ao Gateway de origem.
+    O evento leva só CAMPOS_REJEICAO: o pedido pode trazer o valor_maximo
+    de um lance automático, que não pode sair para o broker.
+    """
+    evento = {campo: dados[campo] for campo in CAMPOS_REJEICAO if campo in dados}
+    evento['erro'] = erro
+    if REJEICOES_MODO != 'agregado':
+        outbox.registrar('lance.invalidado', evento)
+        return
+    leilao_id = dados.get('id_leilao')
+    contagem = rejeicoes_por_listra[hash(leilao_id) % NUM_LISTRAS_LOCK].setdefault(leilao_id, [0, None])
+    contagem[0] += 1
+    contagem[1] = erro
+    if via_fila:
+        gateway = dados.get('gateway')
+        outbox.registrar(f'lance.invalidado.{gateway}' if gateway else 'lance.invalidado', evento)
+
+def decidir_lance(dados, chave=None, via_fila=False):
+    """
+    Valida o lance e registra o veredito no outbox. Retorna a mensagem de erro ou None.
+    Usado pelo endpoint REST e pelo consumidor de comandos (`via_fila`). Com `chave`,
+    um lance repetido devolve o veredito já dado, sem efeito nenhum.
+    """
+    leilao_id = dados.get('id_leilao')
+    usuario_id = dados.get('id_usuario')
+    # Conferido antes do lock: um valor de tipo errado não pode estourar com a listra presa
+    valor_lance = ler_valor(dados.get('valor'))
+    if valor_lance is None:
+        return "Valor do lance deve ser um número positivo"
+    dados = dict(dados, valor=valor_lance) # O evento publicado leva o valor já convertido
+
+    # Sob o lock só a decisão e o registro no outbox; logs e publicação ficam de fora
+    with lock_medido(leilao_id): # Protege apenas este leilão
+        # Conferido sob o lock: a exportação da partição espera este lance terminar
+        if particao_do_leilao(leilao_id) not in particoes_proprias:
+            return ERRO_PARTICAO
+        # Mesma chave => mesmo leilão => mesmo lock: checar e guardar aqui é atômico
+        if chave:
+            veredito = idempotencia.obter(chave)
+            if veredito is not CacheIdempotencia.AUSENTE:
+                return veredito
+        leilao_info = leiloes_ativos.get(leilao_id)
+        evento = None
+
+        # Validação 1: Leilão existe e está ativo?
+        if not leilao_info or leilao_info['status'] != 'ativo':
+            erro = "Leilão não está ativo"
+        elif prazo_esgotado(leilao_info):
+            erro = "Leilão encerrado (prazo esgotado)"
+        else:
+            # Validação 2: Valor do lance é maior?
+            maior_lance_atual = leilao_info.get('maior_lance', 0)
+            if valor_lance <= maior_lance_atual:
+                erro = f"Valor do lance deve ser maior que R${maior_lance_atual}"
+            else:
+                # Lance Válido! Os lances automáticos respondem antes de publicar
+                erro = None
+                evento = dados
+                maximos = lances_maximos.get(leilao_id)
+                if maximos:
+                    evento, erro = disputar_automaticos(leilao_id, maximos, valor_lance, usuario_id, dados)
+                else:
+                    aceitar_lance(leilao_id, valor_lance, usuario_id)
+
+        if erro:
+            rejeitar(dados, erro, via_fila)
+        if evento:
+            outbox.registrar('lance.validado', dict(evento, seq_leilao=leilao_info['seq_leilao']))
+        if chave:
+            idempotencia.guardar(chave, erro)
+    return erro
+
+def disputar_automaticos(leilao_id, maximos, preco, lider, dados):
+    """
+    Chamado sob o lock do leilão depois de (preco, lider) mudar: resolve os
+    lances automáticos, grava só o estado final e devolve (evento, erro) -
+    um único lance.validado com o resultado (ou None se nada mudou) e o erro
+    para quem originou o lance, se ele não ficou na frente.
+    """
+    leilao_info = leiloes_ativos[leilao_id]
+    anterior = (leilao_info['maior_lance'], leilao_info['vencedor'])
+    preco, lider = maximos.resolver(preco, lider)
+    if (preco, lider) == anterior:
+        return None, None
+    aceitar_lance(leilao_id, preco, lider)
+
+    if lider == dados.get('id_usuario') and preco == dados.get('valor'):
+        return dados, None # O próprio lance direto ficou na frente
+    # Preço definido pelos automáticos; o máximo de ninguém aparece no evento
+    evento = {"id_leilao": leilao_id, "id_usuario": lider, "valor": preco, "automatico": True}
+    if lider != dados.get('id_usuario'):
+        return evento, f"Lance coberto por um lance automático (atual R${preco})"
+    if dados.get('id_lance'):
+        evento['id_lance'] = dados['id_lance']
+    return evento, None
+
+def registrar_lance_maximo(dados, chave=None):
+    """
+    Registra (ou aumenta) o lance máximo do usuário no leilão e resolve a
+    disputa com os demais automáticos. Só publica se o preço ou o líder mudou.
+    Retorna (erro, situacao). Um máximo registrado nunca é erro, mesmo que
+    outro automático maior o cubra na hora: ele fica valendo e já empurrou o
+    preço. situacao diz o preço, o líder e se o usuário ficou na frente.
+    """
+    leilao_id = dados.get('id_leilao')
+    usuario_id = dados.get('id_usuario')
+    maximo = ler_valor(dados.get('valor_maximo'))
+    if maximo is None:
+        return "valor_maximo deve ser um número positivo", None
+
+    with lock_do_leilao(leilao_id):
+        if particao_do_leilao(leilao_id) not in particoes_proprias:
+            return ERRO_PARTICAO, None
+        if chave:
+            veredito = idempotencia.obter(chave)
+            if veredito is not CacheIdempotencia.AUSENTE:
+                return veredito
+        leilao_info = leiloes_ativos.get(leilao_id)
+        evento = None
+        situacao = None
+
+        if not leilao_info or leilao_info['status'] != 'ativo':
+            erro = "Leilão não está ativo"
+        elif prazo_esgotado(leilao_info):
+            erro = "Leilão encerrado (prazo esgotado)"
+        elif not usuario_id:
+            erro = "Campos obrigatórios: id_leilao, id_usuario, valor_maximo"
+        else:
+            maximos = lances_maximos.setdefault(leilao_id, LancesMaximos())
+            registrado = maximos.maximo_de(usuario_id)
+            maior_lance_atual = leilao_info.get('maior_lance', 0)
+            if registrado is not None and maximo <= registrado:
+                erro = f"Lance máximo deve ser maior que o já registrado (R${registrado})"
+            elif maximo <= maior_lance_atual:
+                erro = f"Valor do lance deve ser maior que R${maior_lance_atual}"
+            else:
+                erro = None
+                maximos.registrar(usuario_id, maximo)
+                diario.registrar('p', leilao_id, usuario_id, maximo)
+                evento, _ = disputar_automaticos(leilao_id, maximos, maior_lance_atual,
+                                                 leilao_info['vencedor'], dados)
+                situacao = {"preco": leilao_info['maior_lance'], "lider": leilao_info['vencedor'],
+                            "na_frente": leilao_info['vencedor'] == usuario_id}
+
+        if erro:
+            rejeitar(dados, erro)
+        if evento:
+            outbox.registrar('lance.validado', dict(evento, seq_leilao=leilao_info['seq_leilao']))
+        if chave:
+            idempotencia.guardar(chave, (erro, situacao))
+    return erro, situacao
 
 # --- Endpoints da API REST ---
 
@@ -52,114 +744,444 @@ def efetuar_lance(): #
     Recebe um novo lance via REST.
     JSON esperado: {"id_leilao": int, "id_usuario": str, "valor": float}
     """
-    dados = request.json
-    leilao_id = dados.get('id_leilao')
-    valor_lance = dados.get('valor', 0)
+    dados = request.get_json(silent=True)
+    if not isinstance(dados, dict):
+        return jsonify({"erro": "Envie um objeto JSON"}), 400
+    valor_lance = dados.get('valor')
     usuario_id = dados.get('id_usuario')
     
-    print(f"\n[REST] Recebida tentativa de lance de {usuario_id} no leilão {leilao_id} por R${valor_lance}")
+    print(f"\n[REST] Recebida tentativa de lance de {usuario_id} no leilão {dados.get('id_leilao')} por R${valor_lance}")
 
-    with leiloes_lock: # Protege o acesso ao dicionário
-        leilao_info = leiloes_ativos.get(leilao_id)
-
-        # Validação 1: Leilão existe e está ativo?
-        if not leilao_info or leilao_info['status'] != 'ativo': 
-            print(f"  --> Lance Inválido: Leilão {leilao_id} não está ativo.")
-            publicar_evento('lance.invalidado', dados) # 
-            return jsonify({"erro": "Leilão não está ativo"}), 400
-
-        # Validação 2: Valor do lance é maior?
-        maior_lance_atual = leilao_info.get('maior_lance', 0)
-        if valor_lance <= maior_lance_atual: 
-            print(f"  --> Lance Inválido: Valor R${valor_lance} não é maior que R${maior_lance_atual}.")
-            publicar_evento('lance.invalidado', dados) # 
-            return jsonify({"erro": f"Valor do lance deve ser maior que R${maior_lance_atual}"}), 400
-        
-        # Lance Válido!
-        print(f"  [X] Lance VÁLIDO de {usuario_id} no valor de R${valor_lance}.")
-        leilao_info['maior_lance'] = valor_lance
-        leilao_info['vencedor'] = usuario_id
-        
-        # Publica o evento de lance validado
-        publicar_evento('lance.validado', dados) 
+    erro = decidir_lance(dados, chave_idempotencia(dados, request.headers.get('Idempotency-Key')))
+    if erro == ERRO_PARTICAO:
+        # O Gateway roteou com um anel desatualizado (rebalanceamento em andamento)
+        return jsonify({"erro": erro, "particao": particao_do_leilao(dados.get('id_leilao'))}), 409
+    if erro:
+        print(f"  --> Lance Inválido: {erro}.")
+        return jsonify({"erro": erro}), 400
 
+    print(f"  [X] Lance VÁLIDO de {usuario_id} no valor de R${valor_lance}.")
     return jsonify({"status": "Lance aceito"}), 200
 
+@app.route('/lance/maximo', methods=['POST'])
+def efetuar_lance_maximo():
+    """
+    Registra um lance automático: o MS Lance cobre os concorrentes pelo usuário
+    até `valor_maximo`, publicando só o preço resultante.
+    JSON esperado: {"id_leilao": int, "id_usuario": str, "valor_maximo": float}
+    """
+    dados = request.get_json(silent=True)
+    if not isinstance(dados, dict):
+        return jsonify({"erro": "Envie um objeto JSON"}), 400
+    print(f"\n[REST] Lance máximo de {dados.get('id_usuario')} no leilão {dados.get('id_leilao')}")
+
+    erro, situacao = registrar_lance_maximo(dados, chave_idempotencia(dados, request.headers.get('Idempotency-Key')))
+    if erro == ERRO_PARTICAO:
+        return jsonify({"erro": erro, "particao": particao_do_leilao(dados.get('id_leilao'))}), 409
+    if erro:
+        print(f"  --> Lance máximo recusado: {erro}.")
+        return jsonify({"erro": erro}), 400
+    # Registrado mesmo se outro automático maior já o cobriu (na_frente=False)
+    return jsonify({"status": "Lance máximo registrado", **situacao}), 200
+
+# --- Histórico de lances ---
+
+def ler_inteiro(nome, padrao, maximo):
+    """Parâmetro inteiro da query limitado a 1..maximo; ValueError se não for inteiro."""
+    return max(1, min(int(request.args.get(nome, padrao)), maximo))
+
+def ler_instante_query(nome):
+    """Parâmetro em epoch (segundos) da query, ou None se ausente; ValueError se inválido."""
+    texto = request.args.get(nome)
+    if texto is None:
+        return None
+    valor = float(texto)
+    if not math.isfinite(valor):
+        raise ValueError(nome)
+    return valor
+
+@app.route('/leiloes/<int:id_leilao>/lances', methods=['GET'])
+def consultar_ultimos_lances(id_leilao):
+    """Últimos `n` lances aceitos (padrão 20), do mais novo para o mais antigo."""
+    try:
+        n = ler_inteiro('n', 20, 1000)
+    except ValueError:
+        return jsonify({"erro": "n inválido"}), 400
+    with lock_do_leilao(id_leilao):
+        historico = historicos.get(id_leilao)
+        lances = historico.ultimos(n) if historico else []
+    return jsonify({"id_leilao": id_leilao, "lances": lances}), 200
+
+@app.route('/leiloes/<int:id_leilao>/lances/top', methods=['GET'])
+def consultar_maiores_lances(id_leilao):
+    """Os `n` usuários (padrão 10) com os maiores lances no leilão."""
+    try:
+        n = ler_inteiro('n', 10, 1000)
+    except ValueError:
+        return jsonify({"erro": "n inválido"}), 400
+    with lock_do_leilao(id_leilao):
+        historico = historicos.get(id_leilao)
+        usuarios = historico.maiores(n) if historico else []
+    return jsonify({"id_leilao": id_leilao, "usuarios": usuarios}), 200
+
+@app.route('/leiloes/<int:id_leilao>/lances/serie', methods=['GET'])
+def consultar_serie_precos(id_leilao):
+    """
+    Preço ao longo do tempo, reduzido no servidor a até `pontos` (padrão 100).
+    `desde`/`ate` em epoch (segundos); sem eles, do primeiro ao último lance guardado.
+    """
+    try:
+        pontos = ler_inteiro('pontos', 100, 1000)
+        desde = ler_instante_query('desde')
+        ate = ler_instante_query('ate')
+    except ValueError:
+        return jsonify({"erro": "pontos, desde ou ate inválido"}), 400
+    with lock_do_leilao(id_leilao):
+        historico = historicos.get(id_leilao)
+        if not historico:
+            return jsonify({"id_leilao": id_leilao, "serie": []}), 200
+        desde = historico.instantes[0] if desde is None else desde
+        ate = historico.instantes[-1] if ate is None else ate
+        serie = historico.serie(desde, ate, pontos)
+    return jsonify({"id_leilao": id_leilao, "desde": desde, "ate": ate, "serie": serie}), 200
+
+@app.route('/metricas/historico', methods=['GET'])
+def metricas_historico():
+    """Memória do histórico, medida: bytes por lance (arrays) e da tabela de usuários."""
+    lances, bytes_lances, bytes_usuarios = 0, 0, 0
+    for leilao_id, historico in list(historicos.items()):
+        with lock_do_leilao(leilao_id):
+            lances += len(historico)
+            por_lance, tabela = historico.tamanho_bytes()
+        bytes_lances += por_lance
+        bytes_usuarios += tabela
+    return jsonify({
+        "leiloes": len(historicos),
+        "lances": lances,
+        "max_lances_por_leilao": HISTORICO_MAX_LANCES,
+        "bytes_lances": bytes_lances,
+        "bytes_usuarios": bytes_usuarios,
+        "bytes_por_lance": round(bytes_lances / lances, 1) if lances else None,
+    }), 200
+
+@app.route('/metricas/publicador', methods=['GET'])
+def metricas_publicador():
+    return jsonify({**publicador.estatisticas(), "outbox": outbox.estatisticas()}), 200
+
+@app.route('/metricas/lock', methods=['GET'])
+def metricas_lock():
+    """Tempo com o lock do leilão preso em decidir_lance (média, p50, p99, máximo em ms)."""
+    amostras = list(tempos_lock)
+    return jsonify({"amostras": len(amostras), "lock_ms": resumo_latencias(amostras)}), 200
+
+@app.route('/metricas/comandos', methods=['GET'])
+def metricas_comandos():
+    with stats_comandos_lock:
+        vereditos = dict(stats_comandos)
+    return jsonify({**vereditos, "consumidor": consumidor_comandos.estatisticas()}), 200
+
+@app.route('/metricas/consumo', methods=['GET'])
+def metricas_consumo():
+    return jsonify(consumidor_eventos.estatisticas()), 200
+
+@app.route('/metricas/idempotencia', methods=['GET'])
+def metricas_idempotencia():
+    return jsonify(idempotencia.estatisticas()), 200
+
+@app.route('/metricas/recuperacao', methods=['GET'])
+def metricas_recuperacao():
+    return jsonify(diario.recuperacao), 200
+
+@app.route('/metricas/prazos', methods=['GET'])
+def metricas_prazos():
+    """Encerramentos pelo relógio local e atraso entre o fim e o encerramento (ms)."""
+    return jsonify(prazos.estatisticas()), 200
+
+@app.route('/metricas/rejeicoes', methods=['GET'])
+def metricas_rejeicoes():
+    with stats_rejeicoes_lock:
+        return jsonify({"modo": REJEICOES_MODO, **stats_rejeicoes}), 200
+
+# --- Particionamento entre réplicas ---
+
+@app.route('/particoes', methods=['GET'])
+def listar_particoes():
+    return jsonify({
+        "id": MS_LANCE_ID,
+        "replicas": anel.nos,
+        "particoes": sorted(particoes_proprias),
+        "recebendo": sorted(particoes_recebendo),
+        "leiloes": len(leiloes_ativos),
+        "lances_maximos": sum(len(m) for m in list(lances_maximos.values())),
+    }), 200
+
+@app.route('/particoes/exportar', methods=['POST'])
+def exportar_particoes():
+    """
+    Chamado pela réplica que passa a ser dona das partições: deixa de atendê-las
+    e entrega o estado dos leilões delas. Lances em andamento terminam antes
+    (a exportação pega o lock de cada leilão).
+    """
+    global particoes_proprias
+    dados = request.get_json(silent=True)
+    if not verificar_pedido(dados, request.headers.get(CABECALHO_ASSINATURA), PARTICOES_SEGREDO):
+        return jsonify({"erro": "Assinatura inválida ou expirada"}), 401
+    pedidas = set(dados.get('particoes') or [])
+    with particoes_lock:
+        cedidas = pedidas & particoes_proprias
+        particoes_proprias = particoes_proprias - cedidas
+
+    leiloes = []
+    for leilao_id in list(leiloes_ativos):
+        if particao_do_leilao(leilao_id) in cedidas:
+            with lock_do_leilao(leilao_id):
+                info = leiloes_ativos.pop(leilao_id, None)
+                maximos = lances_maximos.pop(leilao_id, None)
+                historicos.pop(leilao_id, None) # O histórico fica em memória; não acompanha o leilão
+                diario.registrar('x', leilao_id)
+            if info is not None:
+                leiloes.append([leilao_id, info, maximos.em_ordem() if maximos else []])
+    consumidor_eventos.atualizar_bindings(remover=chaves_eventos(cedidas))
+    consumidor_comandos.atualizar_bindings(remover=chaves_comandos(cedidas))
+    print(f"[PARTIÇÕES] {len(cedidas)} partição(ões) cedida(s) com {len(leiloes)} leilão(ões).")
+    return jsonify({"particoes": sorted(cedidas), "leiloes": leiloes}), 200
+
+@app.route('/particoes/rebalancear', methods=['POST'])
+def rebalancear_particoes():
+    """
+    Recebe o novo conjunto de réplicas ({id: url}). Esta réplica passa a escutar
+    as partições que ganhou, busca o estado delas com o dono anterior e só então
+    as atende. As partições que perdeu são levadas pelo novo dono (exportar).
+    """
+    global anel, MS_LANCE_REPLICAS, particoes_proprias, particoes_recebendo
+    dados = request.get_json(silent=True)
+    if not verificar_pedido(dados, request.headers.get(CABECALHO_ASSINATURA), PARTICOES_SEGREDO):
+        return jsonify({"erro": "Assinatura inválida ou expirada"}), 401
+    novas_replicas = dados.get('replicas') or {}
+    if not isinstance(novas_replicas, dict):
+        return jsonify({"erro": "Informe replicas: {id: url}"}), 400
+    if MS_LANCE_ID not in novas_replicas:
+        return jsonify({"erro": f"{MS_LANCE_ID} não está entre as réplicas"}), 400
+
+    with rebalanceamento_lock:
+        novo_anel = AnelConsistente(novas_replicas)
+        ganhas = novo_anel.particoes_de(MS_LANCE_ID) - particoes_proprias
+        with particoes_lock:
+            particoes_recebendo = frozenset(ganhas)
+
+        # 1. Escuta as partições novas antes de buscar o estado: nada do período se perde
+        ligadas = [consumidor_eventos.atualizar_bindings(adicionar=chaves_eventos(ganhas)),
+                   consumidor_comandos.atualizar_bindings(adicionar=chaves_comandos(ganhas))]
+        for evento in ligadas:
+            evento.wait(10)
+
+        # 2. Busca o estado com quem era dono de cada partição
+        por_dono = defaultdict(list)
+        for p in ganhas:
+            por_dono[anel.dono_da_particao(p)].append(p)
+        importados = 0
+        for dono, particoes in por_dono.items():
+            url = MS_LANCE_REPLICAS.get(dono)
+            if not url or dono == MS_LANCE_ID: continue
+            try:
+                corpo, headers = assinar_pedido({"particoes": particoes}, PARTICOES_SEGREDO)
+                resposta = ClienteHTTP(dono, url, pool=1).post('/particoes/exportar', json=corpo, headers=headers)
+                resposta.raise_for_status()
+            except Exception as e:
+                print(f"[PARTIÇÕES] [!] Não foi possível obter as partições {particoes} de {dono}: {e}")
+                continue
+            for leilao_id, info, *extra in resposta.json()['leiloes']:
+                with lock_do_leilao(leilao_id):
+                    leiloes_ativos[leilao_id] = info
+                    prazos.agendar(leilao_id, info.get('fim'))
+                    diario.registrar('m', leilao_id, info['maior_lance'], info['vencedor'], info['status'], info.get('fim'),
+                                     info.get('seq_leilao', 0))
+                    for usuario, maximo in (extra[0] if extra else []):
+                        lances_maximos.setdefault(leilao_id, LancesMaximos()).registrar(usuario, maximo)
+                        diario.registrar('p', leilao_id, usuario, maximo)
+                importados += 1
+
+        # 3. Passa a atender as partições e processa o que chegou durante a transferência
+        with particoes_lock:
+            particoes_proprias = particoes_proprias | ganhas
+            particoes_recebendo = frozenset()
+            adiados = eventos_adiados[:]
+            eventos_adiados.clear()
+            for funcao, routing_key, mensagem in adiados:
+                funcao(routing_key, mensagem)
+        anel, MS_LANCE_REPLICAS = novo_anel, dict(novas_replicas)
+
+    print(f"[PARTIÇÕES] Rebalanceado: +{len(ganhas)} partição(ões), {importados} leilão(ões) importado(s).")
+    return jsonify({"id": MS_LANCE_ID, "ganhas": sorted(ganhas), "importados": importados,
+                    "particoes": sorted(particoes_proprias)}), 200
+
+def adiar_se_em_transferencia(funcao, routing_key, mensagem, id_leilao):
+    """
+    True se o evento não deve ser processado agora: a partição está chegando de
+    outra réplica (fica adiado até o estado ser importado) ou não é desta réplica.
+    """
+    particao = particao_do_leilao(id_leilao)
+    if particao in particoes_proprias:
+        return False
+    with particoes_lock:
+        if particao in particoes_recebendo:
+            eventos_adiados.append((funcao, routing_key, mensagem))
+            return True
+        return particao not in particoes_proprias
+
 # --- Funções de Consumo RabbitMQ ---
 
+def ler_instante(texto):
+    """ISO 8601 do MS Leilão -> epoch (o mesmo relógio que o agendador de lá usa)."""
+    try:
+        return datetime.fromisoformat(texto.replace('Z', '+00:00')).timestamp()
+    except (AttributeError, ValueError):
+        return None
+
 def processar_leilao_iniciado(leilao):
     leilao_id = leilao.get('id_leilao')
     if leilao_id:
-        with leiloes_lock: # Protege o acesso
+        fim = ler_instante(leilao.get('fim'))
+        with lock_do_leilao(leilao_id): # Protege o acesso
+            if leilao_id in leiloes_ativos:
+                return # Reentrega (fila durável) ou já recuperado do diário: não zera os lances
             leiloes_ativos[leilao_id] = {
                 "maior_lance": leilao.get('valor_inicial', 0), # Usa o valor inicial como base
                 "vencedor": None, 
-                "status": "ativo"
+                "status": "ativo",
+                "fim": fim, # Prazo local: lances e encerramento não dependem do leilao.finalizado
+                "seq_leilao": 0,
             }
+            diario.registrar('i', leilao_id, leiloes_ativos[leilao_id]['maior_lance'], fim)
+        prazos.agendar(leilao_id, fim)
         print(f"\n[SUB] Leilão {leilao_id} ({leilao.get('descricao')}) agora está ATIVO.")
 
+def encerrar_leilao(leilao_id, origem):
+    """
+    Encerra o leilão e publica o vencedor. Chamado pelo prazo local e pelo
+    leilao.finalizado; o que chegar primeiro encerra, o outro é no-op.
+    """
+    with lock_do_leilao(leilao_id): # Protege o acesso
+        leilao_info = leiloes_ativos.get(leilao_id)
+        if not leilao_info or leilao_info['status'] != 'ativo':
+            return False
+        leilao_info['status'] = 'encerrado'
+        lances_maximos.pop(leilao_id, None)
+        diario.registrar('f', leilao_id)
+        vencedor = leilao_info.get('vencedor')
+        valor = leilao_info.get('maior_lance', 0)
+
+        print(f"\n[{origem}] Leilão {leilao_id} ENCERRADO.")
+
+        # Se houver vencedor, publica o evento
+        if vencedor:
+            print(f"  - Vencedor: {vencedor} com R${valor:.2f}")
+            evento_vencedor = {
+                "id_leilao": leilao_id, 
+                "id_vencedor": vencedor, 
+                "valor": valor 
+            }
+            outbox.registrar('leilao.vencedor', evento_vencedor)
+        else:
+            print("  - Leilão terminou sem lances/vencedor.")
+    return True
+
 def processar_leilao_finalizado(leilao):
-    leilao_id = leilao.get('id_leilao')
-    
-    with leiloes_lock: # Protege o acesso
-        if leilao_id in leiloes_ativos:
-            leilao_info = leiloes_ativos[leilao_id]
-            leilao_info['status'] = 'encerrado'
-            vencedor = leilao_info.get('vencedor')
-            valor = leilao_info.get('maior_lance', 0)
-            
-            print(f"\n[SUB] Leilão {leilao_id} ENCERRADO.")
-            
-            # Se houver vencedor, publica o evento
-            if vencedor:
-                print(f"  - Vencedor: {vencedor} com R${valor:.2f}")
-                evento_vencedor = {
-                    "id_leilao": leilao_id, 
-                    "id_vencedor": vencedor, 
-                    "valor": valor 
-                }
-                publicar_evento('leilao.vencedor', evento_vencedor)
-                print("  - Leilão terminou sem lances/vencedor.")
-
-def callback_geral(ch, method, properties, body):
-    routing_key = method.routing_key
-    mensagem = json.loads(body.decode())
-    
+    # Normalmente o prazo local já encerrou; o evento cobre leilões sem 'fim' e relógio atrasado
+    encerrar_leilao(leilao.get('id_leilao'), 'SUB')
+
+prazos = PrazosLeiloes(lambda leilao_id: encerrar_leilao(leilao_id, 'PRAZO'))
+
+def processar_evento(routing_key, mensagem):
+    if adiar_se_em_transferencia(processar_evento, routing_key, mensagem, mensagem.get('id_leilao')):
+        return # Entrega atrasada de partição cedida, ou adiado até a transferência terminar
+    routing_key = rota_base(routing_key)
     if routing_key == 'leilao.iniciado':
         processar_leilao_iniciado(mensagem)
     elif routing_key == 'leilao.finalizado':
         processar_leilao_finalizado(mensagem)
-    
-    ch.basic_ack(delivery_tag=method.delivery_tag)
 
-def iniciar_consumidor_rabbitmq():
-    """Roda em uma thread separada para consumir eventos do RabbitMQ."""
-    print("[*] Iniciando thread de consumo RabbitMQ...")
-    try:
-        credentials = pika.PlainCredentials(RABBITMQ_USER, RABBITMQ_PASS)
-        connection = pika.BlockingConnection(pika.ConnectionParameters(host=RABBITMQ_HOST, credentials=credentials))
-        channel = connection.channel()
-
-        channel.exchange_declare(exchange=EXCHANGE_NAME, exchange_type='topic')
-        result = channel.queue_declare(queue='', exclusive=True)
-        queue_name = result.method.queue
-
-        for key in BINDING_KEYS:
-            channel.queue_bind(exchange=EXCHANGE_NAME, queue=queue_name, routing_key=key)
-        
-        print(f'[*] MS Lance escutando por eventos: {BINDING_KEYS}.')
-        channel.basic_consume(queue=queue_name, on_message_callback=callback_geral)
-        channel.start_consuming()
-    except Exception as e:
-        print(f"[!] Thread RabbitMQ falhou: {e}")
+# Fila nomeada e durável: eventos do ciclo de vida não se perdem durante um reinício.
+# Cada réplica liga só as routing keys das suas partições (leilao.iniciado.p<k>).
+consumidor_eventos = ConsumidorEventos(
+    RABBITMQ_HOST, RABBITMQ_USER, RABBITMQ_PASS, EXCHANGE_NAME, FILA_EVENTOS, chaves_eventos(particoes_proprias),
+    processar_evento, nome='ms-lance', prefetch=CONSUMO_PREFETCH,
+    universo_bindings=chaves_eventos(range(NUM_PARTICOES)))
+
+# --- Consumo de comandos de lance (modo assíncrono) ---
+
+stats_comandos = {"aceitos": 0, "rejeitados": 0, "assinatura_invalida": 0, "reencaminhados": 0}
+stats_comandos_lock = threading.Lock()
+
+def processar_comando_lance(routing_key, comando):
+    """Confere a assinatura e decide o lance; o veredito segue pelo outbox."""
+    dados = comando.get('lance') if isinstance(comando, dict) else None
+    if not isinstance(dados, dict) or not verificar(dados, comando.get('assinatura'), LANCE_SEGREDO):
+        resultado = 'assinatura_invalida'
+        print("  [!] Comando de lance com assinatura inválida descartado.")
+    elif adiar_se_em_transferencia(processar_comando_lance, routing_key, comando, dados.get('id_leilao')):
+        return
+    else:
+        erro = decidir_lance(dados, chave_idempotencia(dados), via_fila=True) # id_lance: reentregas não viram lance novo
+        if erro == ERRO_PARTICAO:
+            # Partição cedida depois da publicação: reencaminha pela exchange ao novo dono
+            publicador.publicar(routing_key, comando)
+            resultado = 'reencaminhados'
+        else:
+            resultado = 'rejeitados' if erro else 'aceitos'
+    with stats_comandos_lock:
+        stats_comandos[resultado] += 1
+
+# Fila durável da réplica, ligada aos comandos das suas partições (lance.comando.p<k>)
+consumidor_comandos = ConsumidorEventos(
+    RABBITMQ_HOST, RABBITMQ_USER, RABBITMQ_PASS, EXCHANGE_NAME, FILA_COMANDOS_LANCE, chaves_comandos(particoes_proprias),
+    processar_comando_lance, nome='ms-lance-comandos', prefetch=LANCE_PREFETCH, tamanho_lote=LANCE_LOTE,
+    intervalo_lote=INTERVALO_LOTE, universo_bindings=chaves_comandos(range(NUM_PARTICOES)))
+
+# --- Agregação de rejeições (REJEICOES_MODO=agregado) ---
+
+stats_rejeicoes = {"rejeicoes_agregadas": 0, "eventos_agregados": 0}
+stats_rejeicoes_lock = threading.Lock()
+
+def publicar_rejeicoes():
+    """Troca a tabela de cada listra por uma vazia e publica um único lance.rejeicoes com o total."""
+    leiloes = []
+    for i, lock in enumerate(locks_leiloes):
+        with lock:
+            tabela, rejeicoes_por_listra[i] = rejeicoes_por_listra[i], {}
+        leiloes.extend([leilao_id, quantidade, erro] for leilao_id, (quantidade, erro) in tabela.items())
+    if not leiloes: return
+    total = sum(quantidade for _, quantidade, _ in leiloes)
+    # Só a quantidade e um erro de exemplo por leilão, em vez de uma mensagem por rejeição
+    publicador.publicar('lance.rejeicoes', {"replica": MS_LANCE_ID, "intervalo": REJEICOES_INTERVALO, "leiloes": leiloes})
+    with stats_rejeicoes_lock:
+        stats_rejeicoes['rejeicoes_agregadas'] += total
+        stats_rejeicoes['eventos_agregados'] += 1
+
+def loop_rejeicoes():
+    while True:
+        time.sleep(REJEICOES_INTERVALO)
+        try:
+            publicar_rejeicoes()
+        except Exception as e:
+            print(f"  [!] Erro ao publicar rejeições agregadas: {e}")
 
 # --- Ponto de entrada ---
 if __name__ == '__main__':
-    # Inicia o consumidor RabbitMQ em uma thread separada
-    thread_rabbitmq = threading.Thread(target=iniciar_consumidor_rabbitmq)
-    thread_rabbitmq.daemon = True # Permite que o programa feche mesmo se a thread estiver rodando
-    thread_rabbitmq.start()
+    # Estado anterior a um reinício: snapshot + diário, antes de aceitar eventos e lances
+    diario.recuperar()
+    diario.iniciar()
+    # Prazos dos leilões recuperados; os que venceram com o serviço fora encerram já
+    prazos.agendar_lote([(leilao_id, info.get('fim')) for leilao_id, info in leiloes_ativos.items()
+                         if info['status'] == 'ativo'])
+    prazos.iniciar()
+
+    # Consumidores RabbitMQ em threads próprias (reconectam sozinhos)
+    consumidor_eventos.iniciar()
+    consumidor_comandos.iniciar()
+    if REJEICOES_MODO == 'agregado':
+        threading.Thread(target=loop_rejeicoes, daemon=True).start()
     
     # Inicia o servidor Flask na thread principal
-    print("[*] Iniciando servidor Flask (porta 5002)...")
-    app.run(port=5002, debug=True, use_reloader=False)
\ No newline at end of file
+    print(f"[*] {MS_LANCE_ID}: {len(particoes_proprias)}/{NUM_PARTICOES} partições. Iniciando servidor Flask (porta {MS_LANCE_PORTA})...")
+    app.run(port=MS_LANCE_PORTA, debug=True, use_reloader=False)
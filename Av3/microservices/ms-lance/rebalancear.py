@@ -0,0 +1,32 @@
+# /microservices/ms-lance/rebalancear.py
+#
+# Rebalanceia as partições do MS Lance pelo Gateway (PUT /particoes/ms-lance),
+# assinando o pedido com PARTICOES_SEGREDO. As réplicas precisam estar em
+# MS_LANCE_PERMITIDAS no Gateway.
+#
+#   PARTICOES_SEGREDO=... python rebalancear.py "ms-lance-0=http://127.0.0.1:5002,ms-lance-1=http://127.0.0.1:5012"
+
+import os
+import sys
+import json
+import argparse
+import requests
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from comum.assinatura import assinar_pedido
+from comum.particionamento import ler_replicas
+
+def main():
+    parser = argparse.ArgumentParser(description="Rebalanceia as partições do MS Lance")
+    parser.add_argument('replicas', help="id=url,id=url,... (o novo conjunto completo)")
+    parser.add_argument('--gateway-url', default="http://127.0.0.1:5000")
+    args = parser.parse_args()
+
+    segredo = os.environ.get('PARTICOES_SEGREDO', 'segredo-dev-particoes').encode()
+    corpo, headers = assinar_pedido({"replicas": ler_replicas(args.replicas)}, segredo)
+    resposta = requests.put(f"{args.gateway_url}/particoes/ms-lance", json=corpo, headers=headers, timeout=120)
+    print(f"[rebalancear] {resposta.status_code}")
+    print(json.dumps(resposta.json(), indent=2, ensure_ascii=False))
+
+if __name__ == '__main__':
+    main()
@@ -1,149 +1,721 @@
 # /microservices/ms-leilao/ms-leilao.py
 
-import pika
+import os
+import sys
 import json
+import math
 import time
+import heapq
+import queue
+import bisect
+import sqlite3
 import threading
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 from datetime import datetime, timezone
+from collections import defaultdict
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from comum.publicador import PublicadorEventos
+from comum.consumidor import ConsumidorEventos
+from comum.particionamento import rota_particionada
 
 # --- Configurações ---
 RABBITMQ_HOST = '127.0.0.1'
 RABBITMQ_USER = 'user'
 RABBITMQ_PASS = 'password'
 EXCHANGE_NAME = 'leilao_topic_exchange'
+CONFIRMAR_PUBLICACAO = os.environ.get('CONFIRMAR_PUBLICACAO') == '1' # Confirmação do broker por lote
+
+# Banco SQLite (modo WAL) ao lado deste arquivo; sobrevive a reinícios do serviço
+DB_PATH = os.environ.get('MS_LEILAO_DB', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'leiloes.db'))
+MAX_LOTE_COMMIT = 1000 # Máximo de escritas agrupadas em uma única transação
+
+MAX_LOTE_LEILOES = 10000 # Máximo de leilões aceitos em um POST /leiloes/lote
+
+# Paginação da listagem de leilões ativos
+LIMITE_PADRAO = 100
+LIMITE_MAXIMO = 1000
+MAX_PAGINAS_CACHE = 256 # Páginas serializadas mantidas para a versão corrente
+
+# Escuta os lances validados para manter valor_atual sem depender do Gateway
+BINDING_KEYS = ['lance.validado']
+FILA_EVENTOS = 'ms_leilao.eventos'
+CONSUMO_PREFETCH = int(os.environ.get('CONSUMO_PREFETCH', 500)) # Só atualiza memória: lotes grandes
+INTERVALO_PRECOS = 0.2 # Segundos entre aplicações de preço (rajadas viram uma escrita por leilão)
 
 #Publica 2 eventos: leilao.iniciado e leilao.finalizado
 
 app = Flask(__name__)
 
 # --- Banco em Memória ---
+# leiloes_db é a cópia de trabalho; o ArmazemLeiloes a torna durável
 leiloes_db = {}
 proximo_id_leilao = 1
 db_lock = threading.Lock() # Protege o acesso concorrente ao dicionário
 
+# --- Índices Secundários (sempre alterados sob db_lock) ---
+ids_por_status = defaultdict(set)
+ativos_por_id = []   # ids dos leilões ativos, ordenados
+ativos_por_fim = []  # (fim_ts, id_leilao) dos leilões ativos, ordenados
+
+def indexar_leilao(leilao):
+    ids_por_status[leilao['status']].add(leilao['id_leilao'])
+    if leilao['status'] == 'ativo':
+        bisect.insort(ativos_por_id, leilao['id_leilao'])
+        bisect.insort(ativos_por_fim, (leilao['fim'].timestamp(), leilao['id_leilao']))
+
+def desindexar_leilao(leilao):
+    ids_por_status[leilao['status']].discard(leilao['id_leilao'])
+    if leilao['status'] == 'ativo':
+        _remover_ordenado(ativos_por_id, leilao['id_leilao'])
+        _remover_ordenado(ativos_por_fim, (leilao['fim'].timestamp(), leilao['id_leilao']))
+
+def _remover_ordenado(lista, valor):
+    i = bisect.bisect_left(lista, valor)
+    if i < len(lista) and lista[i] == valor:
+        del lista[i]
+
+def mudar_status(leilao, novo_status):
+    """Única porta para trocar o status: mantém os índices coerentes."""
+    global versao_leiloes
+    desindexar_leilao(leilao)
+    leilao['status'] = novo_status
+    indexar_leilao(leilao)
+    versao_leiloes += 1
+
+# --- Cache da Listagem ---
+# Qualquer mudança de status ou de valor_atual incrementa a versão; a página
+# serializada só é refeita quando a versão muda. A versão também é o ETag.
+versao_leiloes = 0
+EPOCA_CACHE = int(time.time()) # Evita colisão de ETag entre reinícios do serviço
+paginas_cache = {} # (ordem, limite, cursor) -> (versao, corpo_bytes, proximo_cursor)
+
+# --- Persistência (SQLite) ---
+COLUNAS = ('id_leilao', 'nome_produto', 'descricao', 'valor_inicial', 'valor_atual', 'inicio', 'fim', 'status')
+
+class ArmazemLeiloes:
+    """
+    Persistência dos leilões em SQLite no modo WAL.
+    Todas as escritas passam por uma única thread que agrupa o que chegou
+    enquanto o commit anterior acontecia (group commit): muitos POSTs
+    simultâneos pagam um único fsync.
+    """
+
+    def __init__(self, caminho):
+        self._caminho = caminho
+        self._fila = queue.Queue()
+        conn = self._conectar()
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS leiloes (
+                id_leilao     INTEGER PRIMARY KEY,
+                nome_produto  TEXT NOT NULL,
+                descricao     TEXT NOT NULL,
+                valor_inicial REAL NOT NULL,
+                valor_atual   REAL NOT NULL,
+                inicio        REAL NOT NULL,
+                fim           REAL NOT NULL,
+                status        TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_leiloes_status ON leiloes(status);
+            CREATE INDEX IF NOT EXISTS idx_leiloes_inicio ON leiloes(inicio);
+            CREATE INDEX IF NOT EXISTS idx_leiloes_fim ON leiloes(fim);
+        """)
+        conn.close()
+        self._thread = threading.Thread(target=self._executar, daemon=True)
+
+    def _conectar(self):
+        conn = sqlite3.connect(self._caminho, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=FULL')
+        return conn
+
+    def iniciar(self):
+        self._thread.start()
+
+    # --- Escritas ---
+    def inserir(self, leilao):
+        """Grava um leilão novo e só retorna depois do commit."""
+        self._enviar("INSERT INTO leiloes VALUES (?, ?, ?, ?, ?, ?, ?, ?)", self._linha(leilao), aguardar=True)
+
+    def inserir_lote(self, leiloes):
+        """Grava vários leilões novos em uma única transação."""
+        self._enviar("INSERT INTO leiloes VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                     [self._linha(leilao) for leilao in leiloes], aguardar=True, varios=True)
+
+    def atualizar_valor(self, id_leilao, valor):
+        # Valor atual é derivado dos lances; não precisa segurar o chamador
+        self._enviar("UPDATE leiloes SET valor_atual = ? WHERE id_leilao = ?", (valor, id_leilao))
+
+    def atualizar_status(self, id_leilao, status):
+        self._enviar("UPDATE leiloes SET status = ? WHERE id_leilao = ?", (status, id_leilao))
+
+    def atualizar_agenda(self, id_leilao, inicio, fim):
+        self._enviar("UPDATE leiloes SET inicio = ?, fim = ? WHERE id_leilao = ?",
+                     (inicio.timestamp(), fim.timestamp(), id_leilao), aguardar=True)
+
+    def _enviar(self, sql, params, aguardar=False, varios=False):
+        pedido = {"sql": sql, "params": params, "varios": varios,
+                  "feito": threading.Event() if aguardar else None, "erro": None}
+        self._fila.put(pedido)
+        if aguardar:
+            pedido['feito'].wait()
+            if pedido['erro']:
+                raise RuntimeError(f"Falha ao persistir leilão: {pedido['erro']}")
+
+    def _executar(self):
+        conn = self._conectar()
+        while True:
+            lote = [self._fila.get()]
+            try:
+                while len(lote) < MAX_LOTE_COMMIT:
+                    lote.append(self._fila.get_nowait())
+            except queue.Empty:
+                pass
+
+            try:
+                with conn:
+                    for pedido in lote:
+                        self._aplicar(conn, pedido)
+            except sqlite3.Error:
+                # Uma escrita ruim não pode derrubar o lote inteiro: refaz uma a uma
+                for pedido in lote:
+                    try:
+                        with conn:
+                            self._aplicar(conn, pedido)
+                    except sqlite3.Error as e:
+                        pedido['erro'] = str(e)
+                        print(f"Erro ao persistir leilão: {e}")
+
+            for pedido in lote:
+                if pedido['feito']:
+                    pedido['feito'].set()
+
+    @staticmethod
+    def _aplicar(conn, pedido):
+        if pedido['varios']:
+            conn.executemany(pedido['sql'], pedido['params'])
+        else:
+            conn.execute(pedido['sql'], pedido['params'])
+
+    # --- Leitura (boot) ---
+    def carregar_pendentes(self):
+        """Retorna (leilões agendados/ativos, maior id já usado)."""
+        conn = self._conectar()
+        try:
+            maior_id = conn.execute("SELECT COALESCE(MAX(id_leilao), 0) FROM leiloes").fetchone()[0]
+            linhas = conn.execute(
+                f"SELECT {', '.join(COLUNAS)} FROM leiloes WHERE status IN ('agendado', 'ativo')"
+            ).fetchall()
+        finally:
+            conn.close()
+        return [self._leilao(linha) for linha in linhas], maior_id
+
+    @staticmethod
+    def _linha(leilao):
+        return (leilao['id_leilao'], leilao['nome_produto'], leilao['descricao'],
+                leilao['valor_inicial'], leilao['valor_atual'],
+                leilao['inicio'].timestamp(), leilao['fim'].timestamp(), leilao['status'])
+
+    @staticmethod
+    def _leilao(linha):
+        leilao = dict(zip(COLUNAS, linha))
+        leilao['inicio'] = datetime.fromtimestamp(leilao['inicio'], timezone.utc)
+        leilao['fim'] = datetime.fromtimestamp(leilao['fim'], timezone.utc)
+        return leilao
+
+armazem = ArmazemLeiloes(DB_PATH)
+
 # --- Publicação (Apenas Publisher) ---
+publicador = PublicadorEventos(RABBITMQ_HOST, RABBITMQ_USER, RABBITMQ_PASS, EXCHANGE_NAME,
+                               nome='ms-leilao', confirmar=CONFIRMAR_PUBLICACAO)
+
 def publicar_evento(routing_key: str, evento: dict):
-    try:
-        creds = pika.PlainCredentials(RABBITMQ_USER, RABBITMQ_PASS)
-        conn = pika.BlockingConnection(pika.ConnectionParameters(host=RABBITMQ_HOST, credentials=creds))
-        channel = conn.channel()
-        channel.exchange_declare(exchange=EXCHANGE_NAME, exchange_type='topic')
-        
-        evento_serializavel = evento.copy()
-        for key, value in evento_serializavel.items():
-            if isinstance(value, datetime):
-                evento_serializavel[key] = value.isoformat()
-
-        channel.basic_publish(
-            exchange=EXCHANGE_NAME,
-            routing_key=routing_key,
-            body=json.dumps(evento_serializavel),
-            properties=pika.BasicProperties(delivery_mode=2)
-        )
-        print(f" [x] Evento '{routing_key}' publicado.")
-        conn.close()
-    except Exception as e:
-        print(f"Erro ao publicar evento: {e}")
+    evento_serializavel = evento.copy()
+    for key, value in evento_serializavel.items():
+        if isinstance(value, datetime):
+            evento_serializavel[key] = value.isoformat()
+
+    publicador.publicar(routing_key, evento_serializavel)
+    print(f" [x] Evento '{routing_key}' enfileirado.")
 
 # --- Agendamento de Ciclo de Vida ---
-def agendar_leilao(id_leilao):
-    try:
+INICIAR = 0   # A ordem numérica garante que o início sai antes do fim no mesmo instante
+FINALIZAR = 1
+
+class AgendadorCicloVida:
+    """
+    Agendador único para o início/fim de todos os leilões.
+    Uma só thread dorme até o próximo prazo de um min-heap de
+    (prazo, id_leilao, transicao, versao), então o número de threads
+    não cresce com o número de leilões agendados.
+    """
+
+    def __init__(self, ao_disparar):
+        self._ao_disparar = ao_disparar  # callback(id_leilao, transicao)
+        self._heap = []
+        self._agendados = {}  # id_leilao -> [versao, entradas_restantes]
+        self._entradas_obsoletas = 0
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._executar, daemon=True)
+
+    def iniciar(self):
+        self._thread.start()
+
+    def agendar(self, id_leilao, inicio, fim):
+        """Agenda (ou reagenda) as transições de um leilão."""
+        self.agendar_lote([(id_leilao, inicio, fim)])
+
+    def agendar_lote(self, itens):
+        """Agenda vários leilões de uma vez: [(id_leilao, inicio, fim), ...]."""
+        with self._cond:
+            novas = []
+            for id_leilao, inicio, fim in itens:
+                versao = self._descartar(id_leilao) + 1
+                self._agendados[id_leilao] = [versao, 2]
+                novas.append((inicio.timestamp(), id_leilao, INICIAR, versao))
+                novas.append((fim.timestamp(), id_leilao, FINALIZAR, versao))
+            if len(novas) > 64:
+                # Lotes grandes (boot, criação em massa): heapify O(n) em vez de n pushes
+                self._heap.extend(novas)
+                heapq.heapify(self._heap)
+            else:
+                for entrada in novas:
+                    heapq.heappush(self._heap, entrada)
+            self._compactar_se_necessario()
+            self._cond.notify()
+
+    def cancelar(self, id_leilao):
+        """Descarta as transições pendentes de um leilão. Retorna False se não havia nenhuma."""
+        with self._cond:
+            if id_leilao not in self._agendados:
+                return False
+            self._descartar(id_leilao)
+            self._compactar_se_necessario()
+            self._cond.notify()
+            return True
+
+    def profundidade(self):
+        """Quantidade de transições válidas na fila e tamanho físico do heap."""
+        with self._cond:
+            pendentes = sum(restantes for _, restantes in self._agendados.values())
+            return {"pendentes": pendentes, "leiloes": len(self._agendados), "heap": len(self._heap)}
+
+    def _descartar(self, id_leilao):
+        # Remoção preguiçosa: as entradas continuam no heap, mas com versão velha
+        versao, restantes = self._agendados.pop(id_leilao, [0, 0])
+        self._entradas_obsoletas += restantes
+        return versao
+
+    def _compactar_se_necessario(self):
+        if self._entradas_obsoletas > 1024 and self._entradas_obsoletas * 2 > len(self._heap):
+            self._heap = [e for e in self._heap if self._valida(e)]
+            heapq.heapify(self._heap)
+            self._entradas_obsoletas = 0
+
+    def _valida(self, entrada):
+        agendado = self._agendados.get(entrada[1])
+        return agendado is not None and agendado[0] == entrada[3]
+
+    def _retirar_topo(self):
+        _, id_leilao, transicao, _ = heapq.heappop(self._heap)
+        agendado = self._agendados[id_leilao]
+        agendado[1] -= 1
+        if agendado[1] == 0:
+            del self._agendados[id_leilao]
+        return id_leilao, transicao
+
+    def _executar(self):
+        while True:
+            with self._cond:
+                while True:
+                    if not self._heap:
+                        self._cond.wait()
+                        continue
+                    entrada = self._heap[0]
+                    if not self._valida(entrada):
+                        heapq.heappop(self._heap)
+                        self._entradas_obsoletas -= 1
+                        continue
+                    espera = entrada[0] - time.time()
+                    if espera <= 0:
+                        id_leilao, transicao = self._retirar_topo()
+                        break
+                    self._cond.wait(espera) # acorda antes se algo mais cedo for agendado
+            try:
+                self._ao_disparar(id_leilao, transicao)
+            except Exception as e:
+                print(f"Erro no agendador (leilão {id_leilao}): {e}")
+
+def disparar_transicao(id_leilao, transicao):
+    if transicao == INICIAR:
         with db_lock:
             leilao = leiloes_db.get(id_leilao)
-        if not leilao: return
-
-        agora = datetime.now(timezone.utc)
-        
-        # 1. Espera iniciar
-        tempo_para_iniciar = (leilao['inicio'] - agora).total_seconds()
-        if tempo_para_iniciar > 0:
-            time.sleep(tempo_para_iniciar) # dorme até o início do leilão
-        
-        # 2. Inicia
-        with db_lock: leilao['status'] = 'ativo'
+            if not leilao or leilao['status'] != 'agendado': return
+            mudar_status(leilao, 'ativo')
+            evento = leilao.copy()
+        armazem.atualizar_status(id_leilao, 'ativo')
         print(f"Leilão {id_leilao} INICIADO.")
-        publicar_evento('leilao.iniciado', leilao)
-        
-        # 3. Espera finalizar
-        agora = datetime.now(timezone.utc) 
-        tempo_para_finalizar = (leilao['fim'] - agora).total_seconds()
-        if tempo_para_finalizar > 0:
-            time.sleep(tempo_para_finalizar)
-
-        # 4. Finaliza
-        with db_lock: leilao['status'] = 'encerrado'
+        # Routing key com a partição (leilao.iniciado.p<k>): cada réplica do MS Lance só liga as suas.
+        # O evento leva inicio/fim: o MS Lance encerra o leilão pelo próprio relógio, sem esperar o finalizado
+        publicar_evento(rota_particionada('leilao.iniciado', id_leilao), evento)
+    else:
+        with db_lock:
+            leilao = leiloes_db.get(id_leilao)
+            if not leilao or leilao['status'] != 'ativo': return
+            mudar_status(leilao, 'encerrado')
+        armazem.atualizar_status(id_leilao, 'encerrado')
         print(f"Leilão {id_leilao} FINALIZADO.")
-        publicar_evento('leilao.finalizado', {"id_leilao": leilao['id_leilao']})
+        publicar_evento(rota_particionada('leilao.finalizado', id_leilao), {"id_leilao": id_leilao})
 
-    except Exception as e:
-        print(f"Erro na thread do leilão {id_leilao}: {e}")
+agendador = AgendadorCicloVida(disparar_transicao)
+
+def carregar_estado():
+    """Recarrega os leilões pendentes do disco e rearma o agendador."""
+    global proximo_id_leilao
+    t0 = time.perf_counter()
+    pendentes, maior_id = armazem.carregar_pendentes()
+    with db_lock:
+        for leilao in pendentes:
+            leiloes_db[leilao['id_leilao']] = leilao
+            indexar_leilao(leilao)
+        proximo_id_leilao = maior_id + 1
+    agendador.agendar_lote([(l['id_leilao'], l['inicio'], l['fim']) for l in pendentes])
+    print(f"[*] {len(pendentes)} leilões pendentes recarregados em {(time.perf_counter() - t0) * 1000:.0f} ms.")
+
+# --- Atualização de Preço por Eventos (lance.validado) ---
+precos_pendentes = {}     # id_leilao -> (seq, valor) mais recente recebido neste tick
+precos_lock = threading.Lock()
+ultimo_seq_aplicado = {}  # id_leilao -> seq_leilao do último preço aplicado (sob db_lock)
+
+def receber_lance_validado(evento):
+    """Guarda só o preço mais recente de cada leilão até o próximo tick."""
+    id_leilao = evento.get('id_leilao')
+    if id_leilao is None or evento.get('valor') is None: return
+    # seq_leilao é por leilão e segue o leilão entre réplicas do MS Lance;
+    # o 'seq' do outbox é por processo e não serve para comparar entre elas
+    seq = evento.get('seq_leilao', 0)
+    with precos_lock:
+        pendente = precos_pendentes.get(id_leilao)
+        if pendente is None or seq >= pendente[0]:
+            precos_pendentes[id_leilao] = (seq, float(evento['valor']))
+
+def aplicar_precos_pendentes():
+    global precos_pendentes, versao_leiloes
+    with precos_lock:
+        lote, precos_pendentes = precos_pendentes, {}
+    if not lote: return
+
+    aplicados = []
+    with db_lock:
+        for id_leilao, (seq, valor) in lote.items():
+            leilao = leiloes_db.get(id_leilao)
+            # Descarta evento atrasado: um seq maior já foi aplicado
+            if not leilao or seq < ultimo_seq_aplicado.get(id_leilao, -1): continue
+            ultimo_seq_aplicado[id_leilao] = seq
+            leilao['valor_atual'] = valor
+            aplicados.append((id_leilao, valor))
+        if aplicados:
+            versao_leiloes += 1
+    for id_leilao, valor in aplicados:
+        armazem.atualizar_valor(id_leilao, valor)
+    if aplicados:
+        print(f" [SUB] Preço atualizado em {len(aplicados)} leilão(ões).")
+
+def loop_precos():
+    while True:
+        time.sleep(INTERVALO_PRECOS)
+        try:
+            aplicar_precos_pendentes()
+        except Exception as e:
+            print(f"Erro ao aplicar preços: {e}")
+
+def processar_evento(routing_key, evento):
+    if routing_key == 'lance.validado':
+        receber_lance_validado(evento)
+
+# Fila nomeada e durável: lances validados com o MS Leilão fora do ar são aplicados ao voltar
+consumidor = ConsumidorEventos(RABBITMQ_HOST, RABBITMQ_USER, RABBITMQ_PASS, EXCHANGE_NAME,
+                               FILA_EVENTOS, BINDING_KEYS, processar_evento,
+                               nome='ms-leilao', prefetch=CONSUMO_PREFETCH, tamanho_lote=200)
 
 # --- Endpoints REST ---
 
+CAMPOS_LEILAO = ('nome_produto', 'descricao', 'valor_inicial', 'inicio', 'fim') # Obrigatórios no POST /leiloes
+
+def montar_leilao(dados):
+    """
+    Valida o JSON de criação e monta o registro (sem id). Lança ValueError se inválido.
+    Tipos e campos obrigatórios são conferidos aqui: um item que o SQLite recusaria
+    (NOT NULL, tipo não suportado) derrubaria o executemany do lote inteiro.
+    """
+    if not isinstance(dados, dict):
+        raise ValueError("Cada leilão deve ser um objeto JSON")
+    faltando = [campo for campo in CAMPOS_LEILAO if dados.get(campo) is None]
+    if faltando:
+        raise ValueError(f"Campos obrigatórios: {', '.join(faltando)}")
+    for campo in ('nome_produto', 'descricao', 'inicio', 'fim'):
+        if not isinstance(dados[campo], str):
+            raise ValueError(f"{campo} deve ser texto")
+    if not dados['nome_produto'].strip():
+        raise ValueError("nome_produto não pode ser vazio")
+    valor_inicial = dados['valor_inicial']
+    try:
+        if isinstance(valor_inicial, bool) or not isinstance(valor_inicial, (int, float, str)):
+            raise ValueError
+        valor_inicial = float(valor_inicial)
+    except ValueError:
+        raise ValueError("valor_inicial deve ser numérico")
+    if not math.isfinite(valor_inicial) or valor_inicial < 0:
+        raise ValueError("valor_inicial deve ser um número finito e não negativo")
+
+    # Tratamento de fuso horário
+    inicio_dt = datetime.fromisoformat(dados['inicio'].replace('Z', '+00:00'))
+    fim_dt = datetime.fromisoformat(dados['fim'].replace('Z', '+00:00'))
+
+    return {
+        "id_leilao": None, # Definido sob o lock
+        "nome_produto": dados['nome_produto'],
+        "descricao": dados['descricao'],
+        "valor_inicial": valor_inicial,
+        "valor_atual": valor_inicial, # Inicializa igual ao inicial
+        "inicio": inicio_dt,
+        "fim": fim_dt,
+        "status": "agendado"
+    }
+
+def registrar_leiloes(novos):
+    """Atribui ids e indexa os leilões sob uma única aquisição do lock."""
+    global proximo_id_leilao
+    with db_lock:
+        for leilao in novos:
+            leilao['id_leilao'] = proximo_id_leilao
+            leiloes_db[leilao['id_leilao']] = leilao
+            indexar_leilao(leilao)
+            proximo_id_leilao += 1
+
+def desfazer_registro(novos):
+    with db_lock:
+        for leilao in novos:
+            desindexar_leilao(leiloes_db.pop(leilao['id_leilao']))
+
 @app.route('/leiloes', methods=['POST'])
 def criar_leilao():
-    global proximo_id_leilao
     dados = request.json
 
     try:
-        # Tratamento de fuso horário
-        inicio_dt = datetime.fromisoformat(dados['inicio'].replace('Z', '+00:00'))
-        fim_dt = datetime.fromisoformat(dados['fim'].replace('Z', '+00:00'))
-
-        novo_leilao = {
-            "id_leilao": proximo_id_leilao,
-            "nome_produto": dados['nome_produto'],
-            "descricao": dados['descricao'],
-            "valor_inicial": float(dados['valor_inicial']),
-            "valor_atual": float(dados['valor_inicial']), # Inicializa igual ao inicial
-            "inicio": inicio_dt,
-            "fim": fim_dt,
-            "status": "agendado"
-        }
-        
-        with db_lock:
-            leiloes_db[novo_leilao['id_leilao']] = novo_leilao
-            proximo_id_leilao += 1
-        
-        thread_leilao = threading.Thread(target=agendar_leilao, args=(novo_leilao['id_leilao'],))
-        thread_leilao.start()
-        
-        return jsonify({"msg": "Leilão agendado", "id": novo_leilao['id_leilao']}), 201
-        
+        novo_leilao = montar_leilao(dados)
     except Exception as e:
         return jsonify({"erro": str(e)}), 400
 
+    registrar_leiloes([novo_leilao])
+
+    try:
+        armazem.inserir(novo_leilao)
+    except RuntimeError as e:
+        desfazer_registro([novo_leilao])
+        return jsonify({"erro": str(e)}), 500
+
+    agendador.agendar(novo_leilao['id_leilao'], novo_leilao['inicio'], novo_leilao['fim'])
+
+    return jsonify({"msg": "Leilão agendado", "id": novo_leilao['id_leilao']}), 201
+
+@app.route('/leiloes/lote', methods=['POST'])
+def criar_leiloes_lote():
+    """
+    Cria vários leilões de uma vez.
+    JSON esperado: {"leiloes": [<mesmo formato de POST /leiloes>, ...]}
+    Itens inválidos são rejeitados individualmente; os válidos entram juntos
+    (um lock, uma transação, um lote no agendador).
+    """
+    dados = request.get_json(silent=True)
+    itens = dados.get('leiloes') if isinstance(dados, dict) else None
+    if not isinstance(itens, list) or not itens:
+        return jsonify({"erro": "Envie uma lista não vazia em 'leiloes'"}), 400
+    if len(itens) > MAX_LOTE_LEILOES:
+        return jsonify({"erro": f"Máximo de {MAX_LOTE_LEILOES} leilões por lote"}), 413
+
+    resultados = [None] * len(itens)
+    novos = []
+    for indice, item in enumerate(itens):
+        try:
+            novos.append((indice, montar_leilao(item)))
+        except Exception as e:
+            resultados[indice] = {"indice": indice, "erro": str(e)}
+
+    leiloes = [leilao for _, leilao in novos]
+    if leiloes:
+        registrar_leiloes(leiloes)
+        try:
+            armazem.inserir_lote(leiloes)
+        except RuntimeError as e:
+            desfazer_registro(leiloes)
+            return jsonify({"erro": str(e)}), 500
+        agendador.agendar_lote([(l['id_leilao'], l['inicio'], l['fim']) for l in leiloes])
+
+    for indice, leilao in novos:
+        resultados[indice] = {"indice": indice, "id": leilao['id_leilao']}
+
+    print(f" [REST] Lote: {len(leiloes)} leilões agendados, {len(itens) - len(leiloes)} rejeitados.")
+    status = 201 if leiloes else 400
+    return jsonify({"criados": len(leiloes), "rejeitados": len(itens) - len(leiloes), "resultados": resultados}), status
+
+def vista_publica(leilao):
+    return {
+        "id_leilao": leilao['id_leilao'],
+        "nome_produto": leilao['nome_produto'],
+        "descricao": leilao['descricao'],
+        "valor_inicial": leilao['valor_inicial'],
+        "valor_atual": leilao['valor_atual'], # Retorna o valor atualizado
+        "inicio": leilao['inicio'].isoformat(),
+        "fim": leilao['fim'].isoformat(),
+    }
+
+def ler_cursor(ordem, cursor):
+    """Converte o cursor opaco da listagem na chave de ordenação correspondente."""
+    if ordem == 'fim':
+        fim_ts, id_leilao = cursor.split('_')
+        return (float(fim_ts), int(id_leilao))
+    return int(cursor)
+
+def gerar_cursor(ordem, chave):
+    if ordem == 'fim':
+        return f"{chave[0]!r}_{chave[1]}"
+    return str(chave)
+
 @app.route('/leiloes/ativos', methods=['GET'])
 def consultar_leiloes_ativos():
+    """
+    Lista leilões ativos paginados por cursor.
+    Query: limit (padrão 100), ordem ('id' ou 'fim' = encerrando primeiro), cursor.
+    O cursor da próxima página vem no cabeçalho X-Proximo-Cursor.
+    Responde 304 quando If-None-Match bate com a versão corrente.
+    """
+    ordem = request.args.get('ordem', 'id')
+    if ordem not in ('id', 'fim'):
+        return jsonify({"erro": "ordem deve ser 'id' ou 'fim'"}), 400
+    try:
+        limite = min(max(int(request.args.get('limit', LIMITE_PADRAO)), 1), LIMITE_MAXIMO)
+        cursor = request.args.get('cursor')
+        chave_cursor = ler_cursor(ordem, cursor) if cursor else None
+    except ValueError:
+        return jsonify({"erro": "limit ou cursor inválido"}), 400
+
+    chave_cache = (ordem, limite, cursor)
+    indice = ativos_por_fim if ordem == 'fim' else ativos_por_id
     leiloes_ativos = []
+    proximo_cursor = None
     with db_lock:
-        for leilao in leiloes_db.values():
-            if leilao['status'] == 'ativo':
-                leiloes_ativos.append({
-                    "id_leilao": leilao['id_leilao'],
-                    "nome_produto": leilao['nome_produto'],
-                    "descricao": leilao['descricao'],
-                    "valor_inicial": leilao['valor_inicial'],
-                    "valor_atual": leilao['valor_atual'], # Retorna o valor atualizado
-                    "inicio": leilao['inicio'].isoformat(),
-                    "fim": leilao['fim'].isoformat(),
-                })
-    return jsonify(leiloes_ativos), 200
-
-# Novo Endpoint para receber atualização do Gateway
+        versao = versao_leiloes
+        tag = f"{EPOCA_CACHE}-{versao}"
+        etag = f'"{tag}"'
+        if request.if_none_match.contains(tag):
+            return Response(status=304, headers={'ETag': etag})
+        em_cache = paginas_cache.get(chave_cache)
+        if em_cache and em_cache[0] == versao:
+            return resposta_listagem(em_cache[1], etag, em_cache[2])
+
+        inicio = bisect.bisect_right(indice, chave_cursor) if chave_cursor is not None else 0
+        pagina = indice[inicio:inicio + limite]
+        for chave in pagina:
+            leilao = leiloes_db[chave[1] if ordem == 'fim' else chave]
+            leiloes_ativos.append(vista_publica(leilao))
+        if pagina and inicio + limite < len(indice):
+            proximo_cursor = gerar_cursor(ordem, pagina[-1])
+
+    # Serializa fora do lock; a página fica guardada até a próxima mudança de versão
+    corpo = json.dumps(leiloes_ativos).encode()
+    with db_lock:
+        if versao == versao_leiloes:
+            if len(paginas_cache) >= MAX_PAGINAS_CACHE:
+                paginas_cache.clear()
+            paginas_cache[chave_cache] = (versao, corpo, proximo_cursor)
+    return resposta_listagem(corpo, etag, proximo_cursor)
+
+def resposta_listagem(corpo, etag, proximo_cursor):
+    headers = {'ETag': etag}
+    if proximo_cursor:
+        headers['X-Proximo-Cursor'] = proximo_cursor
+    return Response(corpo, status=200, mimetype='application/json', headers=headers)
+
+@app.route('/leiloes/<int:id_leilao>', methods=['GET'])
+def consultar_leilao(id_leilao):
+    with db_lock:
+        leilao = leiloes_db.get(id_leilao)
+        if not leilao:
+            return jsonify({"erro": "leilao nao encontrado"}), 404
+        # seq_leilao do preço em valor_atual: o Gateway não troca um preço mais novo por este
+        vista = dict(vista_publica(leilao), status=leilao['status'], seq_leilao=ultimo_seq_aplicado.get(id_leilao, 0))
+    return jsonify(vista), 200
+
+# Atualização manual do valor (o fluxo normal vem de lance.validado)
 @app.route('/leiloes/<int:id_leilao>', methods=['PATCH'])
 def atualizar_valor_leilao(id_leilao):
+    global versao_leiloes
     dados = request.json
     novo_valor = dados.get('valor')
     
     with db_lock:
         if id_leilao in leiloes_db:
             leiloes_db[id_leilao]['valor_atual'] = float(novo_valor)
+            versao_leiloes += 1
+            armazem.atualizar_valor(id_leilao, float(novo_valor))
             print(f" [REST] Valor do leilão {id_leilao} atualizado para R${novo_valor}")
             return jsonify({"status": "atualizado"}), 200
         else:
             return jsonify({"erro": "leilao nao encontrado"}), 404
 
+@app.route('/leiloes/<int:id_leilao>', methods=['DELETE'])
+def cancelar_leilao(id_leilao):
+    with db_lock:
+        leilao = leiloes_db.get(id_leilao)
+        if not leilao:
+            return jsonify({"erro": "leilao nao encontrado"}), 404
+        if leilao['status'] != 'agendado':
+            return jsonify({"erro": "apenas leilões agendados podem ser cancelados"}), 409
+        mudar_status(leilao, 'cancelado')
+    agendador.cancelar(id_leilao)
+    armazem.atualizar_status(id_leilao, 'cancelado')
+    return jsonify({"status": "cancelado"}), 200
+
+@app.route('/leiloes/<int:id_leilao>/agenda', methods=['PUT'])
+def reagendar_leilao(id_leilao):
+    dados = request.json
+    try:
+        inicio_dt = datetime.fromisoformat(dados['inicio'].replace('Z', '+00:00'))
+        fim_dt = datetime.fromisoformat(dados['fim'].replace('Z', '+00:00'))
+    except Exception as e:
+        return jsonify({"erro": str(e)}), 400
+
+    with db_lock:
+        leilao = leiloes_db.get(id_leilao)
+        if not leilao:
+            return jsonify({"erro": "leilao nao encontrado"}), 404
+        if leilao['status'] != 'agendado':
+            return jsonify({"erro": "apenas leilões agendados podem ser reagendados"}), 409
+        leilao['inicio'] = inicio_dt
+        leilao['fim'] = fim_dt
+    armazem.atualizar_agenda(id_leilao, inicio_dt, fim_dt)
+    agendador.agendar(id_leilao, inicio_dt, fim_dt)
+    return jsonify({"status": "reagendado"}), 200
+
+@app.route('/metricas/publicador', methods=['GET'])
+def metricas_publicador():
+    return jsonify(publicador.estatisticas()), 200
+
+@app.route('/metricas/consumo', methods=['GET'])
+def metricas_consumo():
+    return jsonify(consumidor.estatisticas()), 200
+
+@app.route('/agendador', methods=['GET'])
+def status_agendador():
+    status = agendador.profundidade()
+    status['threads'] = threading.active_count()
+    return jsonify(status), 200
+
 if __name__ == '__main__':
+    armazem.iniciar()
+    carregar_estado()
+    agendador.iniciar()
+    threading.Thread(target=loop_precos, daemon=True).start()
+    consumidor.iniciar()
     app.run(port=5001, debug=True, use_reloader=False)
\ No newline at end of file
@@ -1,44 +1,45 @@
 # /microservices/ms-pagamento/ms-pagamento.py
 
-import pika
-import json
-import threading
+import os
+import sys
 import requests
 from flask import Flask, request, jsonify
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from comum.publicador import PublicadorEventos
+from comum.http_cliente import ClienteHTTP
+from comum.consumidor import ConsumidorEventos, ReprocessarDepois
+
 # --- Configurações ---
 RABBITMQ_HOST = '127.0.0.1'
 RABBITMQ_USER = 'user'
 RABBITMQ_PASS = 'password'
 EXCHANGE_NAME = 'leilao_topic_exchange'
+CONFIRMAR_PUBLICACAO = os.environ.get('CONFIRMAR_PUBLICACAO') == '1' # Confirmação do broker por lote
 BINDING_KEYS = ['leilao.vencedor'] # Este MS só precisa escutar por 'leilao.vencedor' 
+FILA_EVENTOS = 'ms_pagamento.eventos' # Compartilhada por todos os workers
+CONSUMO_PREFETCH = int(os.environ.get('CONSUMO_PREFETCH', 5)) # Baixo: cada vencedor faz uma chamada HTTP e os workers dividem a fila
+PORTA = int(os.environ.get('MS_PAGAMENTO_PORTA', 5003)) # Outra porta para um segundo worker
 
 # URL do simulador que CRIAMOS no passo 4
 SIMULADOR_URL = "http://127.0.0.1:5004/iniciar_pagamento" 
+simulador = ClienteHTTP('Simulador', "http://127.0.0.1:5004", pool=10) # keep-alive + disjuntor
 
 # --- Configuração do Flask ---
 app = Flask(__name__)
 
 # --- Lógica de Publicação (Thread-safe) ---
 
-def publicar_evento(routing_key: str, evento: dict):
+publicador = PublicadorEventos(RABBITMQ_HOST, RABBITMQ_USER, RABBITMQ_PASS, EXCHANGE_NAME,
+                               nome='ms-pagamento', confirmar=CONFIRMAR_PUBLICACAO)
 
-    try:
-        credentials = pika.PlainCredentials(RABBITMQ_USER, RABBITMQ_PASS)
-        connection = pika.BlockingConnection(pika.ConnectionParameters(host=RABBITMQ_HOST, credentials=credentials))
-        channel = connection.channel()
-        channel.exchange_declare(exchange=EXCHANGE_NAME, exchange_type='topic')
-        
-        channel.basic_publish(
-            exchange=EXCHANGE_NAME,
-            routing_key=routing_key,
-            body=json.dumps(evento),
-            properties=pika.BasicProperties(delivery_mode=2)
-        )
-        print(f"  --> [PUB] Evento '{routing_key}' publicado.")
-        connection.close()
-    except Exception as e:
-        print(f"  [!] Erro ao publicar evento '{routing_key}': {e}")
+def publicar_evento(routing_key: str, evento: dict):
+    """
+    Publica um evento na exchange principal (Thread-safe).
+    Apenas enfileira no publicador compartilhado, que mantém a conexão aberta.
+    """
+    publicador.publicar(routing_key, evento)
+    print(f"  --> [PUB] Evento '{routing_key}' enfileirado.")
 
 # --- Endpoint REST (Recebe o Webhook do Simulador) ---
 
@@ -61,9 +62,26 @@ def receber_webhook_status():
     
     return jsonify({"status": "webhook recebido"}), 200
 
+@app.route('/metricas/publicador', methods=['GET'])
+def metricas_publicador():
+    return jsonify(publicador.estatisticas()), 200
+
+@app.route('/metricas/http', methods=['GET'])
+def metricas_http():
+    return jsonify({simulador.nome: simulador.estatisticas()}), 200
+
+@app.route('/metricas/consumo', methods=['GET'])
+def metricas_consumo():
+    return jsonify(consumidor.estatisticas()), 200
+
 # --- Funções de Consumo RabbitMQ ---
 
 def processar_leilao_vencedor(vencedor_info):
+    """
+    Cria o link de pagamento do vencedor. Se o Simulador não responde (conexão,
+    timeout, 5xx ou circuito aberto), lança ReprocessarDepois: o leilao.vencedor
+    só é confirmado depois que o link foi criado, nunca se perde.
+    """
 
     id_leilao = vencedor_info.get('id_leilao')
     print(f"\n[SUB] Recebido 'leilao.vencedor' para o leilão {id_leilao}")
@@ -80,12 +98,16 @@ def processar_leilao_vencedor(vencedor_info):
     try:
         # 1. Faz a requisição REST ao sistema externo 
         print(f"  ... Enviando requisição REST para Simulador em {SIMULADOR_URL}")
-        response = requests.post(SIMULADOR_URL, json=dados_pagamento)
-        response.raise_for_status() # Lança exceção se for erro HTTP (4xx ou 5xx)
+        response = simulador.post("/iniciar_pagamento", json=dados_pagamento)
+        if response.status_code >= 500:
+            raise ReprocessarDepois(f"Simulador respondeu {response.status_code}")
+        response.raise_for_status() # 4xx: o pedido em si é inválido, repetir não adianta
         
         # 2. Recebe o link de pagamento 
         resposta_json = response.json()
         link_pagamento = resposta_json.get('link_pagamento')
+        if not link_pagamento:
+            raise ReprocessarDepois("Simulador não retornou link de pagamento")
         
         print(f"  ... Simulador retornou link: {link_pagamento}")
         
@@ -97,47 +119,32 @@ def processar_leilao_vencedor(vencedor_info):
         }
         publicar_evento('link_pagamento', evento_link)
         
+    except ReprocessarDepois:
+        raise
+    except requests.exceptions.HTTPError as e:
+        print(f"  [!] Sistema de Pagamento Externo recusou o pedido: {e}")
     except requests.exceptions.RequestException as e:
+        # Inclui CircuitoAberto: o vencedor volta para a fila e é cobrado quando o Simulador voltar
         print(f"  [!] ERRO ao contatar o Sistema de Pagamento Externo: {e}")
+        raise ReprocessarDepois(str(e)) from e
     except Exception as e:
         print(f"  [!] ERRO ao processar vencedor do leilão: {e}")
 
-def callback_geral(ch, method, body):
-    routing_key = method.routing_key
-    mensagem = json.loads(body.decode())
-    
+def processar_evento(routing_key, mensagem):
     if routing_key == 'leilao.vencedor':
         processar_leilao_vencedor(mensagem)
-    
-    ch.basic_ack(delivery_tag=method.delivery_tag)
-
-def iniciar_consumidor_rabbitmq():
-    print("[*] Iniciando thread de consumo RabbitMQ...")
-    try:
-        credentials = pika.PlainCredentials(RABBITMQ_USER, RABBITMQ_PASS)
-        connection = pika.BlockingConnection(pika.ConnectionParameters(host=RABBITMQ_HOST, credentials=credentials))
-        channel = connection.channel()
-
-        channel.exchange_declare(exchange=EXCHANGE_NAME, exchange_type='topic')
-        result = channel.queue_declare(queue='', exclusive=True)
-        queue_name = result.method.queue
 
-        for key in BINDING_KEYS:
-            channel.queue_bind(exchange=EXCHANGE_NAME, queue=queue_name, routing_key=key)
-        
-        print(f'[*] MS Pagamento escutando por eventos: {BINDING_KEYS}.')
-        channel.basic_consume(queue=queue_name, on_message_callback=callback_geral)
-        channel.start_consuming()
-    except Exception as e:
-        print(f"[!] Thread RabbitMQ falhou: {e}")
+# Fila nomeada e durável compartilhada: vários workers do MS Pagamento competem
+# pelos eventos (cada vencedor é cobrado uma vez) e nada se perde num reinício
+consumidor = ConsumidorEventos(RABBITMQ_HOST, RABBITMQ_USER, RABBITMQ_PASS, EXCHANGE_NAME,
+                               FILA_EVENTOS, BINDING_KEYS, processar_evento,
+                               nome='ms-pagamento', prefetch=CONSUMO_PREFETCH)
 
 # --- Ponto de entrada ---
 if __name__ == '__main__':
-    # Inicia o consumidor RabbitMQ em uma thread separada
-    thread_rabbitmq = threading.Thread(target=iniciar_consumidor_rabbitmq)
-    thread_rabbitmq.daemon = True # Permite que o programa feche
-    thread_rabbitmq.start()
+    # Inicia o consumidor RabbitMQ em uma thread separada (reconecta sozinho)
+    consumidor.iniciar()
     
-    # Inicia o servidor Flask na thread principal (porta 5003)
-    print("[*] Iniciando servidor Flask (porta 5003) para Webhooks...")
-    app.run(port=5003, debug=True, use_reloader=False)
\ No newline at end of file
+    # Inicia o servidor Flask na thread principal (porta 5003 por padrão)
+    print(f"[*] Iniciando servidor Flask (porta {PORTA}) para Webhooks...")
+    app.run(port=PORTA, debug=True, use_reloader=False)
@@ -1,15 +1,21 @@
 # /microservices/simulador-pagamento/simulador-pagamento.py
 
+import os
+import sys
 import time
 import requests
 import threading
 from flask import Flask, request, jsonify
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from comum.http_cliente import ClienteHTTP
+
 app = Flask(__name__)
 
 # --- Configuração ---
 # O endpoint para onde este simulador enviará o status (o webhook do MS Pagamento)
 WEBHOOK_URL = "http://127.0.0.1:5003/webhook/status" # Assumindo que o MS Pagamento rodará na porta 5003
+ms_pagamento = ClienteHTTP('MS Pagamento', "http://127.0.0.1:5003", pool=10) # keep-alive + disjuntor
 
 proximo_id_transacao = 1000
 
@@ -30,9 +36,9 @@ def enviar_webhook_assincrono(dados_webhook):
     
     # 3. Envia a notificação de webhook via HTTP POST
     try:
-        requests.post(WEBHOOK_URL, json=dados_webhook)
+        ms_pagamento.post("/webhook/status", json=dados_webhook)
         print(f"[Simulador] Webhook para {dados_webhook['id_transacao']} enviado com sucesso.")
-    except requests.exceptions.ConnectionError:
+    except requests.exceptions.RequestException:
         print(f"[Simulador] ERRO: Não foi possível conectar ao MS Pagamento em {WEBHOOK_URL}. O serviço está rodando?")
 
 # --- Endpoint REST (Recebe o pedido do MS Pagamento) ---
@@ -69,6 +75,10 @@ def iniciar_pagamento():
     print(f"[Simulador] Retornando link de pagamento: {link_pagamento}")
     return jsonify({"link_pagamento": link_pagamento, "id_transacao": id_transacao}), 201
 
+@app.route('/metricas/http', methods=['GET'])
+def metricas_http():
+    return jsonify({ms_pagamento.nome: ms_pagamento.estatisticas()}), 200
+
 # --- Ponto de entrada ---
 if __name__ == '__main__':
     print("[*] Iniciando Simulador de Pagamento Externo (porta 5004)...")